@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+"""
+Micro benchmarks for the hot paths of the wiki. Run from the repository
+root, e.g.
+
+    venv/bin/python otterwiki/benchmark.py balancer
+
+Where an old and a new implementation exist, the benchmark prints the
+time per round of both and checks that they produce the same result.
+"""
+
+import argparse
+import ast
+import glob
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def markdown_corpus():
+    """
+    The markdown used in tests/test_renderer.py, plus the bundled help
+    pages and the example page from the tests.
+    """
+    corpus = []
+    with open(os.path.join(ROOT, "tests", "test_renderer.py")) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            corpus.append(node.value)
+    for filename in sorted(
+        glob.glob(os.path.join(ROOT, "otterwiki", "*.md"))
+    ) + [os.path.join(ROOT, "tests", "example.md")]:
+        with open(filename) as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def report(name, seconds, rounds):
+    print(f"{name:<40} {seconds / rounds * 1000:10.3f} ms/round")
+
+
+def bench_balancer(args):
+    from bs4 import BeautifulSoup
+
+    from otterwiki.renderer import balance_html, render
+
+    corpus = markdown_corpus()
+    with render.parser() as parser:
+        html = [parser(md) for md in corpus]
+    # one large page, like a long table or code listing would produce
+    html.append("\n".join(html) * args.scale)
+
+    def soup():
+        return [str(BeautifulSoup(h, "html.parser")) for h in html]
+
+    def balancer():
+        return [balance_html(h) for h in html]
+
+    assert soup() == balancer(), "balance_html differs from BeautifulSoup"
+    print(
+        f"{len(html)} documents, "
+        f"{sum(len(h) for h in html) / 1024:.0f} KiB of html"
+    )
+    report(
+        "BeautifulSoup html.parser",
+        timeit.timeit(soup, number=args.rounds),
+        args.rounds,
+    )
+    report(
+        "balance_html",
+        timeit.timeit(balancer, number=args.rounds),
+        args.rounds,
+    )
+
+
+def bench_toc(args):
+    from otterwiki.renderer import render
+
+    corpus = markdown_corpus() * args.scale
+
+    def markdown():
+        return [render.markdown(md)[1] for md in corpus]
+
+    def toc():
+        return [render.toc(md) for md in corpus]
+
+    assert markdown() == toc(), "toc() differs from markdown()"
+    print(f"{len(corpus)} documents")
+    report(
+        "markdown() toc",
+        timeit.timeit(markdown, number=args.rounds),
+        args.rounds,
+    )
+    report("toc()", timeit.timeit(toc, number=args.rounds), args.rounds)
+
+
+def synthetic_page(i):
+    return f"# Page {i}\n\ntext\n\n## Part {i}\n"
+
+
+CJK_WORDS = [
+    "知识", "助手", "系统", "页面", "搜索", "文档", "版本", "用户", "管理",
+    "编辑", "历史", "附件", "索引", "配置", "服务器", "数据库", "检索",
+    "模型", "向量", "分词", "的", "是", "在", "和",
+]  # fmt: skip
+LATIN_WORDS = [
+    "wiki", "git", "search", "page", "index", "markdown", "commit",
+    "server", "user", "history",
+]  # fmt: skip
+
+
+def mixed_page(i):
+    """
+    A page of Chinese sentences, without spaces, and some latin words.
+    """
+    rnd = random.Random(i)
+    lines = [f"# 页面 {i}", ""]
+    for _ in range(10):
+        words = [
+            (
+                rnd.choice(CJK_WORDS)
+                if rnd.random() < 0.85
+                else f" {rnd.choice(LATIN_WORDS)} "
+            )
+            for _ in range(16)
+        ]
+        lines.append("".join(words) + "。")
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_repository(path, pages, content=synthetic_page):
+    """
+    Create a git repository with the given number of pages, spread over
+    nested directories, some pages with subpages.
+    """
+    for i in range(pages):
+        section, topic = i % 97, (i // 97) % 13
+        if i % 5 == 0:
+            # a page with the same name as the directory of its subpages
+            filename = f"section {section}/topic {topic}.md"
+        else:
+            filename = f"section {section}/topic {topic}/page {i}.md"
+        filename = os.path.join(path, filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write(content(i))
+    git = ["git", "-C", path, "-c", "user.name=Benchmark"]
+    git += ["-c", "user.email=benchmark@example.org", "-c", "gc.auto=0"]
+    subprocess.run(git + ["init", "-q"], check=True)
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "pages"], check=True)
+
+
+def in_repository(pages, run, content=synthetic_page):
+    """
+    Configure the wiki with a synthetic repository of the given size and
+    call run() within a request context.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        repository = os.path.join(tmpdir, "repo")
+        synthetic_repository(repository, pages, content)
+        settings = os.path.join(tmpdir, "settings.cfg")
+        with open(settings, "w") as f:
+            f.write(f"REPOSITORY = '{repository}'\n")
+            f.write("SECRET_KEY = 'benchmark benchmark'\n")
+        os.environ["OTTERWIKI_SETTINGS"] = settings
+
+        from otterwiki.server import app
+
+        with app.test_request_context():
+            run()
+
+
+def in_subprocesses(name, args, run, content=synthetic_page):
+    if len(args.pages) == 1:
+        in_repository(args.pages[0], lambda: run(args.pages[0]), content)
+        return
+    # otterwiki.server is configured once per process, so every size runs
+    # in a process of its own
+    for pages in args.pages:
+        subprocess.run(
+            [sys.executable, __file__, name, "--pages", str(pages)],
+            check=True,
+        )
+
+
+def run_pageindex(pages):
+    from otterwiki.wiki import PageIndex
+
+    cold = timeit.timeit(PageIndex, number=1)
+    warm = timeit.timeit(PageIndex, number=1)
+    print(
+        f"{pages:>7} pages   PageIndex() cold {cold:8.3f} s"
+        f"   warm {warm:8.3f} s"
+    )
+
+
+def bench_pageindex(args):
+    in_subprocesses("pageindex", args, run_pageindex)
+
+
+def run_search(pages):
+    from otterwiki.wiki import Search
+
+    def search(query, scan=False, **kwargs):
+        s = Search(query, **kwargs)
+        s.compile()
+        if scan:
+            # search every page, without the trigrams
+            s.trigrams = None
+        return s.search()
+
+    build = timeit.timeit(lambda: search("text"), number=1)
+    print(f"{pages:>7} pages   building the index {build:8.3f} s")
+    for query in ["text", "part 1", "page 12345", "Page 1234[56]"]:
+        times = [
+            timeit.timeit(lambda: search(query, **kwargs), number=1)
+            for kwargs in [
+                dict(is_regexp=True, scan=True),
+                dict(is_regexp=True),
+                dict(),
+            ]
+        ]
+        print(
+            f"{pages:>7} pages   {query!r:<16}"
+            " scan {:7.3f} s   trigrams {:7.3f} s   words {:7.3f} s".format(
+                *times
+            )
+        )
+
+
+def run_scan(pages):
+    import otterwiki.wiki
+    from otterwiki.searchindex import ScanPool
+    from otterwiki.wiki import Search
+
+    def search(query):
+        s = Search(query, is_regexp=True)
+        s.compile()
+        # search every page, without the trigrams
+        s.trigrams = None
+        return s.search()
+
+    workers = max(os.cpu_count() or 1, 2)
+    pool = ScanPool(workers)
+    for query in ["text", "Page 1234[56]", r"\d+ *$"]:
+        otterwiki.wiki.scan_pool = ScanPool(1)
+        sequential = timeit.timeit(lambda: search(query), number=1)
+        expected = search(query)
+        otterwiki.wiki.scan_pool = pool
+        # start the workers
+        assert search(query) == expected, "the results differ"
+        parallel = timeit.timeit(lambda: search(query), number=1)
+        print(
+            f"{pages:>7} pages   {query!r:<16} sequential {sequential:7.3f} s"
+            f"   {workers} processes {parallel:7.3f} s"
+        )
+    pool.reset()
+
+
+def bench_scan(args):
+    in_subprocesses("scan", args, run_scan)
+
+
+def bench_search(args):
+    in_subprocesses("search", args, run_search)
+
+
+def run_tokenizer(pages):
+    from otterwiki.searchindex import SearchIndex
+    from otterwiki.server import storage
+
+    class WordIndex(SearchIndex):
+        """
+        The index with the words of the text as terms, as before CJK text
+        was split into bigrams.
+        """
+
+        def tokenize(self, text):
+            return [
+                (word.lower(), i)
+                for i, line in enumerate(text.splitlines())
+                for word in re.findall(r"\w+", line)
+            ]
+
+        def words(self, query):
+            return list(dict.fromkeys(t for t, _ in self.tokenize(query)))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, cls in [("words", WordIndex), ("bigrams", SearchIndex)]:
+            filename = os.path.join(tmpdir, f"{name}.sqlite")
+            index = cls(storage, filename=filename)
+            build = timeit.timeit(index.update, number=1)
+            conn = index._connection()
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            terms = conn.execute(
+                "SELECT COUNT(DISTINCT term) FROM posting"
+            ).fetchone()[0]
+            postings = conn.execute("SELECT COUNT(*) FROM posting")
+            print(
+                f"{pages:>7} pages   {name:<8} build {build:7.3f} s"
+                f"   {os.path.getsize(filename) / 2**20:7.1f} MiB"
+                f"   {terms:>7} terms"
+                f"   {postings.fetchone()[0]:>8} postings"
+            )
+            for query in ["知识", "数据库", "向量模型", "wiki 检索", "索"]:
+                words = index.words(query)
+                seconds = timeit.timeit(lambda: index.search(words), number=5)
+                print(
+                    f"{'':>17}{query!r:<14}"
+                    f" {len(index.search(words)):>7} pages"
+                    f"   {seconds / 5 * 1000:9.3f} ms"
+                )
+
+
+def bench_tokenizer(args):
+    in_subprocesses("tokenizer", args, run_tokenizer, mixed_page)
+
+
+def run_vectors(chunks):
+    import numpy as np
+
+    from otterwiki.vectorstore import VectorStore, normalize
+
+    class RandomEmbedder:
+        """
+        Random unit vectors, embedding with a model is not benchmarked.
+        """
+
+        name, dim = "random", 256
+        rng = np.random.default_rng(42)
+
+        def embed(self, texts):
+            return normalize(
+                self.rng.normal(size=(len(texts), self.dim)).astype(np.float32)
+            )
+
+    embedder = RandomEmbedder()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = VectorStore(tmpdir, embedder=embedder)
+        build = timeit.timeit(
+            lambda: [
+                store.add(
+                    [
+                        dict(
+                            id=str(i),
+                            pagepath=f"page {i}",
+                            anchor="",
+                            breadcrumb=[],
+                            text="",
+                        )
+                        for i in range(start, min(start + 10000, chunks))
+                    ]
+                )
+                for start in range(0, chunks, 10000)
+            ],
+            number=1,
+        )
+        # deserializing the matrix, as with pickle or np.load()
+        matrix = store._load()[0]
+        filename = os.path.join(tmpdir, "matrix.npy")
+        np.save(filename, matrix)
+        load = timeit.timeit(lambda: np.load(filename), number=1)
+        mmap = timeit.timeit(
+            lambda: VectorStore(tmpdir, embedder=embedder)._load(), number=1
+        )
+        queries = embedder.embed([""] * 32)
+        single = timeit.timeit(
+            lambda: [store.search_vectors(q[None, :]) for q in queries],
+            number=1,
+        )
+        batch = timeit.timeit(lambda: store.search_vectors(queries), number=1)
+        print(
+            f"{chunks:>7} chunks   add {build:7.3f} s"
+            f"   np.load {load * 1000:8.2f} ms   mmap {mmap * 1000:8.2f} ms"
+            f"   32 queries: one by one {single * 1000:8.2f} ms"
+            f"   batched {batch * 1000:8.2f} ms"
+        )
+
+
+def bench_vectors(args):
+    # the store does not read the pages
+    in_repository(1, lambda: [run_vectors(chunks) for chunks in args.pages])
+
+
+def run_ann(chunks):
+    import numpy as np
+
+    from otterwiki.vectorstore import VectorStore, normalize
+
+    # clustered vectors, as the embeddings of similar texts are, random
+    # vectors have no neighbours to find
+    rng = np.random.default_rng(42)
+    dim = 256
+    centers = normalize(rng.normal(size=(max(chunks // 100, 1), dim)))
+    data = np.empty((chunks, dim), dtype=np.float32)
+    for start in range(0, chunks, 100000):
+        n = min(100000, chunks - start)
+        data[start : start + n] = normalize(
+            centers[rng.integers(0, len(centers), size=n)]
+            + rng.normal(scale=0.04, size=(n, dim))
+        )
+
+    class DataEmbedder:
+        name = "data"
+
+        def __init__(self):
+            self.dim = dim
+
+        def embed(self, texts):
+            return data[[int(text) for text in texts]]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = VectorStore(tmpdir, embedder=DataEmbedder())
+        store.IVF_ROWS = chunks
+        build = timeit.timeit(
+            lambda: [
+                store.add(
+                    [
+                        dict(
+                            id=str(i),
+                            pagepath="",
+                            anchor="",
+                            breadcrumb=[],
+                            text=str(i),
+                        )
+                        for i in range(start, min(start + 10000, chunks))
+                    ]
+                )
+                for start in range(0, chunks, 10000)
+            ],
+            number=1,
+        )
+        print(f"{chunks:>8} chunks   add and train {build:7.3f} s")
+        queries = data[rng.choice(chunks, 100)] + rng.normal(
+            scale=0.02, size=(100, dim)
+        ).astype(np.float32)
+
+        def ids(**kwargs):
+            return [
+                {
+                    c["id"]
+                    for _, c in store.search_vectors(q[None, :], **kwargs)[0]
+                }
+                for q in queries
+            ]
+
+        exact = ids(k=10, exact=True)
+        seconds = timeit.timeit(lambda: ids(k=10, exact=True), number=1)
+        print(
+            f"{'exact':>17}   recall@10 {1:6.3f}"
+            f"   {seconds / len(queries) * 1000:8.3f} ms/query"
+        )
+        for nprobe in [1, 2, 4, 8, 16, 32]:
+            found = ids(k=10, nprobe=nprobe)
+            recall = np.mean([len(f & e) / 10 for f, e in zip(found, exact)])
+            seconds = timeit.timeit(lambda: ids(k=10, nprobe=nprobe), number=1)
+            print(
+                f"{'nprobe ' + str(nprobe):>17}   recall@10 {recall:6.3f}"
+                f"   {seconds / len(queries) * 1000:8.3f} ms/query"
+            )
+
+
+def bench_ann(args):
+    # the store does not read the pages
+    in_repository(1, lambda: [run_ann(chunks) for chunks in args.pages])
+
+
+def run_retrieve(pages):
+    import numpy as np
+
+    from otterwiki.searchindex import search_index
+    from otterwiki.vectorstore import change_feed
+    from otterwiki.wiki import Retrieval
+
+    build = timeit.timeit(search_index.update, number=1)
+    chunk = timeit.timeit(change_feed.update, number=1)
+    print(
+        f"{pages:>7} pages   building the index {build:8.3f} s"
+        f"   chunking and embedding {chunk:8.3f} s"
+    )
+    rnd = random.Random(42)
+    for n in [1, 2, 3]:
+        queries = ["".join(rnd.sample(CJK_WORDS, n)) for _ in range(50)]
+        times = sorted(
+            timeit.timeit(lambda: Retrieval(query).results(), number=1)
+            for query in queries
+        )
+        print(
+            f"{pages:>7} pages   {n} words   p50 "
+            f"{np.percentile(times, 50) * 1000:8.3f} ms   p95 "
+            f"{np.percentile(times, 95) * 1000:8.3f} ms"
+        )
+
+
+def bench_retrieve(args):
+    in_subprocesses("retrieve", args, run_retrieve, mixed_page)
+
+
+BENCHMARKS = {
+    "ann": bench_ann,
+    "balancer": bench_balancer,
+    "pageindex": bench_pageindex,
+    "retrieve": bench_retrieve,
+    "scan": bench_scan,
+    "search": bench_search,
+    "toc": bench_toc,
+    "tokenizer": bench_tokenizer,
+    "vectors": bench_vectors,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=10,
+        help="how often the corpus is repeated for the large document",
+    )
+    parser.add_argument(
+        "--pages",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="the sizes of the synthetic repositories",
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+"""
+Splits pages into chunks for retrieval.
+
+The chunker walks the block tokens mistune produces with the parser of
+the OtterwikiRenderer. A heading always starts a new chunk, the blocks
+of a section are packed into chunks of at most `budget` tokens, counted
+with the tokenizer of the search index. Blocks larger than the budget
+are split by lines, code blocks and tables keep their fence and header
+in every part. Lines larger than the budget are split after the end of
+their sentences, sentences larger than the budget between their tokens.
+
+Every chunk is a dict with
+
+    id          a hash of the page, the headings and the text, unchanged
+                chunks keep their id when the page is edited
+    pagepath    the page the chunk belongs to
+    breadcrumb  the headings the chunk is nested in
+    anchor      the anchor of the heading in the rendered page
+    text        the markdown of the chunk
+    tokens      the number of tokens of the text
+"""
+
+import hashlib
+import json
+import re
+
+from markupsafe import Markup
+
+from otterwiki.plugins import chain_hooks
+from otterwiki.renderer import render
+from otterwiki.tokenizer import RE_TOKEN, tokenize
+
+BUDGET = 256
+# long lines, e.g. paragraphs in CJK, are split after the end of a sentence
+RE_SENTENCE = re.compile(r"(?<=[.!?。！？])\s*")
+# the tokens that are not part of the text of a page
+SKIP = {"newline", "thematic_break", "frontmatter", "footnotes"}
+
+
+def count(text):
+    return len(tokenize(text))
+
+
+def chunk_id(pagepath, breadcrumb, text):
+    value = json.dumps([pagepath, breadcrumb, text], ensure_ascii=False)
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+class Chunker:
+    def __init__(self, pagepath, budget=BUDGET, renderer=render):
+        self.pagepath = pagepath
+        self.budget = budget
+        self.renderer = renderer
+
+    def chunks(self, text):
+        """
+        Returns the chunks of the markdown text, in the order of the page.
+        """
+        text = chain_hooks("renderer_markdown_preprocess", text)
+        if len(text) < 1 or text[-1] != "\n":
+            text += "\n"
+        self.result = []
+        self.breadcrumb = []
+        self.anchor = ""
+        self.blocks = []
+        with self.renderer.parser() as parser:
+            parser.renderer.reset_toc()
+            state = {}
+            text, state = parser.before_parse(text, state)
+            tokens = parser.block.parse(text, state)
+            tokens = parser.before_render(tokens, state)
+            for tok in tokens:
+                if tok["type"] == "heading":
+                    self._heading(parser, tok, state)
+                elif tok["type"] not in SKIP:
+                    self.blocks.append(self._block(tok))
+            self._flush()
+            self._footnotes(state)
+        return self._ids(self.result)
+
+    def _heading(self, parser, tok, state):
+        self._flush()
+        level = tok["params"][0]
+        # the anchor as the rendered page has it, duplicates are numbered
+        parser.renderer.heading(parser.inline(tok["text"], state), level)
+        _, _, _, raw, anchor = parser.renderer.toc_tree[-1]
+        self.breadcrumb = [
+            (lv, title) for lv, title in self.breadcrumb if lv < level
+        ] + [(level, raw)]
+        self.anchor = anchor
+
+    def _footnotes(self, state):
+        """
+        The footnotes are rendered at the end of the page, they form a
+        section of their own.
+        """
+        if not state.get("def_footnotes"):
+            return
+        self.breadcrumb = []
+        self.anchor = "fn-1"
+        for key, text in state["def_footnotes"].items():
+            self.blocks.append(
+                self._block({"text": f"[^{key}]: {text.strip()}"})
+            )
+        self._flush()
+
+    def _text(self, tok):
+        """
+        The markdown of a token, nested blocks are indented.
+        """
+        kind = tok.get("type")
+        if kind in SKIP:
+            return ""
+        if kind == "block_code":
+            info = (tok.get("params") or ("",))[0] or ""
+            return f"```{info}\n{tok['raw']}```"
+        if kind == "block_html":
+            return Markup(tok["raw"]).striptags()
+        if kind == "table":
+            return "\n".join(self._table(tok))
+        if kind == "list":
+            ordered = tok["params"][0]
+            items = []
+            for i, item in enumerate(tok["children"]):
+                marker = f"{i + 1}." if ordered else "-"
+                if item["type"] == "task_list_item":
+                    marker += " [x]" if item["params"][1] else " [ ]"
+                text = self._children(item)
+                items.append(marker + " " + text.replace("\n", "\n" + " " * 4))
+            return "\n".join(items)
+        if kind == "block_quote":
+            return "\n".join(
+                "> " + line for line in self._children(tok).split("\n")
+            )
+        if isinstance(tok.get("children"), list):
+            return self._children(tok)
+        return tok.get("text") or tok.get("raw") or ""
+
+    def _children(self, tok):
+        texts = [self._text(child) for child in tok["children"]]
+        return "\n".join(text for text in texts if text)
+
+    def _table(self, tok):
+        rows = []
+        for part in tok["children"]:
+            if part["type"] == "table_head":
+                cells = [cell["text"] for cell in part["children"]]
+                rows.append("| " + " | ".join(cells) + " |")
+                rows.append("|" + "---|" * len(cells))
+            else:
+                for row in part["children"]:
+                    cells = [cell["text"] for cell in row["children"]]
+                    rows.append("| " + " | ".join(cells) + " |")
+        return rows
+
+    def _block(self, tok):
+        """
+        Returns (head, lines, tail) of a block, when the block is split the
+        head and the tail are repeated in every part.
+        """
+        if tok.get("type") == "block_code":
+            info = (tok.get("params") or ("",))[0] or ""
+            head, tail = f"```{info}", "```"
+            lines = tok["raw"].rstrip("\n").split("\n")
+        elif tok.get("type") == "table":
+            rows = self._table(tok)
+            head, tail = "\n".join(rows[:2]), ""
+            lines = rows[2:]
+        else:
+            head, tail = "", ""
+            lines = self._text(tok).split("\n")
+        budget = max(1, self.budget - count(head) - count(tail))
+        result = []
+        for line in lines:
+            if count(line) > budget:
+                result += self._split(line, budget)
+            else:
+                result.append(line)
+        return (head, result, tail)
+
+    def _split(self, line, budget):
+        """
+        Splits a line after the end of its sentences, sentences larger than
+        the budget are split between their tokens. Every character of a
+        run of CJK characters adds a token.
+        """
+        parts = []
+        for sentence in RE_SENTENCE.split(line):
+            ends = []
+            for m in RE_TOKEN.finditer(sentence):
+                if m.group(1) is None:
+                    ends.append(m.end())
+                else:
+                    ends += range(m.start() + 1, m.end() + 1)
+            cuts = [0] + ends[budget - 1 : -1 : budget] + [len(sentence)]
+            parts += [sentence[a:b].strip() for a, b in zip(cuts, cuts[1:])]
+        return [part for part in parts if part]
+
+    def _parts(self, block):
+        """
+        Yields the text of the parts of a block within the budget.
+        """
+        head, lines, tail = block
+        head, tail = [head] if head else [], [tail] if tail else []
+        overhead = sum(count(line) for line in head + tail)
+        part, tokens = [], overhead
+        for line in lines:
+            n = count(line)
+            if part and tokens + n > self.budget:
+                yield "\n".join(head + part + tail)
+                part, tokens = [], overhead
+            part.append(line)
+            tokens += n
+        if part:
+            yield "\n".join(head + part + tail)
+
+    def _flush(self):
+        """
+        Packs the blocks of the current section into chunks.
+        """
+        texts, tokens = [], 0
+        for block in self.blocks:
+            for text in self._parts(block):
+                n = count(text)
+                if texts and tokens + n > self.budget:
+                    self._append("\n\n".join(texts), tokens)
+                    texts, tokens = [], 0
+                texts.append(text)
+                tokens += n
+        if texts:
+            self._append("\n\n".join(texts), tokens)
+        self.blocks = []
+
+    def _append(self, text, tokens):
+        self.result.append(
+            {
+                "pagepath": self.pagepath,
+                "breadcrumb": [title for _, title in self.breadcrumb],
+                "anchor": self.anchor,
+                "text": text,
+                "tokens": tokens,
+            }
+        )
+
+    def _ids(self, chunks):
+        seen = {}
+        for chunk in chunks:
+            id = chunk_id(
+                chunk["pagepath"], chunk["breadcrumb"], chunk["text"]
+            )
+            # identical chunks in the same section are numbered
+            seen[id] = seen.get(id, -1) + 1
+            chunk["id"] = id if seen[id] == 0 else f"{id}-{seen[id]}"
+        return chunks
+
+
+def chunk(pagepath, text, budget=BUDGET):
+    """
+    Returns the chunks of a page, see Chunker.
+    """
+    return Chunker(pagepath, budget).chunks(text)
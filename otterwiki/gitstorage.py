@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 # vim: set et ts=8 sts=4 sw=4 ai:
 
+import codecs
+import json
 import os
 import pathlib
+import queue
 import re
+import sqlite3
+import subprocess
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
 from datetime import datetime
 from typing import List, cast
 
 import git
 import git.exc
 
-from otterwiki.util import split_path, ttl_lru_cache
+from otterwiki.util import split_path
 
 
 class StorageError(Exception):
@@ -27,6 +35,432 @@ except NameError:
     FileNotFoundError = IOError
 
 
+class PathIndex(object):
+    """
+    Sorted in-memory listing of all files and directories in the working
+    tree, so that GitStorage.list() can be answered with a range scan
+    instead of an os.walk().
+
+    The index is tagged with a stamp (see GitStorage.stamp).
+    When the stamp changes behind our back the index is rebuilt, changes
+    made via GitStorage are applied incrementally.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.files = []
+        self.directories = []
+        self.lock = threading.RLock()
+
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
+
+    def _walk(self, relpath=""):
+        files, directories = [], []
+        for root, dirs, filenames in os.walk(os.path.join(self.path, relpath)):
+            root = os.path.relpath(root, self.path)
+            if root == ".":
+                root = ""
+            dirs[:] = [d for d in dirs if d != ".git"]
+            files += [os.path.join(root, f) for f in filenames]
+            directories += [os.path.join(root, d) for d in dirs]
+        return files, directories
+
+    def rebuild(self, stamp):
+        with self.lock:
+            files, directories = self._walk()
+            self.files = sorted(files)
+            self.directories = sorted(directories)
+            self.stamp = stamp
+
+    def ensure(self, stamp):
+        with self.lock:
+            if self.stamp != stamp:
+                self.rebuild(stamp)
+
+    @staticmethod
+    def _remove_prefix(entries, path):
+        # remove path itself and everything below path/
+        lo = bisect_left(entries, path)
+        if lo < len(entries) and entries[lo] == path:
+            del entries[lo]
+        prefix = path + "/"
+        lo = bisect_left(entries, prefix)
+        hi = lo
+        while hi < len(entries) and entries[hi].startswith(prefix):
+            hi += 1
+        del entries[lo:hi]
+
+    @staticmethod
+    def _add(entries, path):
+        i = bisect_left(entries, path)
+        if i >= len(entries) or entries[i] != path:
+            entries.insert(i, path)
+
+    def update(self, paths, stamp_before, stamp_after):
+        """
+        Refresh the given paths (files or directories, relative to the
+        repository root) from the filesystem. If the index was not in sync
+        with stamp_before, it is invalidated instead.
+        """
+        with self.lock:
+            if self.stamp is None or self.stamp != stamp_before:
+                self.stamp = None
+                return
+            for path in paths:
+                path = os.path.normpath(path)
+                if path in (".", "") or path.startswith(".."):
+                    self.stamp = None
+                    return
+                self._remove_prefix(self.files, path)
+                self._remove_prefix(self.directories, path)
+                fullpath = os.path.join(self.path, path)
+                if os.path.isdir(fullpath):
+                    self._add(self.directories, path)
+                    files, directories = self._walk(path)
+                    for f in files:
+                        insort(self.files, f)
+                    for d in directories:
+                        insort(self.directories, d)
+                elif os.path.exists(fullpath):
+                    self._add(self.files, path)
+                # make sure the parents are (not) listed
+                parent = os.path.dirname(path)
+                while parent != "":
+                    if os.path.isdir(os.path.join(self.path, parent)):
+                        self._add(self.directories, parent)
+                    else:
+                        self._remove_prefix(self.directories, parent)
+                    parent = os.path.dirname(parent)
+            self.stamp = stamp_after
+
+    @staticmethod
+    def _scan(entries, prefix, depth, excludes):
+        result = []
+        i = bisect_left(entries, prefix)
+        while i < len(entries) and entries[i].startswith(prefix):
+            rel = entries[i][len(prefix) :]
+            i += 1
+            parts = rel.split("/")
+            if depth is not None and len(parts) - 1 > depth:
+                continue
+            if excludes and any(p in excludes for p in parts[:-1]):
+                continue
+            result.append(rel)
+        return result
+
+    def list(self, relpath, depth=None, exclude=[]):
+        prefix = relpath + "/" if relpath else ""
+        with self.lock:
+            files = self._scan(self.files, prefix, depth, exclude)
+            directories = self._scan(self.directories, prefix, depth, exclude)
+        # directories matching the exclude list are not listed themselves
+        directories = [
+            d for d in directories if os.path.basename(d) not in exclude
+        ]
+        return files, directories
+
+
+class CommitMetadataCache(object):
+    """
+    Cache for the metadata of commits, keyed by the full hexsha. Since the
+    metadata of a commit never changes, entries never expire. Recently used
+    entries are kept in memory, all entries are stored in a sqlite database
+    so that they survive restarts and are shared between worker processes.
+    The database is bounded to `maxsize` entries, the oldest are dropped
+    first.
+    """
+
+    def __init__(self, filename=None, maxsize=100000, memsize=1024):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.memsize = memsize
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._inserts = 0
+
+    def _connection(self):
+        if self.filename is None:
+            return None
+        # connections must not be shared with forked worker processes
+        if self._conn is None or self._pid != os.getpid():
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                conn = sqlite3.connect(
+                    self.filename,
+                    timeout=5,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS commit_metadata ("
+                    "hexsha TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                )
+            except (sqlite3.Error, OSError):
+                # fall back to a memory only cache
+                self.filename = None
+                return None
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _encode(metadata):
+        value = dict(metadata)
+        value["datetime"] = value["datetime"].isoformat()
+        return json.dumps(value)
+
+    @staticmethod
+    def _decode(value):
+        metadata = json.loads(value)
+        metadata["datetime"] = datetime.fromisoformat(metadata["datetime"])
+        return metadata
+
+    def _remember(self, hexsha, metadata):
+        self._memory[hexsha] = metadata
+        self._memory.move_to_end(hexsha)
+        while len(self._memory) > self.memsize:
+            self._memory.popitem(last=False)
+
+    def get(self, hexsha):
+        with self._lock:
+            try:
+                metadata = self._memory[hexsha]
+                self._memory.move_to_end(hexsha)
+                self.hits += 1
+                return metadata
+            except KeyError:
+                pass
+            conn = self._connection()
+            row = None
+            if conn is not None:
+                try:
+                    row = conn.execute(
+                        "SELECT value FROM commit_metadata WHERE hexsha=?",
+                        (hexsha,),
+                    ).fetchone()
+                except sqlite3.Error:
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            metadata = self._decode(row[0])
+            self._remember(hexsha, metadata)
+            return metadata
+
+    def set(self, hexsha, metadata):
+        with self._lock:
+            self._remember(hexsha, metadata)
+            conn = self._connection()
+            if conn is None:
+                return
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO commit_metadata (hexsha, value) "
+                    "VALUES (?, ?)",
+                    (hexsha, self._encode(metadata)),
+                )
+                self._inserts += 1
+                if self._inserts % 256 == 0:
+                    # drop the oldest entries
+                    conn.execute(
+                        "DELETE FROM commit_metadata WHERE rowid <= ("
+                        "SELECT MAX(rowid) FROM commit_metadata) - ?",
+                        (self.maxsize,),
+                    )
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory": len(self._memory),
+        }
+
+
+class RevisionIndex(object):
+    """
+    The commits that touched a path, newest first, with lookups from a
+    (short) revision to its position in the history and from there to the
+    parent and child revision.
+    """
+
+    def __init__(self, hexshas):
+        self.hexshas = hexshas
+        self.position = {hexsha: i for i, hexsha in enumerate(hexshas)}
+        self.sorted = sorted(hexshas)
+
+    def __len__(self):
+        return len(self.hexshas)
+
+    def extend(self, newer_hexshas):
+        return RevisionIndex(newer_hexshas + self.hexshas)
+
+    def find(self, revision):
+        """
+        Returns the position of the newest commit starting with revision.
+        """
+        if revision in self.position:
+            return self.position[revision]
+        found = None
+        i = bisect_left(self.sorted, revision)
+        while i < len(self.sorted) and self.sorted[i].startswith(revision):
+            position = self.position[self.sorted[i]]
+            if found is None or position < found:
+                found = position
+            i += 1
+        return found
+
+    def get(self, revision):
+        i = self.find(revision)
+        if i is None:
+            return None
+        return self.hexshas[i]
+
+    def parent(self, revision):
+        i = self.find(revision)
+        if i is None or i + 1 >= len(self.hexshas):
+            return None
+        return self.hexshas[i + 1]
+
+    def child(self, revision):
+        i = self.find(revision)
+        if i is None or i < 1:
+            return None
+        return self.hexshas[i - 1]
+
+
+class CatFileProcess(object):
+    """
+    A long running `git cat-file --batch` (or `--batch-check`) process.
+    Requests are written to stdin, one object name per line. If the process
+    dies or the pipe breaks, it is restarted and the request is retried once.
+    """
+
+    def __init__(self, path, check=False):
+        self.path = path
+        self.check = check
+        self.proc = None
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            [
+                "git",
+                "cat-file",
+                "--batch-check" if self.check else "--batch",
+            ],
+            cwd=self.path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.kill()
+                self.proc.wait()
+            except OSError:
+                pass
+        self.proc = None
+
+    def _request(self, name):
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        assert self.proc is not None
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        self.proc.stdin.write(name.encode("utf8", "surrogateescape") + b"\n")
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline()
+        if not header:
+            raise BrokenPipeError("git cat-file closed the pipe")
+        parts = header.split()
+        if parts[-1] in (b"missing", b"ambiguous"):
+            return None
+        hexsha, objtype, size = parts[0], parts[1], int(parts[2])
+        data = None
+        if not self.check:
+            data = self.proc.stdout.read(size)
+            # every object is followed by a newline
+            if len(data) != size or self.proc.stdout.read(1) != b"\n":
+                raise BrokenPipeError("git cat-file returned short read")
+        return hexsha.decode(), objtype.decode(), size, data
+
+    def request(self, name):
+        """
+        Returns (hexsha, type, size, data) or None if the object does not
+        exist. data is None for --batch-check processes.
+        """
+        try:
+            return self._request(name)
+        except (OSError, ValueError, IndexError):
+            # restart the process and try again
+            self.close()
+            return self._request(name)
+
+
+class CatFilePool(object):
+    """
+    A pool of persistent CatFileProcess, shared by the threads of a worker.
+    Each request takes a process from the pool, so concurrent requests do
+    not interleave on the same pipe. Processes are started lazily and are
+    never shared with forked children.
+    """
+
+    def __init__(self, path, check=False, size=2):
+        self.path = path
+        self.check = check
+        self.size = size
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = queue.LifoQueue()
+                for _ in range(self.size):
+                    self._pool.put(CatFileProcess(self.path, self.check))
+                self._pid = os.getpid()
+            return self._pool
+
+    def request(self, name):
+        if "\n" in name:
+            return None
+        pool = self._get_pool()
+        proc = pool.get()
+        try:
+            return proc.request(name)
+        except (OSError, ValueError, IndexError):
+            proc.close()
+            raise
+        finally:
+            pool.put(proc)
+
+
+class LastCommitIndex(object):
+    """
+    Maps every path in the history of HEAD to the hexsha of the last commit
+    that touched it.
+    """
+
+    def __init__(self):
+        self.head = None
+        self.commits = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        return self.commits.get(path, None)
+
+
 class GitStorage(object):
     def __init__(self, path, initialize=False):
         # make path absolute
@@ -34,6 +468,17 @@ class GitStorage(object):
         if initialize:
             self.repo = git.Repo.init(self.path)
         self.repo = self._read_repo()
+        self._path_index = PathIndex(self.path)
+        self.metadata_cache = CommitMetadataCache(
+            os.path.join(self.path, ".git", "otterwiki", "metadata.sqlite")
+        )
+        self._revision_indices = OrderedDict()
+        self._revision_lock = threading.Lock()
+        self._cat_file = CatFilePool(self.path)
+        self._last_commit_index = LastCommitIndex()
+        self._cat_file_check = CatFilePool(self.path, check=True)
+        # called with the new HEAD after every commit
+        self._listeners = []
 
     def _read_repo(self):
         try:
@@ -49,6 +494,56 @@ class GitStorage(object):
         if os.path.exists(os.path.join(self.path, ".git/RELOAD_GIT")):
             os.remove(os.path.join(self.path, ".git/RELOAD_GIT"))
             self.repo = self._read_repo()
+            self._path_index.invalidate()
+
+    def _head(self):
+        """
+        The hexsha of HEAD, read from the refs. The objects are not looked
+        up, the persistent git process of the GitPython object database
+        must not be used by threads at the same time. Raises ValueError in
+        an empty repository.
+        """
+        return git.SymbolicReference.dereference_recursive(self.repo, "HEAD")
+
+    def stamp(self):
+        """
+        A stamp of the state of the repository, which the PathIndex and
+        other caches of the working tree are keyed on: the HEAD commit, the
+        mtime of the repository root and the mtime of the git index. Files
+        added or changed manually below the root without git add or commit
+        are picked up with the next commit.
+        """
+        try:
+            head = self._head()
+        except ValueError:
+            # empty repository
+            head = None
+        try:
+            index_mtime = os.stat(
+                os.path.join(self.path, ".git", "index")
+            ).st_mtime_ns
+        except FileNotFoundError:
+            index_mtime = None
+        return (head, os.stat(self.path).st_mtime_ns, index_mtime)
+
+    def _update_path_index(self, stamp_before, paths):
+        self._path_index.update(paths, stamp_before, self.stamp())
+
+    def subscribe(self, listener):
+        """
+        Call listener(head) after every commit, the listener should return
+        quickly and do the work elsewhere.
+        """
+        self._listeners.append(listener)
+
+    def notify(self):
+        """
+        Tell the listeners about a new HEAD, called after every commit and
+        by the GitHttpServer after a push has been received.
+        """
+        head = self.stamp()[0]
+        for listener in self._listeners:
+            listener(head)
 
     def exists(self, filename):
         return os.path.exists(os.path.join(self.path, filename))
@@ -67,15 +562,12 @@ class GitStorage(object):
     def load(self, filename, mode="r", revision=None, size=-1):
         self._check_reload()
         if revision is not None:
-            try:
-                content = self.repo.git.show(
-                    "{}:{}".format(revision, filename)
-                )
-                if mode == "rb":
-                    content = content.encode("utf8", "surrogateescape")
-            except git.exc.GitCommandError:
+            blob = self.load_blob("{}:{}".format(revision, filename))
+            if blob is None:
                 raise StorageNotFound
-            return content
+            if mode == "rb":
+                return blob
+            return blob.decode("utf8", "surrogateescape")
         try:
             with open(os.path.join(self.path, filename), mode=mode) as f:
                 content = f.read(size)
@@ -83,8 +575,36 @@ class GitStorage(object):
             raise StorageNotFound("{} not found.".format(filename))
         return content
 
-    @ttl_lru_cache(maxsize=128, ttl=60)
+    def load_blob(self, name):
+        """
+        Returns the raw content of the blob name (e.g. "<revision>:<path>")
+        or None if no such blob exists.
+        """
+        try:
+            obj = self._cat_file.request(name)
+        except (OSError, ValueError, IndexError):
+            return None
+        if obj is None or obj[1] != "blob":
+            return None
+        return obj[3]
+
+    def blob_info(self, name):
+        """
+        Returns (hexsha, size) of the blob name or None if no such blob
+        exists, without reading its content.
+        """
+        try:
+            obj = self._cat_file_check.request(name)
+        except (OSError, ValueError, IndexError):
+            return None
+        if obj is None or obj[1] != "blob":
+            return None
+        return obj[0], obj[2]
+
     def _get_metadata_of_commit(self, commit):
+        metadata = self.metadata_cache.get(commit.hexsha)
+        if metadata is not None:
+            return dict(metadata)
         metadata = {
             "revision-full": commit.hexsha,
             "revision": commit.hexsha[
@@ -102,28 +622,113 @@ class GitStorage(object):
             metadata["author_name"] = (
                 metadata["author_name"].replace("<>", "").strip()
             )
-        return metadata
+        self.metadata_cache.set(commit.hexsha, metadata)
+        return dict(metadata)
+
+    def _get_revision_index(self, filename, follow=False, maxsize=256):
+        """
+        Returns the RevisionIndex of filename at HEAD. With follow=True the
+        history is followed beyond renames, like log(filename) does.
+        """
+        try:
+            head = self._head()
+        except ValueError:
+            raise StorageNotFound
+        key = (filename, follow)
+        with self._revision_lock:
+            cached = self._revision_indices.get(key)
+            if cached is not None:
+                self._revision_indices.move_to_end(key)
+        if cached is not None and cached[0] == head:
+            return cached[1]
+        try:
+            # if HEAD moved forward, only the new commits have to be added
+            extend = (
+                not follow
+                and cached is not None
+                and self.repo.is_ancestor(cached[0], head)
+            )
+        except git.exc.GitCommandError:
+            extend = False
+        try:
+            if follow:
+                rawlog = self.repo.git.log(
+                    "--format=%H", "--follow", head, "--", filename
+                )
+                index = RevisionIndex(rawlog.split())
+            elif extend:
+                rawlog = self.repo.git.rev_list(
+                    "{}..{}".format(cached[0], head), "--", filename
+                )
+                index = cached[1].extend(rawlog.split())
+            else:
+                rawlog = self.repo.git.rev_list(head, "--", filename)
+                index = RevisionIndex(rawlog.split())
+        except (git.exc.GitCommandError, ValueError):
+            raise StorageNotFound
+        with self._revision_lock:
+            self._revision_indices[key] = (head, index)
+            while len(self._revision_indices) > maxsize:
+                self._revision_indices.popitem(last=False)
+        return index
+
+    def _get_last_commit(self, filename):
+        """
+        Returns the hexsha of the last commit that touched filename using
+        the LastCommitIndex. The index is built with a single pass over the
+        log and extended by the commits added since, whenever HEAD moves.
+        """
+        try:
+            head = self._head()
+        except ValueError:
+            # empty repository
+            return None
+        index = self._last_commit_index
+        with index.lock:
+            if index.head != head:
+                try:
+                    extend = index.head is not None and self.repo.is_ancestor(
+                        index.head, head
+                    )
+                except git.exc.GitCommandError:
+                    extend = False
+                revision = f"{index.head}..{head}" if extend else head
+                commits = {}
+                try:
+                    for hexsha, paths in self._iter_changed_paths(revision):
+                        for path in paths:
+                            commits.setdefault(path, hexsha)
+                except StorageNotFound:
+                    return None
+                if extend:
+                    index.commits.update(commits)
+                else:
+                    index.commits = commits
+                index.head = head
+            return index.get(filename)
 
     def _get_commit(self, filename, revision):
         self._check_reload()
         commit = None
         if revision is None:
-            try:
-                commit = list(
-                    self.repo.iter_commits(paths=filename, max_count=1)
-                )[0]
-            except (ValueError, IndexError, git.exc.GitCommandError):
-                raise StorageNotFound
+            hexsha = self._get_last_commit(filename)
+            if hexsha is not None:
+                commit = self.repo.commit(hexsha)
+            elif self.isdir(filename):
+                # directories are not in the index, walk their history
+                try:
+                    commit = list(
+                        self.repo.iter_commits(paths=filename, max_count=1)
+                    )[0]
+                except (ValueError, IndexError, git.exc.GitCommandError):
+                    raise StorageNotFound
         else:
-            try:
-                all_commits = list(self.repo.iter_commits(paths=filename))
-            except (git.exc.GitCommandError, ValueError):
-                raise StorageNotFound
-            for c in all_commits:
-                if c.hexsha.startswith(revision):
-                    # found
-                    commit = c
-                    break
+            hexsha = self._get_revision_index(filename).get(revision)
+            if hexsha is not None:
+                try:
+                    commit = self.repo.commit(hexsha)
+                except (ValueError, git.exc.BadName):
+                    raise StorageNotFound
         # not found :(
         if commit is None:
             raise StorageNotFound
@@ -257,6 +862,161 @@ class GitStorage(object):
 
         return [self._get_metadata_of_log(entry) for entry in rawlog]
 
+    RE_REVISION = re.compile(r"^[0-9a-fA-F]{4,40}$")
+
+    def iter_log(self, revision=None, filename=None, max_count=None):
+        """
+        Stream the log starting at revision (default HEAD), parsing the
+        output of `git log --name-only -z` entry by entry. The git process
+        is stopped as soon as the generator is closed, so the cost depends
+        on the number of entries consumed, not on the length of the history.
+        """
+        args = ["--name-only", "-z"]
+        if max_count:
+            args.append(f"--max-count={max_count}")
+        if revision is not None:
+            if not self.RE_REVISION.match(revision):
+                raise StorageNotFound("Invalid revision {}".format(revision))
+            args.append(revision)
+        if filename is not None:
+            args += ["--follow", "--", filename]
+        for entry in self._iter_log_output(args, "\x00\x00"):
+            entry = entry.strip("\x00")
+            if len(entry) > 0:
+                yield self._get_metadata_of_log(entry)
+
+    def _iter_log_output(self, args, separator):
+        """
+        Run `git log` with the given arguments and yield its output split by
+        separator, while it is read. The git process is killed when the
+        generator is closed early.
+        """
+        try:
+            proc = self.repo.git.log(*args, as_process=True)
+        except git.exc.GitCommandError as e:
+            raise StorageNotFound(str(e))
+        decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        buffer = ""
+        try:
+            while True:
+                chunk = proc.stdout.read1(65536)
+                buffer += decoder.decode(chunk, final=not chunk)
+                pieces = buffer.split(separator)
+                # the last piece might be incomplete
+                buffer = pieces.pop() if chunk else ""
+                for piece in pieces:
+                    yield piece
+                if not chunk:
+                    break
+            try:
+                proc.wait()
+            except git.exc.GitCommandError as e:
+                raise StorageNotFound(str(e))
+        finally:
+            if proc.proc is not None and proc.proc.poll() is None:
+                proc.proc.kill()
+                proc.proc.wait()
+
+    def _iter_changed_paths(self, revision):
+        """
+        Yield (hexsha, paths) for every commit in revision (a revision or a
+        revision range), newest first, from a single `git log --name-only`.
+        Merges list the paths that differ from every parent, e.g. the
+        resolved conflicts.
+        """
+        hexsha, paths = None, []
+        for token in self._iter_log_output(
+            [
+                "--name-only",
+                "-z",
+                "--no-renames",
+                "--cc",
+                "--format=%x01%H",
+                revision,
+                "--",
+            ],
+            "\x00",
+        ):
+            if token.startswith("\x01"):
+                if hexsha is not None:
+                    yield hexsha, paths
+                hexsha, paths = token[1:], []
+            elif len(token) > 0:
+                # the first path of a commit follows a newline
+                paths.append(token[1:] if token.startswith("\n") else token)
+        if hexsha is not None:
+            yield hexsha, paths
+
+    def newer_revisions(self, revision):
+        """
+        The full revisions of all commits between revision (exclusive) and
+        HEAD, newest first.
+        """
+        if not self.RE_REVISION.match(revision):
+            raise StorageNotFound("Invalid revision {}".format(revision))
+        try:
+            return self.repo.git.rev_list("{}..HEAD".format(revision)).split()
+        except git.exc.GitCommandError as e:
+            raise StorageNotFound(str(e))
+
+    def changed_files(self, revision_a, revision_b):
+        """
+        The paths of all files that differ between the two revisions.
+        """
+        for revision in (revision_a, revision_b):
+            if not self.RE_REVISION.match(revision):
+                raise StorageNotFound("Invalid revision {}".format(revision))
+        try:
+            output = self.repo.git.diff(
+                "--name-only", "-z", "--no-renames", revision_a, revision_b
+            )
+        except git.exc.GitCommandError as e:
+            raise StorageNotFound(str(e))
+        return [path for path in output.split("\x00") if path]
+
+    def is_ancestor(self, revision_a, revision_b):
+        """
+        Check if revision_a is an ancestor of (or equal to) revision_b.
+        """
+        for revision in (revision_a, revision_b):
+            if not self.RE_REVISION.match(revision):
+                raise StorageNotFound("Invalid revision {}".format(revision))
+        try:
+            return self.repo.is_ancestor(revision_a, revision_b)
+        except (git.exc.GitCommandError, ValueError) as e:
+            raise StorageNotFound(str(e))
+
+    def pickaxe(
+        self,
+        needle,
+        revision=None,
+        since=None,
+        is_regexp=False,
+        is_casesensitive=False,
+    ):
+        """
+        Stream the commits that added or removed needle in a markdown file,
+        newest first, like iter_log(). The files of every commit are the
+        files needle has been found in. Uses `git log -S`, with is_regexp
+        `git log -G` and a POSIX extended regular expression. With since
+        only the commits after since are searched.
+        """
+        args = ["--name-only", "-z", "--no-renames"]
+        args.append(("-G" if is_regexp else "-S") + needle)
+        if not is_casesensitive:
+            args.append("--regexp-ignore-case")
+        for r in (revision, since):
+            if r is not None and not self.RE_REVISION.match(r):
+                raise StorageNotFound("Invalid revision {}".format(r))
+        revision = revision or "HEAD"
+        if since is not None:
+            revision = "{}..{}".format(since, revision)
+        args += [revision, "--", "*.md"]
+        for entry in self._iter_log_output(args, "\x00\x00"):
+            entry = entry.strip("\x00")
+            if len(entry) > 0:
+                yield self._get_metadata_of_log(entry)
+
     def log_slow(self, filename=None):
         if filename is None:
             try:
@@ -283,6 +1043,7 @@ class GitStorage(object):
     ):
         if message is None:
             message = ""
+        stamp = self.stamp()
         dirname = os.path.dirname(filename)
         if dirname != "":
             os.makedirs(
@@ -300,9 +1061,14 @@ class GitStorage(object):
         index.add([filename])
         actor = git.Actor(author[0], author[1])
         index.commit(message, author=actor)
+        self._update_path_index(stamp, [filename])
+        self.notify()
         return True
 
     def commit(self, filenames, message="", author=("", ""), no_add=False):
+        if not type(filenames) == list:
+            filenames = [filenames]
+        stamp = self.stamp()
         index = self.repo.index
         # add and commit to git
         if no_add == False:
@@ -314,6 +1080,9 @@ class GitStorage(object):
                 )
         actor = git.Actor(author[0], author[1])
         index.commit(message, author=actor)
+        if not no_add:
+            self._update_path_index(stamp, filenames)
+        self.notify()
 
     def revert(self, revision, message="", author=("", "")):
         actor = git.Actor(author[0], author[1])
@@ -328,6 +1097,7 @@ class GitStorage(object):
 
         actor = git.Actor(author[0], author[1])
         self.repo.index.commit(message, author=actor)
+        self.notify()
 
     def diff(self, rev_a, rev_b):
         # https://docs.python.org/2/library/difflib.html
@@ -336,6 +1106,7 @@ class GitStorage(object):
     def delete(self, filename, message=None, author=("", "")):
         if not type(filename) == list:
             filename = [filename]
+        stamp = self.stamp()
         # make sure we only try to delete what exists
         filename_remove = [
             f for f in filename if self.exists(f) and not self.isdir(f)
@@ -360,6 +1131,8 @@ class GitStorage(object):
         if message is None:
             message = "Deleted {}.".format(filename_remove)
         self.repo.index.commit(message, author=actor)
+        self._update_path_index(stamp, filename)
+        self.notify()
 
     def rename(
         self,
@@ -373,6 +1146,7 @@ class GitStorage(object):
             raise StorageError(
                 f'The filename "{new_filename}" already exist. Please choose a new filename.'
             )
+        stamp = self.stamp()
         # make sure the target directory exists
         dirname = os.path.dirname(new_filename)
         if dirname != "":
@@ -391,8 +1165,20 @@ class GitStorage(object):
             message = "{} renamed to {}.".format(old_filename, new_filename)
         if not no_commit:
             self.commit([new_filename], message, author, no_add=True)
+        self._update_path_index(stamp, [old_filename, new_filename])
 
     def list(self, p=None, depth=None, exclude=[]):
+        if p is not None and os.path.isabs(p):
+            raise ValueError("p must not be an absolute path")
+        relpath = os.path.normpath(p) if p is not None else ""
+        if relpath == ".":
+            relpath = ""
+        if relpath.startswith(".."):
+            return self._list_walk(p, depth, exclude)
+        self._path_index.ensure(self.stamp())
+        return self._path_index.list(relpath, depth, exclude)
+
+    def _list_walk(self, p=None, depth=None, exclude=[]):
         excludes = [".git"] + exclude
         # full path to search
         if p is not None:
@@ -443,16 +1229,15 @@ class GitStorage(object):
 
     def get_parent_revision(self, filename, revision):
         """
-        Walk the log for the given file to find the revision of the commit before the given one.
+        Find the revision of the commit before the given one in the (renames
+        following) log of the given file.
         """
-        log = self.log(filename)
-        for i, entry in enumerate(log):
-            if entry['revision'] == revision:
-                try:
-                    return log[i + 1]['revision']
-                except IndexError:
-                    raise StorageNotFound
-        raise StorageNotFound
+        parent = self._get_revision_index(filename, follow=True).parent(
+            revision
+        )
+        if parent is None:
+            raise StorageNotFound
+        return parent[0:6]
 
 
 storage = None
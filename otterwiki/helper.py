@@ -14,6 +14,7 @@ import re
 from hashlib import sha256
 import json
 from collections import namedtuple
+from datetime import timezone
 from otterwiki.server import app, mail, storage, Preferences, db, app_renderer
 from otterwiki.gitstorage import StorageError
 from flask import flash, url_for, session
@@ -320,6 +321,22 @@ def update_ftoc_cache(filename, ftoc, mtime=None):
     db.session.commit()
 
 
+def _cached_ftoc(filename, result):
+    if result is None:
+        return None
+    try:
+        value = json.loads(result.value)
+        try:
+            # check
+            if filename == value["filename"]:
+                return value["ftoc"]
+        except KeyError:
+            pass
+    except:
+        pass
+    return None
+
+
 def get_ftoc(filename, mtime=None):
     if mtime is None:
         mtime = storage.mtime(filename)
@@ -328,20 +345,42 @@ def get_ftoc(filename, mtime=None):
     result = Cache.query.filter(
         db.and_(Cache.key == hash, Cache.datetime >= mtime)
     ).first()
-    if result is not None:
-        try:
-            value = json.loads(result.value)
-            try:
-                # check
-                if filename == value["filename"]:
-                    return value["ftoc"]
-            except KeyError:
-                pass
-        except:
-            pass
+    ftoc = _cached_ftoc(filename, result)
+    if ftoc is not None:
+        return ftoc
     content = storage.load(filename)
-    # parse file contents
-    _, ftoc = app_renderer.markdown(content)
+    # parse the headings of the file contents
+    ftoc = app_renderer.toc(content)
     update_ftoc_cache(filename, ftoc, mtime)
 
     return ftoc
+
+
+def get_ftocs(filenames):
+    """
+    get_ftoc() for a list of files, looking up the cached entries with one
+    query per chunk of files instead of one per file.
+    """
+    hashes = {
+        sha256sum(f"ftoc://{filename}"): filename for filename in filenames
+    }
+    results = {}
+    keys = list(hashes.keys())
+    # stay below the sqlite limit of variables per query
+    for i in range(0, len(keys), 500):
+        for result in Cache.query.filter(Cache.key.in_(keys[i : i + 500])):
+            results[hashes[result.key]] = result
+    ftocs = {}
+    for filename in filenames:
+        mtime = storage.mtime(filename)
+        result = results.get(filename)
+        ftoc = None
+        # the cache returns timezone aware datetimes in UTC
+        if result is not None and result.datetime >= mtime.astimezone(
+            timezone.utc
+        ):
+            ftoc = _cached_ftoc(filename, result)
+        if ftoc is None:
+            ftoc = get_ftoc(filename, mtime)
+        ftocs[filename] = ftoc
+    return ftocs
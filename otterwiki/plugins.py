@@ -41,6 +41,16 @@ class OtterWikiPluginSpec:
         This hooks receives a html string containing the page content.
         """
 
+    @hookspec(firstresult=True)
+    def vector_embedder(self):
+        """
+        This hook returns the embedder of the vector store, an object with
+        a `name`, the dimension `dim` and the method `embed(texts)`, which
+        returns the float32 numpy matrix of the normalized embeddings of
+        the texts. The first embedder returned is used, by default the
+        words are hashed.
+        """
+
 
 # pluggy doesn't by default handle chaining the output of one plugin into
 # another, so this is a small utility function to do this.
@@ -10,8 +10,10 @@ from otterwiki.auth import current_user, has_permission, check_credentials
 
 
 class GitHttpServer:
-    def __init__(self, path: str):
+    def __init__(self, path: str, storage=None):
         self.path = path
+        # the GitStorage told about received pushes
+        self.storage = storage
         # configure git to allow pushing into the current branch
         # of the non-bare repository, see https://git-scm.com/docs/git-config#Documentation/git-config.txt-receivedenyCurrentBranch
         config_command = [
@@ -89,7 +91,10 @@ class GitHttpServer:
     def git_receive_pack(self, stream):
         self.check_if_enabled()
         self.check_permission("UPLOAD")
-        return self.git_pack("receive", stream)
+        response = self.git_pack("receive", stream)
+        if self.storage is not None:
+            self.storage.notify()
+        return response
 
     def git_pack(self, service, stream):
         command = [f"git-{service}-pack", "--stateless-rpc", self.path]
@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 # vim: set et ts=8 sts=4 sw=4 ai:
 
+import hashlib
+import json
+import os
+import queue
 import re
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from html.parser import HTMLParser
 
 import mistune
-from bs4 import BeautifulSoup
+from bs4.dammit import EntitySubstitution
 from markupsafe import Markup, escape
 from mistune.plugins import plugin_strikethrough, plugin_table, plugin_url
 from pygments import highlight
@@ -12,7 +21,7 @@ from pygments.formatters import html
 from pygments.lexers import get_lexer_by_name
 from pygments.util import ClassNotFound
 
-from otterwiki.plugins import chain_hooks
+from otterwiki.plugins import chain_hooks, plugin_manager
 from otterwiki.renderer_plugins import (
     plugin_alerts,
     plugin_fancy_blocks,
@@ -27,6 +36,7 @@ from otterwiki.renderer_plugins import (
     plugin_frontmatter_title,
 )
 from otterwiki.util import empty, slugify
+from otterwiki.version import __version__
 
 # the cursor magic word which is ignored by the rendering
 cursormagicword = "CuRsoRm4g1cW0Rd"
@@ -97,10 +107,250 @@ def showmagicword(line, html):
     return "".join(arr)
 
 
+class HTMLBalancer(HTMLParser):
+    """
+    Single pass tag balancer. Fed with html it writes out the same markup
+    str(BeautifulSoup(html, 'html.parser')) would, without building a
+    tree: stray end tags are dropped, misnested tags are closed up to the
+    matching open tag and tags left open are closed at the end.
+    """
+
+    VOID_TAGS = {
+        'area',
+        'base',
+        'br',
+        'col',
+        'embed',
+        'hr',
+        'img',
+        'input',
+        'keygen',
+        'link',
+        'menuitem',
+        'meta',
+        'param',
+        'source',
+        'track',
+        'wbr',
+        'basefont',
+        'bgsound',
+        'command',
+        'frame',
+        'image',
+        'isindex',
+        'nextid',
+        'spacer',
+    }
+    PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+    CDATA_TAGS = {'script', 'style'}
+    # attributes which hold a whitespace separated list of values
+    LIST_ATTRIBUTES = {'class', 'accesskey', 'dropzone'}
+    TAG_LIST_ATTRIBUTES = {
+        'a': {'rel', 'rev'},
+        'link': {'rel', 'rev'},
+        'td': {'headers'},
+        'th': {'headers'},
+        'form': {'accept-charset'},
+        'object': {'archive'},
+        'area': {'rel'},
+        'icon': {'sizes'},
+        'iframe': {'sandbox'},
+        'output': {'for'},
+    }
+    ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+
+    def reset(self):
+        super().reset()
+        self.output = []
+        # the open tags as [name, start tag without the closing '>',
+        # start tag written]
+        self.stack = []
+        self.open_tags = Counter()
+        self.preserve_whitespace = 0
+        self.already_closed = []
+        self.data = []
+
+    def toplevel(self, name, attrs):
+        """Called for every tag opened outside of any other tag."""
+        pass
+
+    @staticmethod
+    def escape(text):
+        return (
+            text.replace("&", "&amp;")
+            .replace("<", "&lt;")
+            .replace(">", "&gt;")
+        )
+
+    def _attribute(self, key, value):
+        value = self.escape(value)
+        if '"' in value:
+            if "'" not in value:
+                return f"{key}='{value}'"
+            value = value.replace('"', "&quot;")
+        return f'{key}="{value}"'
+
+    def _open_parent(self):
+        if self.stack and not self.stack[-1][2]:
+            self.output.append(self.stack[-1][1] + ">")
+            self.stack[-1][2] = True
+
+    def _pop(self):
+        name, start, written = self.stack.pop()
+        self.open_tags[name] -= 1
+        if name in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace -= 1
+        if written:
+            self.output.append(f"</{name}>")
+        elif name in self.VOID_TAGS:
+            self.output.append(start + "/>")
+        else:
+            self.output.append(f"{start}></{name}>")
+
+    def _end_data(self, prefix=None, suffix=""):
+        if not self.data:
+            return
+        data = "".join(self.data)
+        self.data = []
+        if not self.preserve_whitespace and not data.strip(self.ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        self._open_parent()
+        if prefix is not None:
+            self.output.append(prefix + data + suffix)
+        elif self.stack and self.stack[-1][0] in self.CDATA_TAGS:
+            self.output.append(data)
+        else:
+            self.output.append(self.escape(data))
+
+    def handle_starttag(self, name, attrs, handle_empty_element=True):
+        attr_dict = {}
+        for key, value in attrs:
+            attr_dict[key] = "" if value is None else value
+        self._end_data()
+        if not self.stack:
+            self.toplevel(name, attr_dict)
+        list_attributes = self.TAG_LIST_ATTRIBUTES.get(name, ())
+        start = ["<" + name]
+        for key, value in sorted(attr_dict.items()):
+            if key in self.LIST_ATTRIBUTES or key in list_attributes:
+                value = " ".join(value.split())
+            start.append(self._attribute(key, value))
+        self._open_parent()
+        self.stack.append([name, " ".join(start), False])
+        self.open_tags[name] += 1
+        if name in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace += 1
+        if name in self.VOID_TAGS and handle_empty_element:
+            # void tags are closed right away, an explicit end tag
+            # showing up later is ignored
+            self.handle_endtag(name, check_already_closed=False)
+            self.already_closed.append(name)
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, handle_empty_element=False)
+        self.handle_endtag(name)
+
+    def handle_endtag(self, name, check_already_closed=True):
+        if check_already_closed and name in self.already_closed:
+            self.already_closed.remove(name)
+            return
+        self._end_data()
+        if not self.open_tags[name]:
+            # stray end tag
+            return
+        while self.stack:
+            popped = self.stack[-1][0]
+            self._pop()
+            if popped == name:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        if name[0] in "xX":
+            number = int(name.lstrip("xX"), 16)
+        else:
+            number = int(name)
+        data = None
+        if number < 256:
+            # numeric entities in the windows-1252 range are read as such
+            try:
+                data = bytearray([number]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(number)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else f"&{name}")
+
+    def handle_comment(self, data):
+        self._end_data()
+        self.data.append(data)
+        self._end_data("<!--", "-->")
+
+    def handle_decl(self, data):
+        self._end_data()
+        self.data.append(data[len("DOCTYPE ") :])
+        self._end_data("<!DOCTYPE ", ">\n")
+
+    def unknown_decl(self, data):
+        self._end_data()
+        if data.upper().startswith("CDATA["):
+            self.data.append(data[len("CDATA[") :])
+            self._end_data("<![CDATA[", "]]>")
+        else:
+            self.data.append(data)
+            self._end_data("<?", "?>")
+
+    def handle_pi(self, data):
+        self._end_data()
+        self.data.append(data)
+        self._end_data("<?", ">")
+
+    def close(self):
+        super().close()
+        self._end_data()
+        while self.stack:
+            self._pop()
+        output = "".join(self.output)
+        self.reset()
+        return output
+
+
+def balance_html(html: str) -> str:
+    balancer = HTMLBalancer()
+    balancer.feed(html)
+    return balancer.close()
+
+
+class _HTMLSanitizer(HTMLBalancer):
+    def __init__(self, remove_tags, remove_attributes):
+        super().__init__()
+        self.remove_tags = remove_tags
+        self.remove_attributes = remove_attributes
+        self.unsafe = False
+
+    def toplevel(self, name, attrs):
+        if name in self.remove_tags or any(
+            x in attrs for x in self.remove_attributes
+        ):
+            self.unsafe = True
+
+
 def clean_html(html: str) -> str:
-    # use BeautifulSoup to identify tags we want to remove / escape
+    # use the HTMLBalancer to identify tags we want to remove / escape
     # since we get incomplete tags via inline html we have to work
-    # with the html string and can not use what bs makes out of it
+    # with the html string and can not use what the balancer makes out of it
     REMOVE_ATTRIBUTES = [
         'onclick',
         'onload',
@@ -157,22 +407,10 @@ def clean_html(html: str) -> str:
     ]
     REMOVE_TAGS = ['style', 'script', 'blink', 'marque']
 
-    _escape = False
-    soup = BeautifulSoup(html, 'html.parser')
-    for element in soup:
-        if element.name in REMOVE_TAGS:  # pyright: ignore
-            _escape = True
-            break
-        try:
-            if any(
-                x in element.attrs.keys()  # pyright: ignore
-                for x in REMOVE_ATTRIBUTES
-            ):
-                _escape = True
-                break
-        except AttributeError:
-            continue
-    if _escape:
+    sanitizer = _HTMLSanitizer(REMOVE_TAGS, REMOVE_ATTRIBUTES)
+    sanitizer.feed(html)
+    sanitizer.close()
+    if sanitizer.unsafe:
         # take nom prisoners
         html = escape(html)
 
@@ -327,20 +565,32 @@ class OtterwikiMdParser(mistune.Markdown):
 
 
 class OtterwikiRenderer:
+    # the app.config keys that change the rendered html
+    CONFIG_KEYS = ["WIKILINK_STYLE"]
+
     def __init__(self, config={}):
-        self.env = {
-            "config": config,
+        self.config = config
+        # idle parsers, each markdown() call takes one for itself so
+        # that concurrent and nested calls don't share the toc or the
+        # extra kwargs stored in the env.
+        self._parsers = queue.LifoQueue()
+        self.lastword = re.compile(r"([a-zA-Z\-0-9\.]+)$")
+        self.htmlcursor = " <span id=\"otterwiki_cursor\"></span> "
+
+    def _build_parser(self):
+        env = {
+            "config": self.config,
         }
-        self.md_renderer = OtterwikiMdRenderer(env=self.env)
-        self.inline_parser = OtterwikiInlineParser(
-            env=self.env, renderer=self.md_renderer, hard_wrap=False
+        md_renderer = OtterwikiMdRenderer(env=env)
+        inline_parser = OtterwikiInlineParser(
+            env=env, renderer=md_renderer, hard_wrap=False
         )
-        self.block_parser = OtterwikiBlockParser()
+        block_parser = OtterwikiBlockParser()
 
-        self.mistune = OtterwikiMdParser(
-            renderer=self.md_renderer,
-            inline=self.inline_parser,
-            block=self.block_parser,
+        parser = OtterwikiMdParser(
+            renderer=md_renderer,
+            inline=inline_parser,
+            block=block_parser,
             plugins=[
                 plugin_table,
                 plugin_url,
@@ -357,16 +607,38 @@ class OtterwikiRenderer:
                 plugin_frontmatter,
                 plugin_frontmatter_title,
             ],
-            env=self.env,
+            env=env,
         )
-        self.lastword = re.compile(r"([a-zA-Z\-0-9\.]+)$")
-        self.htmlcursor = " <span id=\"otterwiki_cursor\"></span> "
         # thanks to https://github.com/lepture/mistune/issues/158#issuecomment-830481284
-        # we can enable tables in lists
-        self.mistune.block.list_rules += ['table', 'nptable']  # pyright:ignore
+        # we can enable tables in lists. list_rules is a class attribute,
+        # so extend a copy of it.
+        parser.block.list_rules = parser.block.list_rules + [
+            'table',
+            'nptable',
+        ]
+        return parser
+
+    @contextmanager
+    def parser(self):
+        """
+        Borrow a mistune parser with its own OtterwikiMdRenderer and env
+        for the duration of a single call.
+        """
+        try:
+            parser = self._parsers.get_nowait()
+        except queue.Empty:
+            parser = self._build_parser()
+        try:
+            yield parser
+        finally:
+            self._parsers.put(parser)
 
     def markdown(self, text, cursor=None, **kwargs):
-        self.md_renderer.reset_toc()
+        with self.parser() as parser:
+            return self._markdown(parser, text, cursor, **kwargs)
+
+    def _markdown(self, parser, text, cursor=None, **kwargs):
+        parser.renderer.reset_toc()
         # do the preparsing
         text = chain_hooks("renderer_markdown_preprocess", text)
         # to avoid that preparsing removes the trailing newline and to be
@@ -398,13 +670,15 @@ class OtterwikiRenderer:
 
         # store extra kwargs in environment
         for k, v in kwargs.items():
-            self.env[k.upper()] = v
-        html = self.mistune(text)
-        # clean extra kwargs from environment
-        for k, v in kwargs.items():
-            del self.env[k.upper()]
+            parser.env[k.upper()] = v
+        try:
+            html = parser(text)
+        finally:
+            # clean extra kwargs from environment
+            for k, v in kwargs.items():
+                del parser.env[k.upper()]
         # generate the toc
-        toc = self.md_renderer.toc_tree.copy()
+        toc = parser.renderer.toc_tree.copy()
         if cursor is not None and line > 0:
             # replace the magic word with the cursor span
             html = html.replace(cursormagicword, self.htmlcursor)
@@ -426,11 +700,194 @@ class OtterwikiRenderer:
         ]
 
         # make sure the page content is clean html.
-        # we shove it through BeautifulSoup.prettify this will get rid
+        # we shove it through the HTMLBalancer this will get rid
         # of wrong placed tags, too many closed tags and so on.
-        soup = BeautifulSoup(html, 'html.parser')
-        html = str(soup)
+        html = balance_html(html)
+
+        return html, toc
+
+    def toc(self, text):
+        """
+        The toc markdown(text) would return, without rendering the page:
+        the text is only split into blocks and the inline markdown is
+        parsed for the headings alone.
+        """
+        text = chain_hooks("renderer_markdown_preprocess", text)
+        # neither an atx heading nor a setext underline
+        if "#" not in text and "==" not in text and "--" not in text:
+            return []
+        if len(text) < 1 or text[-1] != "\n":
+            text += "\n"
+        with self.parser() as parser:
+            parser.renderer.reset_toc()
+            state = {}
+            text, state = parser.before_parse(text, state)
+            tokens = parser.block.parse(text, state)
+            tokens = parser.before_render(tokens, state)
+            self._toc_headings(parser, tokens, state)
+            return parser.renderer.toc_tree.copy()
+
+    def _toc_headings(self, parser, tokens, state):
+        for tok in tokens:
+            if tok["type"] == "heading":
+                parser.renderer.heading(
+                    parser.inline(tok["text"], state), *tok["params"]
+                )
+            elif "children" in tok:
+                self._toc_headings(parser, tok["children"], state)
 
+    def fingerprint(self):
+        """
+        A hash of everything besides the markdown that changes the output:
+        the otterwiki version, the renderer relevant config and the loaded
+        plugins.
+        """
+        config = self.config
+        plugins = sorted(
+            name for name, _ in plugin_manager.list_name_plugin()
+        ) + sorted(
+            f"{dist.project_name}-{dist.version}"
+            for _, dist in plugin_manager.list_plugin_distinfo()
+        )
+        value = json.dumps(
+            [
+                __version__,
+                [(k, str(config.get(k, ""))) for k in self.CONFIG_KEYS],
+                plugins,
+            ]
+        )
+        return hashlib.sha256(value.encode()).hexdigest()
+
+
+class RenderCache:
+    """
+    Content addressed cache for the html and toc rendered by an
+    OtterwikiRenderer. The key is made of the git blob hash of the markdown,
+    the fingerprint of the renderer and the extra arguments of markdown().
+
+    Entries are held in memory (LRU) and, if a path is given, as json files
+    on disk, shared by all worker processes. The mtime of a file is its
+    last access, the least recently used files are removed once more than
+    `disksize` entries are stored.
+    """
+
+    def __init__(self, renderer, path=None, memsize=256, disksize=10000):
+        self.renderer = renderer
+        self.path = path
+        self.memsize = memsize
+        self.disksize = disksize
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    @staticmethod
+    def blob_hash(text):
+        data = text.encode("utf8", "surrogateescape")
+        blob = hashlib.sha1(b"blob %d\x00" % len(data))
+        blob.update(data)
+        return blob.hexdigest()
+
+    def key(self, text, **kwargs):
+        value = json.dumps(
+            [
+                self.blob_hash(text),
+                self.renderer.fingerprint(),
+                sorted((k, str(v)) for k, v in kwargs.items()),
+            ]
+        )
+        return hashlib.sha256(value.encode()).hexdigest()
+
+    def _filename(self, key):
+        assert self.path is not None
+        return os.path.join(self.path, key[:2], key + ".json")
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memsize:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+        value = None
+        if self.path is not None:
+            filename = self._filename(key)
+            try:
+                with open(filename) as f:
+                    data = json.load(f)
+                value = (data["html"], [tuple(t) for t in data["toc"]])
+                # mark as recently used
+                os.utime(filename)
+            except (OSError, ValueError, KeyError, TypeError):
+                value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, value)
+        return value
+
+    def set(self, key, html, toc):
+        with self._lock:
+            self._remember(key, (html, toc))
+            self._writes += 1
+            evict = self._writes % 64 == 0
+        if self.path is None:
+            return
+        filename = self._filename(key)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(
+                dir=os.path.dirname(filename), suffix=".tmp"
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump({"html": html, "toc": toc}, f)
+            os.replace(tmpname, filename)
+        except OSError:
+            return
+        if evict:
+            self.evict()
+
+    def evict(self):
+        if self.path is None:
+            return
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for fn in files:
+                filename = os.path.join(root, fn)
+                try:
+                    entries.append((os.path.getmtime(filename), filename))
+                except OSError:
+                    pass
+        if len(entries) <= self.disksize:
+            return
+        entries.sort()
+        for _, filename in entries[: len(entries) - self.disksize]:
+            try:
+                os.remove(filename)
+                # remove the directory, if it is empty
+                os.rmdir(os.path.dirname(filename))
+            except OSError:
+                pass
+
+    def markdown(self, text, **kwargs):
+        """
+        Same as OtterwikiRenderer.markdown(text, **kwargs), served from the
+        cache if possible.
+        """
+        key = self.key(text, **kwargs)
+        value = self.get(key)
+        if value is not None:
+            return value
+        html, toc = self.renderer.markdown(text, **kwargs)
+        self.set(key, html, toc)
         return html, toc
 
 
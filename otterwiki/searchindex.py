@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+
+import os
+import re
+import json
+import math
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from re import _parser as sre_parse
+from otterwiki.server import app, storage
+from otterwiki.gitstorage import CommitMetadataCache, StorageNotFound
+from otterwiki.sidebar import SqliteStore
+from otterwiki.tokenizer import tokenize
+
+
+class SearchIndex(SqliteStore):
+    """
+    An inverted index of the words in all markdown files, used to rank
+    searches with BM25.
+
+    Every posting stores the positions of a word in a page together with
+    the line numbers, so that queries of several words are matched as a
+    phrase and the summaries of the search results are produced without
+    reading the files.
+
+    For regular expression and case sensitive searches, which the words
+    can not answer, the index keeps the trigrams of every page, to find
+    the pages that can match before running the search on them.
+
+    The index is stored with the HEAD commit it has been built for. When
+    HEAD moves, only the files changed in between are indexed again.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS document (
+            filename TEXT PRIMARY KEY, length INTEGER NOT NULL,
+            content TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS posting (
+            term TEXT NOT NULL, filename TEXT NOT NULL,
+            positions TEXT NOT NULL,
+            PRIMARY KEY (term, filename)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS posting_filename ON posting (filename);
+        CREATE TABLE IF NOT EXISTS trigram (
+            trigram TEXT NOT NULL, filename TEXT NOT NULL,
+            PRIMARY KEY (trigram, filename)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS trigram_filename ON trigram (filename);
+    """
+    # increase when the content of the index changes, to rebuild it
+    VERSION = "3"
+
+    # the BM25 parameters
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, storage, filename=None):
+        super().__init__(filename)
+        self.storage = storage
+        self.reads = 0
+        # the HEAD the index has been checked against by this process
+        self._head = None
+        # number of documents and sum of their lengths
+        self._stats = (0, 0)
+        self._lock = threading.Lock()
+
+    def tokenize(self, text):
+        """
+        Returns the list of (term, line number) of all terms in the text.
+        """
+        tokens = []
+        for i, line in enumerate(text.splitlines()):
+            tokens += [(term, i) for term in tokenize(line)]
+        return tokens
+
+    def words(self, query):
+        """
+        Returns the terms of the query in their order. In a page containing
+        the query the terms are found at consecutive positions, the last
+        one as the beginning of a term.
+        """
+        return tokenize(query)
+
+    def _add(self, conn, filename, content):
+        self._remove(conn, filename)
+        tokens = self.tokenize(content)
+        postings = {}
+        for position, (term, line) in enumerate(tokens):
+            postings.setdefault(term, []).append((position, line))
+        conn.executemany(
+            "INSERT INTO posting (term, filename, positions) VALUES (?, ?, ?)",
+            [
+                (term, filename, json.dumps(positions))
+                for term, positions in postings.items()
+            ],
+        )
+        conn.execute(
+            "INSERT INTO document (filename, length, content) "
+            "VALUES (?, ?, ?)",
+            (filename, len(tokens), content),
+        )
+        conn.executemany(
+            "INSERT INTO trigram (trigram, filename) VALUES (?, ?)",
+            [(trigram, filename) for trigram in trigrams(content.lower())],
+        )
+
+    def _remove(self, conn, filename):
+        conn.execute("DELETE FROM posting WHERE filename=?", (filename,))
+        conn.execute("DELETE FROM document WHERE filename=?", (filename,))
+        conn.execute("DELETE FROM trigram WHERE filename=?", (filename,))
+
+    def _changed_files(self, conn, head):
+        """
+        Returns the markdown files that have to be indexed again to bring the
+        index to head or None, if the index has to be rebuilt.
+        """
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if meta.get("version") != self.VERSION:
+            return None
+        indexed = meta.get("head")
+        if indexed == head:
+            return []
+        if indexed is None or head is None:
+            return None
+        try:
+            changed = self.storage.changed_files(indexed, head)
+        except StorageNotFound:
+            return None
+        return [f for f in changed if f.endswith(".md")]
+
+    def update(self):
+        """
+        Bring the index up to date with HEAD. Returns False if there is no
+        index.
+        """
+        head = self.storage.stamp()[0]
+        conn = self._connection()
+        if conn is None:
+            return False
+        if head is not None and head == self._head:
+            return True
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            filenames = self._changed_files(conn, head)
+            if filenames is None:
+                conn.execute("DELETE FROM posting")
+                conn.execute("DELETE FROM document")
+                conn.execute("DELETE FROM trigram")
+                files, _ = self.storage.list()
+                filenames = [f for f in files if f.endswith(".md")]
+            for filename in filenames:
+                try:
+                    content = self.storage.load(filename)
+                    self.reads += 1
+                    self._add(conn, filename, content)
+                except StorageNotFound:
+                    self._remove(conn, filename)
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("head", head), ("version", self.VERSION)],
+            )
+            conn.execute("COMMIT")
+            self._stats = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM document"
+            ).fetchone()
+        except sqlite3.Error:
+            return False
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        self._head = head
+        return True
+
+    def _postings(self, conn, word, filenames=None, prefix=True):
+        """
+        Returns a dict filename -> [positions, ...] of all terms starting
+        with word, or of the term word if not prefix, in all pages or in
+        the filenames. The positions are decoded only where needed.
+        """
+        query = (
+            "SELECT filename, positions FROM posting "
+            "WHERE term >= ? AND term < ?"
+        )
+        # the terms from word up to end, only word itself if not prefix
+        end = word + "\U0010ffff" if prefix else word + "\x00"
+        batches = [[]]
+        if filenames is not None:
+            filenames = sorted(filenames)
+            batches = [
+                filenames[i : i + 500] for i in range(0, len(filenames), 500)
+            ]
+        result = {}
+        for batch in batches:
+            sql = query
+            if filenames is not None:
+                sql += " AND filename IN ({})".format(
+                    ",".join("?" * len(batch))
+                )
+            for filename, positions in conn.execute(sql, [word, end] + batch):
+                result.setdefault(filename, []).append(positions)
+        return result
+
+    def _phrase(self, conn, words, filenames=None):
+        """
+        Returns the postings of the words of a phrase, the last word is
+        matched by its beginning.
+        """
+        return [
+            self._postings(conn, word, filenames, i == len(words) - 1)
+            for i, word in enumerate(words)
+        ]
+
+    def _documents(self, conn, column, filenames):
+        """
+        Returns a dict filename -> column of the documents of the filenames.
+        """
+        result = {}
+        filenames = sorted(filenames)
+        for i in range(0, len(filenames), 500):
+            batch = filenames[i : i + 500]
+            result.update(
+                conn.execute(
+                    "SELECT filename, {} FROM document "
+                    "WHERE filename IN ({})".format(
+                        column, ",".join("?" * len(batch))
+                    ),
+                    batch,
+                )
+            )
+        return result
+
+    def _candidates(self, conn, query, cache):
+        if isinstance(query, str):
+            if query not in cache:
+                cache[query] = {
+                    row[0]
+                    for row in conn.execute(
+                        "SELECT filename FROM trigram WHERE trigram=?",
+                        (query,),
+                    )
+                }
+            return cache[query]
+        op, queries = query
+        result = self._candidates(conn, queries[0], cache)
+        for q in queries[1:]:
+            if op == "and":
+                if not result:
+                    break
+                result = result & self._candidates(conn, q, cache)
+            else:
+                result = result | self._candidates(conn, q, cache)
+        return result
+
+    def candidates(self, query):
+        """
+        Returns the set of filenames that contain the trigrams of the query,
+        as returned by regex_trigrams(), or None, if there is no query or
+        the index is not available.
+        """
+        if query is None:
+            return None
+        with self._lock:
+            if not self.update():
+                return None
+            try:
+                return self._candidates(self._connection(), query, {})
+            except sqlite3.Error:
+                return None
+
+    def rank(self, words):
+        """
+        Returns a dict filename -> BM25 score of all pages containing the
+        words as a phrase, the last word as the beginning of a word, or
+        None, if the index is not available. The term frequencies of a
+        single word are counted without decoding the positions, those of
+        a phrase only in the pages containing all words. The pages are not
+        read.
+        """
+        if not words:
+            return None
+        with self._lock:
+            if not self.update():
+                return None
+            conn = self._connection()
+            try:
+                postings = self._phrase(conn, words)
+                filenames = set(postings[0])
+                for p in postings[1:]:
+                    filenames &= set(p)
+                if len(postings) == 1:
+                    # the number of [position, line] pairs
+                    tfs = {
+                        filename: sum(
+                            s.count("[") - 1 for s in postings[0][filename]
+                        )
+                        for filename in filenames
+                    }
+                else:
+                    tfs = {}
+                    for filename in filenames:
+                        tf = len(phrases([p[filename] for p in postings]))
+                        if tf > 0:
+                            tfs[filename] = tf
+                lengths = self._documents(conn, "length", tfs)
+            except sqlite3.Error:
+                return None
+            n, total = self._stats
+        avgdl = total / n if total else 1
+        df = len(tfs)
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        scores = {}
+        for filename, length in lengths.items():
+            tf = tfs[filename]
+            scores[filename] = (
+                idf
+                * tf
+                * (self.K1 + 1)
+                / (tf + self.K1 * (1 - self.B + self.B * length / avgdl))
+            )
+        return scores
+
+    def lines(self, words, filenames):
+        """
+        Returns a dict filename -> [(line number, line), ...] of the lines
+        with the phrase of the words in the pages of filenames, as found by
+        rank().
+        """
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return {}
+            try:
+                postings = self._phrase(conn, words, filenames)
+                contents = self._documents(conn, "content", filenames)
+            except sqlite3.Error:
+                return {}
+        result = {}
+        for filename, content in contents.items():
+            lines = set(phrases([p.get(filename, []) for p in postings]))
+            content_lines = content.splitlines()
+            result[filename] = [
+                (i, content_lines[i])
+                for i in sorted(lines)
+                if i < len(content_lines)
+            ]
+        return result
+
+    def search(self, words, limit=None):
+        """
+        Returns a dict filename -> (score, [(line number, line), ...]) of all
+        pages containing the words as a phrase or None, if the index is not
+        available. With limit only the best limit
+        pages come with their lines, the lines of the others are empty.
+        """
+        scores = self.rank(words)
+        if scores is None:
+            return None
+        best = sorted(scores, key=lambda f: -scores[f])[:limit]
+        lines = self.lines(words, best)
+        return {
+            filename: (score, lines.get(filename, []))
+            for filename, score in scores.items()
+        }
+
+
+def phrases(postings):
+    """
+    Returns the line numbers of all occurrences of a phrase in a page, from
+    the stored positions of every word of the phrase. The words of a phrase
+    are found at consecutive positions in the same line.
+    """
+    positions = []
+    for word in postings:
+        found = {}
+        for s in word:
+            found.update(json.loads(s))
+        positions.append(found)
+    return [
+        line
+        for position, line in positions[0].items()
+        if all(
+            positions[i].get(position + i) == line
+            for i in range(1, len(positions))
+        )
+    ]
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams of all lines of the text.
+    """
+    result = set()
+    for line in text.splitlines():
+        result.update(line[i : i + 3] for i in range(len(line) - 2))
+    return result
+
+
+def _and(queries):
+    queries = [q for q in queries if q is not None]
+    if len(queries) == 0:
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return ("and", queries)
+
+
+def _or(queries):
+    if len(queries) == 0 or None in queries:
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return ("or", queries)
+
+
+def _items(subpattern):
+    """
+    The items of a parsed regular expression with the groups inlined.
+    """
+    for op, av in subpattern:
+        if op is sre_parse.SUBPATTERN:
+            yield from _items(av[3])
+        elif op is sre_parse.ATOMIC_GROUP:
+            yield from _items(av)
+        else:
+            yield op, av
+
+
+def _chars(op, av):
+    """
+    The lowercase characters matched by a literal or a small character
+    class, or None.
+    """
+    if op is sre_parse.LITERAL:
+        return [chr(av).lower()]
+    if op is sre_parse.IN and 0 < len(av) <= 4:
+        if all(o is sre_parse.LITERAL for o, _ in av):
+            return sorted({chr(a).lower() for _, a in av})
+    return None
+
+
+def _sequence(subpattern):
+    queries = []
+    # the strings the current run of characters can be
+    strings = [""]
+
+    def flush():
+        nonlocal strings
+        queries.append(_or([_and(sorted(trigrams(s))) for s in strings]))
+        strings = [""]
+
+    for op, av in _items(subpattern):
+        chars = _chars(op, av)
+        if chars is not None:
+            if len(strings) * len(chars) > 16:
+                flush()
+            strings = [s + c for s in strings for c in chars]
+        elif op is sre_parse.AT:
+            # anchors match the empty string
+            continue
+        elif op in (
+            sre_parse.MAX_REPEAT,
+            sre_parse.MIN_REPEAT,
+            sre_parse.POSSESSIVE_REPEAT,
+        ):
+            flush()
+            if av[0] > 0:
+                queries.append(_sequence(av[2]))
+        elif op is sre_parse.BRANCH:
+            flush()
+            queries.append(_or([_sequence(b) for b in av[1]]))
+        else:
+            flush()
+    flush()
+    return _and(queries)
+
+
+def regex_trigrams(pattern, flags=0):
+    """
+    Returns the trigrams a line matching the regular expression has to
+    contain, as lowercase trigram or nested ("and", [...]) and
+    ("or", [...]) of them, or None, if no trigram is required.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (re.error, RecursionError):
+        return None
+    return _sequence(parsed)
+
+
+class PickaxeCache(SqliteStore):
+    """
+    The commits found by a search in the history, keyed by the search and
+    stored with the HEAD commit they have been searched up to, so that
+    after HEAD moved forward only the new commits have to be searched.
+
+    The number of stored searches is bounded to `maxsize`, the oldest are
+    dropped first.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS pickaxe ("
+        "key TEXT PRIMARY KEY, head TEXT NOT NULL, value TEXT NOT NULL)"
+    )
+
+    def __init__(self, filename=None, maxsize=1000):
+        super().__init__(filename)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(needle, is_regexp, is_casesensitive):
+        return json.dumps([needle, is_regexp, is_casesensitive])
+
+    def get(self, key):
+        """
+        Returns (head, commits) or None.
+        """
+        with self._lock:
+            rows = self._execute(
+                "SELECT head, value FROM pickaxe WHERE key=?", (key,)
+            )
+        if not rows:
+            return None
+        return rows[0][0], [
+            CommitMetadataCache._decode(value)
+            for value in json.loads(rows[0][1])
+        ]
+
+    def set(self, key, head, commits):
+        value = json.dumps([CommitMetadataCache._encode(c) for c in commits])
+        with self._lock:
+            self._execute(
+                "INSERT OR REPLACE INTO pickaxe (key, head, value) "
+                "VALUES (?, ?, ?)",
+                (key, head, value),
+            )
+            self._execute(
+                "DELETE FROM pickaxe WHERE rowid <= ("
+                "SELECT MAX(rowid) FROM pickaxe) - ?",
+                (self.maxsize,),
+            )
+
+
+class ScanPool:
+    """
+    A process pool for scanning files, started when it is needed first and
+    never shared with forked children. The workers are spawned, not
+    forked, so that they do not inherit the state of the threads of the
+    wiki.
+
+    Spawning runs sys.executable, under uWSGI that is not python and the
+    pool breaks. After the pool broke once, the files are scanned serially
+    in the process.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+        self._pid = None
+        # the process the pool broke in
+        self._broken = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the ProcessPoolExecutor or None with only one worker or
+        after the pool broke in this process.
+        """
+        if self.workers < 2 or self._broken == os.getpid():
+            return None
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self._pid = os.getpid()
+            return self._pool
+
+    def reset(self):
+        """
+        Drop a broken pool, the next get() starts a new one.
+        """
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def broken(self):
+        """
+        Drop a broken pool, the files are scanned serially in this process
+        from now on.
+        """
+        self._broken = os.getpid()
+        self.reset()
+
+
+search_index = SearchIndex(
+    storage,
+    filename=os.path.join(storage.path, ".git", "otterwiki", "search.sqlite"),
+)
+pickaxe_cache = PickaxeCache(
+    filename=os.path.join(storage.path, ".git", "otterwiki", "pickaxe.sqlite"),
+)
+try:
+    scan_pool = ScanPool(int(app.config["SEARCH_WORKERS"]))
+except ValueError:
+    scan_pool = ScanPool()
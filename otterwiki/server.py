@@ -13,7 +13,7 @@ import otterwiki.gitstorage
 import otterwiki.util
 from otterwiki import __version__, fatal_error
 from otterwiki.plugins import plugin_manager
-from otterwiki.renderer import OtterwikiRenderer
+from otterwiki.renderer import OtterwikiRenderer, RenderCache
 
 app = Flask(__name__)
 # default configuration settings
@@ -60,6 +60,11 @@ app.config.update(
     MAX_FORM_MEMORY_SIZE=1_000_000,
     HTML_EXTRA_HEAD="",
     HTML_EXTRA_BODY="",
+    # processes scanning files, default: number of CPUs. The processes are
+    # spawned with sys.executable, if that fails, e.g. under uWSGI, the
+    # files are scanned serially
+    SEARCH_WORKERS="",
+    VECTOR_DTYPE="float32",  # or float16, the type of the stored embeddings
 )
 app.config.from_envvar("OTTERWIKI_SETTINGS", silent=True)
 
@@ -182,6 +187,13 @@ update_app_config()
 #
 # initialize renderer
 app_renderer = OtterwikiRenderer(config=app.config)
+# and the cache for rendered pages
+app_render_cache = RenderCache(
+    app_renderer,
+    path=os.path.join(
+        storage.path, ".git", "otterwiki", "render"  # pyright: ignore
+    ),
+)
 
 
 #
@@ -228,7 +240,12 @@ app.jinja_env.globals.update(os_getenv=os.getenv)
 # initialize git via http
 import otterwiki.remote
 
-githttpserver = otterwiki.remote.GitHttpServer(path=app.config["REPOSITORY"])
+githttpserver = otterwiki.remote.GitHttpServer(
+    path=app.config["REPOSITORY"], storage=storage
+)
+
+# keep the chunks of the pages up to date with the commits
+import otterwiki.vectorstore  # pyright: ignore
 
 # contains application routes,
 # using side-effect of import executing the file to get
@@ -4,9 +4,12 @@
 import os
 import re
 import json
+import sqlite3
+import threading
 from collections import OrderedDict
 from flask import url_for
 from otterwiki.server import storage, app
+from otterwiki.gitstorage import StorageNotFound
 from otterwiki.util import (
     split_path,
     join_path,
@@ -61,12 +64,266 @@ class SidebarMenu:
         return self.menu
 
 
-class SidebarPageIndex:
+class SqliteStore:
+    """
+    Base for the indices that are stored in a sqlite database, so that
+    they survive restarts and are shared between worker processes.
+    """
+
+    # the CREATE TABLE statements
+    SCHEMA = ""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        """
+        Opens a connection to the database and creates the tables, returns
+        None if the database is not available.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            conn = sqlite3.connect(
+                self.filename,
+                timeout=5,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+        except (sqlite3.Error, OSError):
+            # fall back to memory only
+            self.filename = None
+            return None
+        return conn
+
+    def _connection(self):
+        if self.filename is None:
+            return None
+        # connections must not be shared with forked worker processes
+        if self._conn is None or self._pid != os.getpid():
+            conn = self._connect()
+            if conn is None:
+                return None
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql, parameters=(), many=False):
+        conn = self._connection()
+        if conn is None:
+            return None
+        try:
+            if many:
+                return conn.executemany(sql, parameters).fetchall()
+            return conn.execute(sql, parameters).fetchall()
+        except sqlite3.Error:
+            return None
+
+
+class PageHeaderIndex(SqliteStore):
+    """
+    The first markdown header of every page, as displayed in the sidebar
+    menu tree.
+
+    Entries are stored with the mtime and size of the file they have been
+    read from. As long as the storage stamp does not change the headers
+    are returned without touching the files. After a change every file is checked once with a
+    stat() and only read again if it has been modified.
+    """
+
     AXT_HEADING = re.compile(
         r' {0,3}(#{1,6})(?!#+)(?: *\n+|' r'\s+([^\n]*?)(?:\n+|\s+?#+\s*\n+))'
     )
     SETEX_HEADING = re.compile(r'([^\n]+)\n *(=|-){2,}[ \t]*\n+')
 
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS page_header ("
+        "filename TEXT PRIMARY KEY, mtime INTEGER NOT NULL, "
+        "size INTEGER NOT NULL, header TEXT)"
+    )
+
+    def __init__(self, storage, filename=None):
+        super().__init__(filename)
+        self.storage = storage
+        self.reads = 0
+        # filename -> (mtime_ns, size, header)
+        self._headers = {}
+        # the filenames checked since the stamp last changed
+        self._checked = set()
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """
+        Load the stored headers into memory.
+        """
+        with self._lock:
+            rows = self._execute(
+                "SELECT filename, mtime, size, header FROM page_header"
+            )
+            for filename, mtime, size, header in rows or []:
+                self._headers.setdefault(filename, (mtime, size, header))
+
+    def read_header(self, filename):
+        filehead = self.storage.load(filename, size=512)
+        self.reads += 1
+        # find first markdown header in filehead
+        header = [line for (_, line) in self.AXT_HEADING.findall(filehead)]
+        header += [line for (line, _) in self.SETEX_HEADING.findall(filehead)]
+        if len(header):
+            return header[0]
+        return None
+
+    def get(self, filenames):
+        """
+        Returns a dict filename -> first header (or None) for the given
+        filenames.
+        """
+        stamp = self.storage.stamp()
+        result = {}
+        changed = []
+        with self._lock:
+            if stamp != self._stamp:
+                self._stamp = stamp
+                self._checked = set()
+            for filename in filenames:
+                entry = self._headers.get(filename)
+                if entry is None or filename not in self._checked:
+                    try:
+                        stat = os.stat(
+                            os.path.join(self.storage.path, filename)
+                        )
+                    except OSError:
+                        result[filename] = None
+                        continue
+                    if entry is None or entry[:2] != (
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                    ):
+                        try:
+                            header = self.read_header(filename)
+                        except StorageNotFound:
+                            result[filename] = None
+                            continue
+                        entry = (stat.st_mtime_ns, stat.st_size, header)
+                        self._headers[filename] = entry
+                        changed.append((filename,) + entry)
+                    self._checked.add(filename)
+                result[filename] = entry[2]
+            if changed:
+                self._execute(
+                    "INSERT OR REPLACE INTO page_header "
+                    "(filename, mtime, size, header) VALUES (?, ?, ?, ?)",
+                    changed,
+                    many=True,
+                )
+        return result
+
+
+class MenuTreeCache(SqliteStore):
+    """
+    The ordered trees of the SidebarPageIndex, keyed by directory and the
+    menu tree settings, each stored with the HEAD commit it has been built
+    for.
+
+    When HEAD moves, an entry stays valid unless a page below its
+    directory has been added, removed, renamed or changed in between.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS menutree ("
+        "key TEXT PRIMARY KEY, head TEXT NOT NULL, value TEXT NOT NULL)"
+    )
+
+    def __init__(self, storage, filename=None, memsize=256):
+        super().__init__(filename)
+        self.storage = storage
+        self.memsize = memsize
+        self.hits = 0
+        self.misses = 0
+        # key -> (head, value)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, *settings):
+        return json.dumps([path] + list(settings))
+
+    def _remember(self, key, head, value):
+        self._memory[key] = (head, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memsize:
+            self._memory.popitem(last=False)
+
+    def _unchanged(self, path, head_before, head):
+        """
+        Check if no page below path changed between the two commits.
+        """
+        try:
+            changed = self.storage.changed_files(head_before, head)
+        except StorageNotFound:
+            return False
+        prefix = path.lower().strip("/") + "/" if path.strip("/") else ""
+        return not any(
+            f.lower().startswith(prefix) and f.lower().endswith(".md")
+            for f in changed
+        )
+
+    def get(self, path, key, head):
+        if head is None:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                rows = self._execute(
+                    "SELECT head, value FROM menutree WHERE key=?", (key,)
+                )
+                if rows:
+                    entry = (
+                        rows[0][0],
+                        json.loads(rows[0][1], object_pairs_hook=OrderedDict),
+                    )
+            if entry is not None and (
+                entry[0] == head or self._unchanged(path, entry[0], head)
+            ):
+                if entry[0] != head:
+                    self._execute(
+                        "UPDATE menutree SET head=? WHERE key=?", (head, key)
+                    )
+                self._remember(key, head, entry[1])
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, key, head, value):
+        if head is None:
+            return
+        with self._lock:
+            self._remember(key, head, value)
+            self._execute(
+                "INSERT OR REPLACE INTO menutree (key, head, value) "
+                "VALUES (?, ?, ?)",
+                (key, head, json.dumps(value)),
+            )
+
+
+page_headers = PageHeaderIndex(
+    storage,
+    filename=os.path.join(storage.path, ".git", "otterwiki", "headers.sqlite"),
+)
+page_headers.warm()
+menutree_cache = MenuTreeCache(
+    storage,
+    filename=os.path.join(
+        storage.path, ".git", "otterwiki", "menutree.sqlite"
+    ),
+)
+
+
+class SidebarPageIndex:
     def __init__(self, path: str = "/", mode: str = ""):
         self.path = (
             path if app.config["RETAIN_PAGE_NAME_CASE"] else path.lower()
@@ -86,19 +343,31 @@ class SidebarPageIndex:
         # load pages
         if self.mode == "":
             self.tree = None
-        else:
-            self.tree = OrderedDict()
-            self.load()
-            self.tree = self.order_tree(self.tree)
-
-    def read_header(self, filename):
-        filehead = storage.load(filename, size=512)
-        # find first markdown header in filehead
-        header = [line for (_, line) in self.AXT_HEADING.findall(filehead)]
-        header += [line for (line, _) in self.SETEX_HEADING.findall(filehead)]
-        if len(header):
-            return header[0]
-        return None
+            return
+        key = menutree_cache.key(
+            self.path,
+            self.mode,
+            self.max_depth,
+            app.config["SIDEBAR_MENUTREE_IGNORE_CASE"],
+            app.config["RETAIN_PAGE_NAME_CASE"],
+        )
+        head = storage.stamp()[0]
+        cached = menutree_cache.get(self.path, key, head)
+        if cached is not None:
+            self.tree = cached["tree"]
+            self.filenames_and_header = cached["filenames_and_header"]
+            return
+        self.tree = OrderedDict()
+        self.load()
+        self.tree = self.order_tree(self.tree)
+        menutree_cache.set(
+            key,
+            head,
+            {
+                "tree": self.tree,
+                "filenames_and_header": self.filenames_and_header,
+            },
+        )
 
     def order_tree(
         self,
@@ -181,11 +450,12 @@ class SidebarPageIndex:
                 entries.append(pp)
             entries.append(filename)
         entries = sorted(list(set(entries)))
+        headers = page_headers.get([e for e in entries if e.endswith(".md")])
 
         for entry in entries:
             header = None
             if entry.endswith(".md"):
-                header = self.read_header(entry)
+                header = headers[entry]
                 entry = entry[:-3]
             self.filenames_and_header.append((entry, header))
             parts = split_path(entry)
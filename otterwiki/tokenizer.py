@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+"""
+The tokenizer of the search and retrieval indices.
+
+Text in latin (or any other space separated) script is split into
+lowercase words. Chinese, Japanese and Korean text is not separated by
+spaces, runs of these characters are split into overlapping character
+bigrams instead.
+"""
+
+import regex
+
+CJK = r"\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}"
+# a run of CJK characters or a word of any other characters
+RE_TOKEN = regex.compile(r"([{0}]+)|[^\W{0}]+".format(CJK))
+RE_CJK = regex.compile(r"[{}]".format(CJK))
+
+
+def is_cjk(token):
+    return RE_CJK.match(token) is not None
+
+
+def bigrams(run, query=False):
+    """
+    Returns the overlapping bigrams of a run of CJK characters. In documents
+    the last character is added as unigram, so that every character starts a
+    token and a single character can be found as the prefix of a token.
+    """
+    if len(run) == 1:
+        return [run]
+    tokens = [run[i : i + 2] for i in range(len(run) - 1)]
+    if not query:
+        tokens.append(run[-1])
+    return tokens
+
+
+def tokenize(text, query=False):
+    """
+    Returns the list of lowercase tokens of the text. With query=True the
+    tokens of a search query are returned, which every document containing
+    the query contains, too.
+    """
+    tokens = []
+    for m in RE_TOKEN.finditer(text):
+        if m.group(1) is None:
+            tokens.append(m.group(0).lower())
+        else:
+            tokens += bigrams(m.group(1), query)
+    return tokens
@@ -386,3 +386,33 @@ def get_PatchSet(s: str) -> PatchSet:
         m = RE_DIFF_HEAD_WITH_QUOTED_FILENAMES.search(s)
 
     return PatchSet(s)
+
+
+@lru_cache(maxsize=16)
+def _compile_search(pattern, flags):
+    return re.compile(pattern, flags)
+
+
+def scan_files(root, filenames, pattern, flags=0):
+    """
+    Returns [(filename, [(line number, line), ...]), ...] of the files below
+    root with lines matching the regular expression. Used by the search,
+    also in the worker processes of a process pool, so the compiled
+    expression is cached per process.
+    """
+    regexp = _compile_search(pattern, flags)
+    result = []
+    for filename in filenames:
+        try:
+            with open(os.path.join(root, filename)) as f:
+                haystack = f.read()
+        except OSError:
+            continue
+        lines = [
+            (i, line)
+            for i, line in enumerate(haystack.splitlines())
+            if regexp.search(line)
+        ]
+        if lines:
+            result.append((filename, lines))
+    return result
@@ -0,0 +1,777 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+"""
+The vector store of the chunks of the pages.
+
+The embeddings are the rows of a matrix in a file of its own, which is
+mapped into memory and not read: opening the store costs the same for
+any number of chunks and all worker processes share the matrix via the
+page cache. The ids of the chunks and their rows are kept in a sqlite
+database, next to the text of the chunks.
+
+New chunks are appended to the matrix. The rows of deleted chunks are
+marked with a tombstone and skipped by the search, when there are too
+many of them the matrix is compacted into a new file.
+
+Large stores are searched approximately with an inverted file index
+(IVF): the rows are clustered with k-means, the compaction orders the
+matrix by cluster, and a search compares the queries only with the rows
+of the clusters with the closest centroids. Rows added later are
+assigned to their cluster when they are appended.
+"""
+
+import hashlib
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+
+from otterwiki.chunker import chunk
+from otterwiki.gitstorage import StorageNotFound
+from otterwiki.plugins import plugin_manager
+from otterwiki.server import app, storage
+from otterwiki.sidebar import SqliteStore
+from otterwiki.tokenizer import tokenize
+
+
+@lru_cache(maxsize=65536)
+def _hash(token):
+    digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def assign(vectors, centroids, block=65536):
+    """
+    Returns the index of the closest centroid of every vector.
+    """
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block):
+        part = np.asarray(vectors[start : start + block], dtype=np.float32)
+        lists[start : start + block] = np.argmax(part @ centroids.T, axis=1)
+    return lists
+
+
+def kmeans(vectors, n, iterations=10, seed=42):
+    """
+    Returns n normalized centroids of the normalized vectors, clustered by
+    their dot product.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n, replace=False)]
+    for _ in range(iterations):
+        lists = assign(vectors, centroids)
+        order = np.argsort(lists, kind="stable")
+        counts = np.bincount(lists, minlength=n)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        centroids = centroids.copy()
+        centroids[filled] = normalize(
+            np.add.reduceat(vectors[order], starts[filled])
+        )
+        # empty clusters start again at a random vector
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = vectors[rng.choice(len(vectors), len(empty))]
+    return centroids.astype(np.float32)
+
+
+def normalize(matrix):
+    """
+    Returns the rows of the matrix scaled to length 1.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class HashingEmbedder:
+    """
+    Embeds texts without a model: every token of the search index is
+    hashed to one of `dim` dimensions, where it adds +1 or -1. The counts
+    are damped with log(), so that a repeated word does not dominate.
+
+    An embedder has a `name`, the dimension `dim` and the method
+    embed(texts), which returns the float32 matrix of the normalized
+    embeddings. Plugins provide another embedder via the vector_embedder
+    hook.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token, n in Counter(tokenize(text)).items():
+                h = _hash(token)
+                sign = 1.0 if h >> 63 else -1.0
+                matrix[i, h % self.dim] += sign * (1 + math.log(n))
+        return normalize(matrix)
+
+
+class VectorStore(SqliteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS chunk (
+            id TEXT PRIMARY KEY, row INTEGER NOT NULL UNIQUE,
+            pagepath TEXT NOT NULL, anchor TEXT NOT NULL,
+            breadcrumb TEXT NOT NULL, text TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS chunk_pagepath ON chunk (pagepath);
+        CREATE TABLE IF NOT EXISTS tombstone (
+            row INTEGER PRIMARY KEY);
+    """
+    # the matrix is compacted when more than COMPACT_RATIO of the rows, and
+    # at least COMPACT_MIN rows, are deleted
+    COMPACT_RATIO = 0.25
+    COMPACT_MIN = 1024
+    # the number of rows multiplied with the queries at once
+    BLOCK = 65536
+    # stores with IVF_ROWS rows are clustered into about sqrt(rows) lists,
+    # again when they grew by IVF_RETRAIN. A search compares the queries
+    # with the rows of the NPROBE closest lists.
+    IVF_ROWS = 100000
+    IVF_RETRAIN = 4
+    IVF_SAMPLE = 32
+    NPROBE = 16
+
+    def __init__(self, path, embedder=None, dtype="float32"):
+        super().__init__(
+            os.path.join(path, "vectors.sqlite") if path else None
+        )
+        self.path = path
+        self.embedder = embedder or HashingEmbedder()
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported dtype {dtype!r}")
+        self.dtype = np.dtype(dtype)
+        # a store built with another embedder or dtype is cleared
+        self.signature = json.dumps(
+            [self.embedder.name, self.embedder.dim, self.dtype.name]
+        )
+        # ((generation, version), matrix, mask of the rows alive) as mapped
+        # last
+        self._mapped = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        The connection of the thread. The ChangeFeed writes in a thread of
+        its own, the readers see its transactions once they are committed.
+        """
+        if self.filename is None:
+            return None
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            conn = self._connect()
+            if conn is None:
+                return None
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def _matrix(self, generation):
+        return self._file(generation, self.dtype.name)
+
+    def _file(self, generation, suffix):
+        """
+        The files of a generation: the matrix, the list of every row and
+        the centroids and offsets of the lists.
+        """
+        return os.path.join(self.path, f"vectors-{generation}.{suffix}")
+
+    def _meta(self, conn):
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if meta.get("signature") != self.signature:
+            return None
+        return {
+            key: int(meta.get(key, 0))
+            for key in [
+                "generation",
+                "rows",
+                "version",
+                # the number of lists, the rows of the matrix sorted by list
+                # and the number of rows they have been trained with
+                "lists",
+                "sorted",
+                "trained",
+            ]
+        }
+
+    @contextmanager
+    def _writing(self):
+        """
+        Yields the connection and the meta data within a transaction, the
+        writes of all processes are serialized.
+        """
+        conn = self._connection()
+        if conn is None:
+            raise sqlite3.OperationalError("The vector store is unavailable")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            changes = conn.total_changes
+            meta = self._meta(conn)
+            if meta is None:
+                meta = self._reset(conn)
+            yield conn, meta
+            if conn.total_changes == changes:
+                # nothing has been written
+                conn.execute("COMMIT")
+                return
+            meta["version"] += 1
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, str(value)) for key, value in meta.items()]
+                + [("signature", self.signature)],
+            )
+            conn.execute("COMMIT")
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+    def _reset(self, conn):
+        conn.execute("DELETE FROM chunk")
+        conn.execute("DELETE FROM tombstone")
+        conn.execute("DELETE FROM meta WHERE key='head'")
+        (generation,) = conn.execute(
+            "SELECT COALESCE(MAX(value), 0) FROM meta WHERE key='generation'"
+        ).fetchone()
+        for filename in os.listdir(self.path):
+            if filename.startswith("vectors-"):
+                os.remove(os.path.join(self.path, filename))
+        generation = int(generation) + 1
+        open(self._matrix(generation), "wb").close()
+        open(self._file(generation, "lists"), "wb").close()
+        return dict(
+            generation=generation,
+            rows=0,
+            version=0,
+            lists=0,
+            sorted=0,
+            trained=0,
+        )
+
+    def _row_bytes(self):
+        return self.embedder.dim * self.dtype.itemsize
+
+    def _add(self, conn, meta, chunks):
+        known = set()
+        for chunk in chunks:
+            row = conn.execute(
+                "SELECT 1 FROM chunk WHERE id=?", (chunk["id"],)
+            ).fetchone()
+            if row is not None:
+                known.add(chunk["id"])
+        new = []
+        for chunk in chunks:
+            if chunk["id"] not in known:
+                known.add(chunk["id"])
+                new.append(chunk)
+        if not new:
+            return 0
+        vectors = self.embedder.embed([self.text(c) for c in new])
+        rows = meta["rows"]
+        if meta["lists"]:
+            centroids = np.load(
+                self._file(meta["generation"], "centroids.npy")
+            )
+            lists = assign(vectors, centroids)
+        else:
+            lists = np.full(len(vectors), -1, dtype=np.int32)
+        for filename, data in [
+            (self._matrix(meta["generation"]), vectors.astype(self.dtype)),
+            (self._file(meta["generation"], "lists"), lists),
+        ]:
+            with open(filename, "r+b") as f:
+                # rows written by an aborted transaction are overwritten
+                f.seek(rows * data[0].nbytes)
+                f.write(data.tobytes())
+                f.truncate()
+        conn.executemany(
+            "INSERT INTO chunk (id, row, pagepath, anchor, breadcrumb, text) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    chunk["id"],
+                    rows + i,
+                    chunk["pagepath"],
+                    chunk["anchor"],
+                    json.dumps(chunk["breadcrumb"]),
+                    chunk["text"],
+                )
+                for i, chunk in enumerate(new)
+            ],
+        )
+        meta["rows"] = rows + len(new)
+        return len(new)
+
+    def _delete(self, conn, ids):
+        for id in ids:
+            conn.execute(
+                "INSERT OR IGNORE INTO tombstone (row) "
+                "SELECT row FROM chunk WHERE id=?",
+                (id,),
+            )
+            conn.execute("DELETE FROM chunk WHERE id=?", (id,))
+
+    @staticmethod
+    def text(chunk):
+        """
+        The text of a chunk that is embedded, with its headings.
+        """
+        return "\n".join(chunk["breadcrumb"] + [chunk["text"]])
+
+    def add(self, chunks):
+        """
+        Adds the chunks which are not in the store yet, returns the number
+        of chunks added.
+        """
+        with self._writing() as (conn, meta):
+            added = self._add(conn, meta, chunks)
+        self.compact()
+        return added
+
+    def delete(self, ids):
+        with self._writing() as (conn, _):
+            self._delete(conn, ids)
+        self.compact()
+
+    def replace_page(self, pagepath, chunks):
+        """
+        Replaces the chunks of a page, only the chunks with new ids are
+        embedded.
+        """
+        ids = {chunk["id"] for chunk in chunks}
+        with self._writing() as (conn, meta):
+            self._delete(
+                conn,
+                [
+                    id
+                    for (id,) in conn.execute(
+                        "SELECT id FROM chunk WHERE pagepath=?", (pagepath,)
+                    )
+                    if id not in ids
+                ],
+            )
+            self._add(conn, meta, chunks)
+        self.compact()
+
+    def head(self):
+        """
+        The commit the chunks have been updated to by the ChangeFeed.
+        """
+        rows = self._execute("SELECT value FROM meta WHERE key='head'")
+        return rows[0][0] if rows else None
+
+    def set_head(self, head):
+        with self._writing() as (conn, _):
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('head', ?)",
+                (head,),
+            )
+
+    def pages(self):
+        return {
+            pagepath
+            for (pagepath,) in self._execute(
+                "SELECT DISTINCT pagepath FROM chunk"
+            )
+            or []
+        }
+
+    def compact(self, force=False):
+        """
+        Writes the rows of the chunks into a new matrix, without the
+        deleted rows and ordered by their list. When the store has grown
+        enough, the lists are trained first. The processes which still map
+        the old matrix see the new one with their next search.
+        """
+        obsolete = None
+        with self._writing() as (conn, meta):
+            (tombstones,) = conn.execute(
+                "SELECT COUNT(*) FROM tombstone"
+            ).fetchone()
+            alive = meta["rows"] - tombstones
+            train = alive >= self.IVF_ROWS and (
+                meta["lists"] == 0
+                or alive > meta["trained"] * self.IVF_RETRAIN
+            )
+            if (
+                not force
+                and not train
+                and (
+                    tombstones < self.COMPACT_MIN
+                    or tombstones <= meta["rows"] * self.COMPACT_RATIO
+                )
+            ):
+                return False
+            live = conn.execute(
+                "SELECT id, row FROM chunk ORDER BY row"
+            ).fetchall()
+            rows = np.array([row for _, row in live], dtype=np.int64)
+            old = self._map(meta["generation"], meta["rows"])
+            generation = meta["generation"] + 1
+            lists, centroids = None, None
+            if train:
+                n = int(math.sqrt(alive))
+                rng = np.random.default_rng(42)
+                sample = np.sort(
+                    rng.choice(
+                        rows, min(alive, n * self.IVF_SAMPLE), replace=False
+                    )
+                )
+                centroids = kmeans(np.asarray(old[sample], np.float32), n)
+                lists = np.concatenate(
+                    [
+                        assign(old[rows[i : i + self.BLOCK]], centroids)
+                        for i in range(0, len(rows), self.BLOCK)
+                    ]
+                )
+                meta.update(lists=n, trained=alive)
+            elif meta["lists"]:
+                centroids = np.load(
+                    self._file(meta["generation"], "centroids.npy")
+                )
+                lists = self._map_lists(meta["generation"], meta["rows"])
+                lists = np.asarray(lists[rows])
+            if lists is not None:
+                order = np.argsort(lists, kind="stable")
+                rows, lists = rows[order], lists[order]
+                live = [live[i] for i in order]
+                offsets = np.concatenate(
+                    [
+                        [0],
+                        np.cumsum(
+                            np.bincount(lists, minlength=len(centroids))
+                        ),
+                    ]
+                )
+                np.save(self._file(generation, "centroids.npy"), centroids)
+                np.save(self._file(generation, "offsets.npy"), offsets)
+            else:
+                lists = np.full(len(rows), -1, dtype=np.int32)
+            with open(self._matrix(generation), "wb") as f:
+                for start in range(0, len(rows), self.BLOCK):
+                    f.write(old[rows[start : start + self.BLOCK]].tobytes())
+            with open(self._file(generation, "lists"), "wb") as f:
+                f.write(lists.astype(np.int32).tobytes())
+            # the rows are unique, move them out of the way first
+            conn.executemany(
+                "UPDATE chunk SET row=? WHERE id=?",
+                [(-1 - i, id) for i, (id, _) in enumerate(live)],
+            )
+            conn.execute("UPDATE chunk SET row=-1-row")
+            conn.execute("DELETE FROM tombstone")
+            obsolete = f"vectors-{meta['generation']}."
+            meta.update(
+                generation=generation,
+                rows=len(live),
+                sorted=len(live) if meta["lists"] else 0,
+            )
+        if obsolete is not None:
+            for filename in os.listdir(self.path):
+                if filename.startswith(obsolete):
+                    os.remove(os.path.join(self.path, filename))
+        return True
+
+    def _map_lists(self, generation, rows):
+        if rows == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(
+            self._file(generation, "lists"),
+            dtype=np.int32,
+            mode="r",
+            shape=(rows,),
+        )
+
+    def _map(self, generation, rows):
+        if rows == 0:
+            return np.zeros((0, self.embedder.dim), dtype=self.dtype)
+        return np.memmap(
+            self._matrix(generation),
+            dtype=self.dtype,
+            mode="r",
+            shape=(rows, self.embedder.dim),
+        )
+
+    def _load(self):
+        """
+        Returns a dict with the matrix, the mask of the rows alive and the
+        lists, mapped again when the store has been changed.
+        """
+        conn = self._connection()
+        if conn is None:
+            return None
+        with self._lock:
+            # a compaction may remove the matrix before it is mapped
+            for _ in range(3):
+                try:
+                    meta = self._meta(conn)
+                    if meta is None:
+                        return None
+                    key = (meta["generation"], meta["version"])
+                    if self._mapped is not None and self._mapped[0] == key:
+                        return self._mapped[1]
+                    generation, rows = meta["generation"], meta["rows"]
+                    loaded = dict(
+                        matrix=self._map(generation, rows),
+                        alive=np.ones(rows, dtype=bool),
+                        centroids=None,
+                    )
+                    loaded["alive"][
+                        [
+                            row
+                            for (row,) in conn.execute(
+                                "SELECT row FROM tombstone"
+                            )
+                        ]
+                    ] = False
+                    if meta["lists"]:
+                        loaded.update(
+                            centroids=np.load(
+                                self._file(generation, "centroids.npy")
+                            ),
+                            offsets=np.load(
+                                self._file(generation, "offsets.npy")
+                            ),
+                            lists=self._map_lists(generation, rows),
+                            sorted=meta["sorted"],
+                        )
+                except (OSError, ValueError, sqlite3.Error):
+                    continue
+                self._mapped = (key, loaded)
+                return loaded
+        return None
+
+    def top(self, matrix, alive, queries, k, rows=None):
+        """
+        Returns the (scores, rows) of the k best rows of every query, the
+        dot products of a block of rows with all queries are computed at
+        once. Only the given rows are compared, if any.
+        """
+        if rows is None:
+            rows = np.arange(len(matrix))
+        scores = np.empty((len(queries), 0), dtype=np.float32)
+        best = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(rows), self.BLOCK):
+            part = rows[start : start + self.BLOCK]
+            if len(part) and part[-1] - part[0] == len(part) - 1:
+                # a slice of the matrix is read without copying
+                block = matrix[part[0] : part[-1] + 1]
+            else:
+                block = matrix[part]
+            s = queries @ np.asarray(block, dtype=np.float32).T
+            s[:, ~alive[part]] = -np.inf
+            scores = np.concatenate([scores, s], axis=1)
+            best = np.concatenate(
+                [best, np.broadcast_to(part, s.shape)], axis=1
+            )
+            if scores.shape[1] > k:
+                i = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, i, axis=1)
+                best = np.take_along_axis(best, i, axis=1)
+        order = np.argsort(-scores, axis=1)
+        return (
+            np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(best, order, axis=1),
+        )
+
+    def _probe(self, loaded, queries, nprobe):
+        """
+        Returns the rows of the nprobe lists closest to any of the queries.
+        """
+        centroids, offsets = loaded["centroids"], loaded["offsets"]
+        if nprobe < len(centroids):
+            probes = np.argpartition(
+                -(queries @ centroids.T), nprobe - 1, axis=1
+            )[:, :nprobe]
+        else:
+            probes = np.arange(len(centroids))
+        probes = np.unique(probes)
+        # the rows appended since the matrix has been sorted
+        tail = np.arange(loaded["sorted"], len(loaded["matrix"]))
+        tail = tail[np.isin(loaded["lists"][loaded["sorted"] :], probes)]
+        return np.concatenate(
+            [np.arange(offsets[p], offsets[p + 1]) for p in probes] + [tail]
+        )
+
+    def search_vectors(self, queries, k=10, nprobe=None, exact=False):
+        """
+        Returns for every row of queries the list of (score, chunk) of the
+        k most similar chunks, the best first. Large stores are searched
+        in the nprobe lists closest to the queries, unless exact is set.
+        """
+        loaded = self._load()
+        if loaded is None or len(loaded["matrix"]) == 0 or k < 1:
+            return [[] for _ in queries]
+        queries = np.asarray(queries, dtype=np.float32)
+        rows = None
+        if loaded["centroids"] is not None and not exact:
+            rows = self._probe(loaded, queries, nprobe or self.NPROBE)
+        scores, rows = self.top(
+            loaded["matrix"], loaded["alive"], queries, k, rows
+        )
+        chunks = self._chunks({int(row) for row in rows[np.isfinite(scores)]})
+        return [
+            [
+                (float(score), chunks[int(row)])
+                for score, row in zip(s, r)
+                if np.isfinite(score) and int(row) in chunks
+            ]
+            for s, r in zip(scores, rows)
+        ]
+
+    def search(self, texts, k=10):
+        """
+        Returns for every text the list of (score, chunk) of the k most
+        similar chunks, the best first.
+        """
+        return self.search_vectors(self.embedder.embed(texts), k)
+
+    def _select(self, column, values):
+        """
+        Yields (row, chunk) of the chunks with one of the values in column.
+        """
+        values = list(values)
+        for i in range(0, len(values), 500):
+            batch = values[i : i + 500]
+            for id, row, pagepath, anchor, breadcrumb, text in (
+                self._execute(
+                    "SELECT id, row, pagepath, anchor, breadcrumb, text "
+                    "FROM chunk WHERE {} IN ({})".format(
+                        column, ",".join("?" * len(batch))
+                    ),
+                    batch,
+                )
+                or []
+            ):
+                yield row, {
+                    "id": id,
+                    "pagepath": pagepath,
+                    "anchor": anchor,
+                    "breadcrumb": json.loads(breadcrumb),
+                    "text": text,
+                }
+
+    def _chunks(self, rows):
+        """
+        Returns a dict row -> chunk of the rows.
+        """
+        return dict(self._select("row", rows))
+
+    def page_chunks(self, pagepaths):
+        """
+        Returns a dict pagepath -> list of the chunks of the pages.
+        """
+        result = {}
+        for _, chunk in sorted(
+            self._select("pagepath", pagepaths), key=lambda x: x[0]
+        ):
+            result.setdefault(chunk["pagepath"], []).append(chunk)
+        return result
+
+
+class ChangeFeed:
+    """
+    Keeps the chunks in the vector store in step with the commits. The
+    storage calls notify() with the new HEAD after every commit and every
+    push received, a thread of the process then diffs HEAD against the
+    commit the store has been updated to, and chunks again only the pages
+    changed in between. Chunks that did not change keep their id and their
+    embedding.
+    """
+
+    def __init__(self, storage, store):
+        self.storage = storage
+        self.store = store
+        self.reads = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def notify(self, head):
+        """
+        Enqueue the update to head, the thread is started on demand and
+        never shared with forked children.
+        """
+        with self._start_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+        self._queue.put(head)
+
+    def _run(self):
+        while True:
+            self._queue.get()
+            # the next update catches up with all commits queued meanwhile
+            while not self._queue.empty():
+                self._queue.get()
+            try:
+                self.update()
+            except Exception as e:
+                app.logger.error(f"ChangeFeed update failed: {e}")
+
+    def _changed_pages(self, indexed, head):
+        """
+        Returns the markdown files changed between indexed and head or
+        None, if all pages have to be chunked again.
+        """
+        if indexed is None:
+            return None
+        try:
+            changed = self.storage.changed_files(indexed, head)
+        except StorageNotFound:
+            return None
+        return [f for f in changed if f.endswith(".md")]
+
+    def update(self):
+        """
+        Bring the chunks up to date with HEAD, returns the number of pages
+        chunked again.
+        """
+        head = self.storage.stamp()[0]
+        with self._lock:
+            indexed = self.store.head()
+            if head is None or head == indexed:
+                return 0
+            filenames = self._changed_pages(indexed, head)
+            if filenames is None:
+                files, _ = self.storage.list()
+                filenames = [f for f in files if f.endswith(".md")]
+                # pages which are gone
+                for pagepath in self.store.pages() - {
+                    f[:-3] for f in filenames
+                }:
+                    self.store.replace_page(pagepath, [])
+            for filename in filenames:
+                pagepath = filename[:-3]
+                try:
+                    content = self.storage.load(filename, revision=head)
+                    self.reads += 1
+                except StorageNotFound:
+                    self.store.replace_page(pagepath, [])
+                    continue
+                self.store.replace_page(pagepath, chunk(pagepath, content))
+            self.store.set_head(head)
+        return len(filenames)
+
+
+_path = os.path.join(storage.path, ".git", "otterwiki", "vectors")
+_embedder = plugin_manager.hook.vector_embedder()
+try:
+    vector_store = VectorStore(
+        _path, _embedder, dtype=app.config["VECTOR_DTYPE"]
+    )
+except ValueError:
+    vector_store = VectorStore(_path, _embedder)
+change_feed = ChangeFeed(storage, vector_store)
+storage.subscribe(change_feed.notify)
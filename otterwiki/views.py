@@ -27,7 +27,9 @@ from otterwiki.wiki import (
     PageIndex,
     Changelog,
     Search,
+    Retrieval,
     AutoRoute,
+    page_names,
 )
 import otterwiki.auth
 import otterwiki.preferences
@@ -236,7 +238,11 @@ def user(uid=None):
 @app.route("/-/changelog")
 @app.route("/-/changelog/<string:revision>")
 def changelog(revision=None):
-    chlg = Changelog(revision)
+    chlg = Changelog(
+        revision,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
     return chlg.render()
 
 
@@ -246,6 +252,22 @@ def pageindex():
     return idx.render()
 
 
+@app.route("/-/api/pages")
+def api_pages():
+    return page_names.autocomplete(
+        request.args.get("prefix"), request.args.get("limit", 10)
+    )
+
+
+@app.route("/-/api/retrieve", methods=["POST", "GET"])
+def api_retrieve():
+    r = Retrieval(
+        query=request.values.get("query"),
+        k=request.values.get("k", Retrieval.K, type=int),
+    )
+    return r.render()
+
+
 @app.route("/-/create", methods=["POST", "GET"])
 def create():
     pagename = request.form.get("pagename")
@@ -686,13 +708,16 @@ def inline_attachment(pagepath):
 @app.route("/-/search", methods=["POST", "GET"])
 @app.route("/-/search/<string:query>", methods=["POST", "GET"])
 def search(query=None):
+    # the form is posted, the pages of the results are linked via GET
     if query is None:
-        query = request.form.get("query")
+        query = request.values.get("query")
     s = Search(
         query=query,
-        is_casesensitive=request.form.get("is_casesensitive") == "y",
-        is_regexp=request.form.get("is_regexp") == "y",
-        in_history=request.form.get("in_history") == "y",
+        is_casesensitive=request.values.get("is_casesensitive") == "y",
+        is_regexp=request.values.get("is_regexp") == "y",
+        in_history=request.values.get("in_history") == "y",
+        page=request.args.get("page", 1, type=int),
+        stream=request.args.get("stream") == "1",
     )
     return s.render()
 
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # vim: set et ts=8 sts=4 sw=4 ai:
 
+import math
 import os
 import re
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import UTC, datetime, timedelta
 from io import BytesIO
 from timeit import default_timer as timer
@@ -17,6 +22,7 @@ from flask import (
     redirect,
     render_template,
     send_file,
+    stream_template,
     url_for,
 )
 from markupsafe import escape as html_escape
@@ -30,7 +36,7 @@ from otterwiki.helper import (
     get_attachment_directoryname,
     get_breadcrumbs,
     get_filename,
-    get_ftoc,
+    get_ftocs,
     get_pagename,
     get_pagename_prefixes,
     patchset2urlmap,
@@ -41,8 +47,20 @@ from otterwiki.helper import (
 from otterwiki.models import Drafts
 from otterwiki.plugins import chain_hooks
 from otterwiki.renderer import pygments_render
-from otterwiki.server import app, app_renderer, db, storage
-from otterwiki.sidebar import SidebarMenu, SidebarPageIndex
+from otterwiki.searchindex import (
+    pickaxe_cache,
+    regex_trigrams,
+    scan_pool,
+    search_index,
+)
+from otterwiki.server import (
+    app,
+    app_render_cache,
+    app_renderer,
+    db,
+    storage,
+)
+from otterwiki.sidebar import SidebarMenu, SidebarPageIndex, page_headers
 from otterwiki.util import (
     empty,
     get_header,
@@ -51,11 +69,13 @@ from otterwiki.util import (
     guess_mimetype,
     join_path,
     patchset2filedict,
+    scan_files,
     sanitize_pagename,
     sizeof_fmt,
     split_path,
     get_PatchSet,
 )
+from otterwiki.vectorstore import change_feed, vector_store
 
 if not hasattr(PIL.Image, 'Resampling'):  # Pillow<9.0
     PIL.Image.Resampling = PIL.Image
@@ -67,7 +87,6 @@ class PageIndex:
         This will generate an index of pages/toc of pages from a given path.
         '''
         self.toc = {}
-        page_indices = []
 
         if path is not None:
             self.path = (
@@ -95,6 +114,29 @@ class PageIndex:
         t_start = timer()
         # filter .md files
         md_files = [f for f in files if f.endswith(".md")]
+        # build a trie of the pages, every node is a dict of the child
+        # nodes, the key None marks that the node is a page
+        trie = {}
+        for fn in md_files:
+            node = trie
+            for part in split_path(fn[:-3]):
+                node = node.setdefault(part, {})
+            node[None] = True
+
+        def find_node(pagepath):
+            node = trie
+            for part in split_path(pagepath):
+                node = node.get(part)
+                if node is None:
+                    return {}
+            return node
+
+        if self.path is None:
+            ftocs = get_ftocs(md_files)
+        else:
+            ftocs = get_ftocs([os.path.join(self.path, fn) for fn in md_files])
+
+        page_indices = set()
         for fn in md_files:
             if self.path is None:
                 f = fn
@@ -112,11 +154,7 @@ class PageIndex:
                     subdir_path_full = subdir_path
                 else:
                     subdir_path_full = join_path([self.path, subdir_path])
-                if storage.exists(
-                    get_filename(
-                        subdir_path,
-                    )
-                ):
+                if None in find_node(get_filename(subdir_path)[:-3]):
                     # if page exists don't add the directory
                     continue
                 if subdir_path not in page_indices:
@@ -139,14 +177,14 @@ class PageIndex:
                             True,
                         )
                     )
-                    page_indices.append(subdir_path)
+                    page_indices.add(subdir_path)
             pagetoc = []
             # default pagename is the pagename derived from the filename
             pagename = get_pagename(
                 f,
                 full=False,
             )
-            ftoc = get_ftoc(f)
+            ftoc = ftocs[f]
 
             # add headers to page toc
             # (4, '2 L <strong>bold</strong>', 1, '2 L bold', '2-l-bold')
@@ -180,11 +218,8 @@ class PageIndex:
                 self.path.lower()
             ):
                 displayname = displayname[len(self.path) + 1 :]
-            has_children = False
-            for other in md_files:
-                if other.startswith(f[:-3] + "/"):
-                    has_children = True
-                    break
+            # any key besides None is a page below this page
+            has_children = any(key is not None for key in find_node(fn[:-3]))
             self.toc[firstletter].append(
                 (
                     page_depth - self.index_depth,
@@ -229,16 +264,109 @@ class PageIndex:
                 yield pagename, pagepath, url
 
 
+class PageNameIndex:
+    """
+    The names of all pages, sorted case-insensitively by the full page
+    path and by the name of the page itself, for the page name
+    autocompletion of the editor.
+
+    The index is rebuilt when the storage stamp changes, the names of pages
+    that did not change are reused.
+    """
+
+    def __init__(self):
+        self._stamp = None
+        self._retain_case = None
+        # filename -> (header, pagepath)
+        self._names = {}
+        # sorted lists of (lowercase key, pagepath)
+        self._paths = []
+        self._basenames = []
+        self._lock = threading.Lock()
+
+    def _update(self):
+        stamp = storage.stamp()
+        retain_case = app.config["RETAIN_PAGE_NAME_CASE"]
+        if stamp == self._stamp and retain_case == self._retain_case:
+            return
+        files, _ = storage.list()
+        md_files = [f for f in files if f.endswith(".md")]
+        # the first header is used as hint for upper/lower casing
+        headers = page_headers.get(md_files)
+        names = {}
+        for fn in md_files:
+            entry = self._names.get(fn)
+            if (
+                entry is None
+                or entry[0] != headers[fn]
+                or retain_case != self._retain_case
+            ):
+                entry = (
+                    headers[fn],
+                    get_pagename(fn, full=True, header=headers[fn]),
+                )
+            names[fn] = entry
+        self._names = names
+        self._paths = sorted(
+            (pagepath.lower(), pagepath) for _, pagepath in names.values()
+        )
+        self._basenames = sorted(
+            (split_path(pagepath)[-1].lower(), pagepath)
+            for _, pagepath in names.values()
+        )
+        self._stamp, self._retain_case = stamp, retain_case
+
+    def query(self, prefix, limit=10):
+        """
+        Returns up to limit page paths starting with the prefix, matches of
+        the full page path first, then matches of the page name.
+        """
+        prefix = prefix.lower().lstrip("/")
+        with self._lock:
+            self._update()
+            paths, basenames = self._paths, self._basenames
+        result = []
+        for index in [paths, basenames]:
+            i = bisect_left(index, (prefix,))
+            while (
+                len(result) < limit
+                and i < len(index)
+                and index[i][0].startswith(prefix)
+            ):
+                if index[i][1] not in result:
+                    result.append(index[i][1])
+                i += 1
+        return result
+
+    def autocomplete(self, prefix, limit=10):
+        if not has_permission("READ"):
+            abort(403)
+        try:
+            limit = min(max(int(limit), 1), 100)
+        except ValueError:
+            limit = 10
+        return jsonify(pages=self.query(prefix or "", limit))
+
+
+page_names = PageNameIndex()
+
+
 class Changelog:
-    def __init__(self, commit_start=None):
+    def __init__(self, commit_start=None, after=None, before=None):
+        # the changelog page starts with commit_start, with the commit
+        # after the given revision or ends with the commit before the given
+        # revision
         self.commit_start = commit_start
+        self.after = after
+        self.before = before
         self.commit_count = 100
-        pass
 
-    def get(self):
+    def get(self, revision=None, max_count=None):
         log = []
-        # filter log
-        for orig_entry in storage.log():
+        # stream the log and stop after max_count entries
+        for orig_entry in storage.iter_log(
+            revision=revision, max_count=max_count
+        ):
             entry = dict(orig_entry)
             entry["files"] = {}
             for filename in cast(List[str], orig_entry["files"]):
@@ -256,95 +384,39 @@ class Changelog:
     def render(self):
         if not has_permission("READ"):
             abort(403)
-        log = self.get()
-        pages = []
+        revision = self.commit_start
+        skip = 0
+        try:
+            if self.after is not None:
+                revision, skip = self.after, 1
+            elif self.before is not None:
+                newer = storage.newer_revisions(self.before)
+                # if there are not enough newer commits, show the first page
+                if len(newer) > self.commit_count:
+                    revision = newer[len(newer) - self.commit_count]
+            # fetch one entry more than displayed to find the next page
+            log = self.get(
+                revision=revision, max_count=skip + self.commit_count + 1
+            )
+        except StorageNotFound:
+            if revision is not None or self.before is not None:
+                abort(404)
+            # the repository is empty
+            log = []
+        log = log[skip:]
         next_page = None
+        if len(log) > self.commit_count:
+            log = log[: self.commit_count]
+            next_page = log[-1]["revision-full"]
         previous_page = None
-        active_page = -1
-        # pagination
-        if self.commit_start is None:
-            self.commit_start = log[0]["revision"]
-
-        log_page = []
-        started = False
-        start_n = 0
-        for n, entry in enumerate(log):
-            if entry["revision"] == self.commit_start:
-                started = True
-                start_n = n
-            elif not started:
-                continue
-            log_page.append(entry)
-            if len(log_page) > self.commit_count:
-                break
-        # find paging revisions
-        commit_i = 0
-        page_i = 1
-        while commit_i < len(log):
-            if (commit_i >= start_n) and (
-                commit_i < start_n + self.commit_count
-            ):
-                active_page = page_i
-                try:
-                    previous_page = pages[-1]["revision"]
-                except IndexError:
-                    pass
-            pages.append(
-                {
-                    "i": page_i,
-                    "revision": log[commit_i]["revision"],
-                    "active": active_page == page_i,
-                    "dummy": False,
-                }
-            )
-            try:
-                if pages[-2]["active"]:
-                    next_page = pages[-1]["revision"]
-            except IndexError:
-                pass
-            commit_i += self.commit_count
-            page_i += 1
-        log = log_page
-        # store first and last page
-        first_page = pages[0]["revision"]
-        last_page = pages[-1]["revision"]
-        # thin out pages
-        page_span = 4
-        max_pages = 8
-        if len(pages) > max_pages:
-            # calculate how many pages would be displayed left and right of the active page
-            l_len = active_page - max(1, active_page - page_span)
-            r_len = min(active_page + page_span, len(pages)) - active_page
-            # to have a fixed length of displayed pages add the missing
-            # lengths to the respectively other side
-            if l_len < page_span:
-                r_len += page_span - l_len
-            if r_len < page_span:
-                l_len += page_span - r_len
-            # calculate array positions
-            l_pos = active_page - l_len - 1
-            r_pos = active_page + r_len
-            # left of active page
-            pages_short = pages[l_pos:active_page]
-            if l_pos > 0:
-                # insert dummy (and remove page to not break the layout)
-                pages_short = [{"dummy": True}] + pages_short[1:]
-            # right of active page
-            pages_short += pages[active_page:r_pos]
-            if r_pos < len(pages):
-                # insert dummy (and remove page to not break the layout)
-                pages_short = pages_short[:-1] + [{"dummy": True}]
-            # use the shorter page list
-            pages = pages_short
+        if revision is not None and len(log) > 0:
+            previous_page = log[0]["revision-full"]
 
         menutree = SidebarPageIndex(get_page_directoryname("/"))
         return render_template(
             "changelog.html",
             log=log,
             title="Changelog",
-            pages=pages,
-            first_page=first_page,
-            last_page=last_page,
             previous_page=previous_page,
             next_page=next_page,
             menutree=menutree.query(),
@@ -553,8 +625,8 @@ class Page:
                 f"""This page was loaded from the repository but is not added under git version control. Make a commit on the <a href="/{self.pagepath}/edit" class="alert-link">Edit page</a> to add it.""",
             ]
 
-        # render markdown
-        htmlcontent, toc = app_renderer.markdown(
+        # render markdown, unchanged pages are served from the cache
+        htmlcontent, toc = app_render_cache.markdown(
             self.content, page_url=self.page_url
         )
         update_ftoc_cache(self.filename, ftoc=toc)
@@ -679,8 +751,6 @@ class Page:
 
         # get file listing
         files = [f.data for f in self._attachments() if f.metadata is not None]
-        # get page listing
-        page_idx = PageIndex()
 
         return render_template(
             "editor.html",
@@ -688,7 +758,6 @@ class Page:
             pagepath=self.pagepath,
             content_editor=content,
             files=files,
-            pages=list(page_idx.pages()),
             cursor_line=cursor_line,
             cursor_ch=cursor_ch,
             revision=(
@@ -1397,14 +1466,47 @@ class Attachment:
 
 
 class Search:
+    # the number of searches in the history running at the same time in a
+    # worker, further searches wait up to HISTORY_TIMEOUT seconds
+    HISTORY_WORKERS = threading.BoundedSemaphore(2)
+    HISTORY_TIMEOUT = 10
+    # files are scanned in batches, in the scan_pool when there are at
+    # least SCAN_PARALLEL files to scan
+    SCAN_BATCH = 256
+    SCAN_PARALLEL = 2048
+    # the number of pages per page of results, when rendered the scan stops
+    # after SCAN_LIMIT pages with matches and the total is estimated
+    PAGE_SIZE = 20
+    SCAN_LIMIT = 500
+
     def __init__(
-        self, query, is_casesensitive=False, is_regexp=False, in_history=False
+        self,
+        query,
+        is_casesensitive=False,
+        is_regexp=False,
+        in_history=False,
+        limit=None,
+        page=1,
+        stream=False,
     ):
         self.query = query
         self.in_history = in_history
         self.is_regexp = is_regexp
         self.is_casesensitive = is_casesensitive
+        # stop scanning files when limit pages with matches have been found
+        self.limit = limit
+        # False if the scan has been stopped early
+        self.complete = True
+        # the number of pages found, estimated if the scan stopped early
+        self.total = 0
+        self.page = page
+        # render the results while they are found, unpaginated
+        self.is_stream = stream
         self.re = None
+        self.trigrams = None
+        # the scores of the pages found with the search index
+        self.words = None
+        self._scores = False
 
     def compile(self):
         if empty(self.query):
@@ -1423,126 +1525,282 @@ class Search:
         except Exception as e:
             toast("Error in search term: {}".format(e), "error")
             return
-
-    def search(self):
-        if self.re is None:
-            return {}
-        # find all markdown files
+        # the trigrams a matching line must contain
+        self.trigrams = regex_trigrams(self.re.pattern, self.re.flags)
+
+    def _lines(self, lines):
+        """
+        Returns the matching lines of a page from its (line number, line),
+        with "[..]" between lines that are not consecutive.
+        """
+        matches = []
+        previous = None
+        for i, line in lines:
+            if i == 0 or (previous is not None and i == previous + 1):
+                matches += [line]
+            else:
+                matches += ["[..]", line]
+            previous = i
+        return matches
+
+    def _scan(self, filenames):
+        """
+        Yields (filename, matching lines) of the files, in the order of
+        filenames. The files are read in batches, which run in the
+        scan_pool when there are enough files.
+        """
+        args = (self.re.pattern, self.re.flags)
+        batches = [
+            filenames[i : i + self.SCAN_BATCH]
+            for i in range(0, len(filenames), self.SCAN_BATCH)
+        ]
+        pool = None
+        if len(filenames) >= self.SCAN_PARALLEL:
+            pool = scan_pool.get()
+        if pool is None:
+            for batch in batches:
+                yield from scan_files(storage.path, batch, *args)
+            return
+        futures = [
+            pool.submit(scan_files, storage.path, batch, *args)
+            for batch in batches
+        ]
+        try:
+            for batch, future in zip(batches, futures):
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    scan_pool.broken()
+                    result = scan_files(storage.path, batch, *args)
+                yield from result
+        finally:
+            # stopped early
+            for future in futures:
+                future.cancel()
+
+    def _names(self):
+        """
+        Returns the markdown files and a dict filename -> page name of the
+        pages with a matching name.
+        """
         t_start = timer()
         files, _ = storage.list()
         md_files = [filename for filename in files if filename.endswith(".md")]
         app.logger.debug(
             f"Search storage.list() and filter took {timer() - t_start:.3f} seconds."
         )
-        fn_result = {}
-
-        t_start = timer()
+        names = {}
         for fn in md_files:
-            # check if pagename matches
+            # check if pagename matches, the pagename differs from the
+            # filename only in case, so check the filename first
+            if self.rei.search(os.path.basename(fn)[:-3]) is None:
+                continue
             mi = self.rei.search(get_pagename(fn))
             if mi is not None:
-                fn_result[fn] = [
-                    True,
-                    get_pagename(
-                        fn,
-                        full=True,
-                    ),
-                ]
-            # open file, read file
-            haystack = storage.load(fn)
-            lastlinematched = False
-            for i, line in enumerate(haystack.splitlines()):
-                m = self.re.search(line)
-                if m:
-                    if fn not in fn_result:
-                        fn_result[fn] = [False]
-                    if lastlinematched or i == 0:
-                        fn_result[fn] += [line]
-                    else:
-                        fn_result[fn] += ["[..]", line]
-                    lastlinematched = True
-                else:
-                    lastlinematched = False
+                names[fn] = get_pagename(fn, full=True)
+        return md_files, names
+
+    def _index(self):
+        """
+        Returns a dict filename -> BM25 score of the pages found with the
+        search index or None, if the index can not rank the search. The
+        scores only order the pages, which pages match is decided by the
+        scan.
+        """
+        if self.is_regexp or self.is_casesensitive:
+            return None
+        if self._scores is not False:
+            return self._scores
+        t_start = timer()
+        self.words = search_index.words(self.query)
+        self._scores = search_index.rank(self.words)
         app.logger.debug(
-            f"Search storage.load() and re.search('{self.needle}') took {timer() - t_start:.3f} seconds."
+            f"Search search_index.rank({self.words}) took {timer() - t_start:.3f} seconds."
         )
-        if self.in_history:
-            # TODO
-            # use git log -S
-            # see https://git-scm.com/docs/git-log#Documentation/git-log.txt--Sltstringgt
-            # search through commits to find the one that added the string
-            pass
+        return self._scores
+
+    def ranked(self):
+        """
+        Returns the filenames of the pages found with the search index, the
+        best first, or None if the index can not rank the search. Only the
+        scores are computed, the pages are not read and not checked for the
+        query as a whole.
+        """
+        if self.re is None:
+            return None
+        scores = self._index()
+        if scores is None:
+            return None
+        return sorted(scores, key=lambda fn: (-scores[fn], fn))
+
+    def _matches(self):
+        """
+        Yields (filename, matches, score) of the pages while they are found.
+        matches starts with True and the page name when the name matches,
+        False otherwise, followed by the matching lines.
+        """
+        if self.re is None:
+            return
+        md_files, names = self._names()
+
+        def matches(fn, lines):
+            if fn in names:
+                return [True, names.pop(fn)] + self._lines(lines)
+            return [False] + self._lines(lines)
 
         t_start = timer()
-        result = {}
-        # simplify result
-        for fn, matches in fn_result.items():
-            fnmatch = 1 if matches.pop(0) else 0
-            # count matches
-            n = 0
-            for i, line in enumerate(matches):
-                # filenames are not casesensitive ...
-                if i == 0 and fnmatch == 1:
-                    n += len(self.rei.findall(line))
-                else:
-                    n += len(self.re.findall(line))
-            key = [
-                fnmatch,
-                n,
-                fn,
-                get_pagename(fn, full=True),
-                get_pagename(fn, full=True),
-            ]
-            summary = []
-            if fnmatch == 1:
-                summary = [matches.pop(0)]
-                # overwrite key[4]
-                key[4] = self.rei.sub(
-                    r'<span class="page-match">\1</span>', cast(str, key[4])
-                )
-            front, end = [], []
-            while len("".join(front) + "".join(end)) < 200:
-                try:
-                    front.insert(0, matches.pop(0))
-                    end.insert(0, matches.pop(-1))
-                except IndexError:
-                    break
-            match_summary = " ".join(front)
-            if len(matches) > 0:
-                match_summary += "[..]"
-            match_summary += " ".join(end)
-            # TODO: check if the number of words have to be limited, too
-            match_summary = match_summary.replace("[..][..]", "[..]")
-            summary.append(match_summary)
-            # colorize summary
-            for i, l in enumerate(summary):
-                # are you kidding me? html_escape(l) is evaluated later so that the span below
-                # would be escaped too.
-                l = str(html_escape(l))
-                # filenames are not casesensitive ...
-                if i == 0 and fnmatch == 1:
-                    summary[i] = None
-                else:
-                    summary[i] = self.re.sub(
-                        r'<span class="text-match">\1</span>', l
-                    )
-            # store summary with key
-            result[tuple(key)] = summary
+        # only the pages with the trigrams of the search can match
+        candidates = search_index.candidates(self.trigrams)
+        to_scan = [
+            fn for fn in md_files if candidates is None or fn in candidates
+        ]
+        # the pages ranked by the search index are scanned first, the best
+        # first, the scan decides which pages match
+        scores = self._index() or {}
+        to_scan.sort(key=lambda fn: -scores.get(fn, 0))
+        position = {fn: i for i, fn in enumerate(to_scan)}
+        found = 0
+        for fn, lines in self._scan(to_scan):
+            yield fn, matches(fn, lines), scores.get(fn, 0)
+            found += 1
+            if self.limit is not None and found >= self.limit:
+                self.complete = False
+                # extrapolate from the share of the files scanned
+                self.total = round(found * len(to_scan) / (position[fn] + 1))
+                break
+        else:
+            self.total = found
         app.logger.debug(
-            f"Search simplify result took {timer() - t_start:.3f} seconds."
+            f"Search scan_files() and re.search('{self.needle}') took {timer() - t_start:.3f} seconds."
         )
+        # the pages where only the name matches
+        self.total += len(names)
+        for fn, pagename in names.items():
+            yield fn, [True, pagename], 0
+
+    def _key(self, fn, matches, score):
+        """
+        Returns the key of a page in the result: (1 if the name matches,
+        the number of matches, filename, page name, highlighted page name,
+        BM25 score).
+        """
+        fnmatch = 1 if matches[0] else 0
+        # count matches
+        n = 0
+        for i, line in enumerate(matches[1:]):
+            # filenames are not casesensitive ...
+            if i == 0 and fnmatch == 1:
+                n += len(self.rei.findall(line))
+            else:
+                n += len(self.re.findall(line))
+        pagename = get_pagename(fn, full=True)
+        if fnmatch == 1:
+            highlighted = self.rei.sub(
+                r'<span class="page-match">\1</span>', pagename
+            )
+        else:
+            highlighted = pagename
+        return (fnmatch, n, fn, pagename, highlighted, score)
+
+    def _summary(self, key, matches):
+        """
+        Returns the highlighted summary of the matching lines of a page.
+        """
+        fnmatch = key[0]
+        matches = matches[1:]
+        summary = []
+        if fnmatch == 1:
+            summary = [matches.pop(0)]
+        front, end = [], []
+        while len("".join(front) + "".join(end)) < 200:
+            try:
+                front.insert(0, matches.pop(0))
+                end.insert(0, matches.pop(-1))
+            except IndexError:
+                break
+        match_summary = " ".join(front)
+        if len(matches) > 0:
+            match_summary += "[..]"
+        match_summary += " ".join(end)
+        # TODO: check if the number of words have to be limited, too
+        match_summary = match_summary.replace("[..][..]", "[..]")
+        summary.append(match_summary)
+        # colorize summary
+        for i, l in enumerate(summary):
+            # are you kidding me? html_escape(l) is evaluated later so that the span below
+            # would be escaped too.
+            l = str(html_escape(l))
+            # filenames are not casesensitive ...
+            if i == 0 and fnmatch == 1:
+                summary[i] = None
+            else:
+                summary[i] = self.re.sub(
+                    r'<span class="text-match">\1</span>', l
+                )
+        return summary
 
-        return result
+    def stream(self):
+        """
+        Yields (key, summary) of the pages while they are found.
+        """
+        for fn, matches, score in self._matches():
+            key = self._key(fn, matches, score)
+            yield key, self._summary(key, matches)
+
+    def search(self):
+        return dict(self.stream())
+
+    def history(self):
+        """
+        Yields the commits that added or removed the query, newest first,
+        while git log finds them. The commits are cached with HEAD, when
+        HEAD moved forward only the new commits are searched.
+        """
+        head = storage.stamp()[0]
+        if head is None:
+            return
+        key = pickaxe_cache.key(
+            self.query, self.is_regexp, self.is_casesensitive
+        )
+        since, cached = pickaxe_cache.get(key) or (None, [])
+        if since == head:
+            yield from cached
+            return
+        try:
+            if since is not None and not storage.is_ancestor(since, head):
+                since, cached = None, []
+        except StorageNotFound:
+            since, cached = None, []
+        if not self.HISTORY_WORKERS.acquire(timeout=self.HISTORY_TIMEOUT):
+            yield {
+                "error": "Too many searches in the history, "
+                "please try again later."
+            }
+            return
+        found = []
+        try:
+            for entry in storage.pickaxe(
+                self.query,
+                revision=head,
+                since=since,
+                is_regexp=self.is_regexp,
+                is_casesensitive=self.is_casesensitive,
+            ):
+                found.append(entry)
+                yield entry
+        except StorageNotFound as e:
+            yield {"error": "Error in search term: {}".format(e)}
+            return
+        finally:
+            self.HISTORY_WORKERS.release()
+        pickaxe_cache.set(key, head, found + cached)
+        yield from cached
 
     def render(self):
         if not has_permission("READ"):
             abort(403)
         self.compile()
-        result = self.search()
-        # sort keys
-        keys = sorted(result.keys(), key=lambda x: (-x[0], -x[1], x[2]))
-        return render_template(
-            "search.html",
+        context = dict(
             title=(
                 "Search '{}'".format(self.query)
                 if not empty(self.query)
@@ -1551,9 +1809,170 @@ class Search:
             query=self.query,
             is_regexp=self.is_regexp,
             is_casesensitive=self.is_casesensitive,
-            keys=keys,
-            result=result,
+            in_history=self.in_history,
         )
+        if self.re is not None and (self.is_stream or self.in_history):
+            # stream the page, the results and commits are rendered while
+            # they are found
+            if self.is_stream:
+                context["stream"] = self.stream()
+            else:
+                context.update(self._paginate())
+            if self.in_history:
+                context["history"] = self.history()
+            return stream_template("search.html", **context)
+        context.update(self._paginate())
+        return render_template("search.html", **context)
+
+    def _paginate(self):
+        """
+        Returns the keys and the summaries of the current page of results,
+        only the summaries of the current page are rendered.
+        """
+        if self.limit is None:
+            # the scan goes on until the current page is filled
+            self.limit = max(self.SCAN_LIMIT, self.page * self.PAGE_SIZE)
+        found = [
+            (self._key(fn, matches, score), matches)
+            for fn, matches, score in self._matches()
+        ]
+        # sort keys
+        found.sort(key=lambda x: (-x[0][0], -x[0][5], -x[0][1], x[0][2]))
+        pages = max(1, math.ceil(self.total / self.PAGE_SIZE))
+        page = min(max(self.page, 1), pages)
+        found = found[(page - 1) * self.PAGE_SIZE : page * self.PAGE_SIZE]
+        return dict(
+            keys=[key for key, _ in found],
+            result={
+                key: self._summary(key, matches) for key, matches in found
+            },
+            total=self.total,
+            is_estimate=not self.complete,
+            page=page,
+            pages=pages,
+        )
+
+
+class Retrieval:
+    """
+    Finds the chunks of the pages that answer a query. The pages ranked by
+    the Search with BM25 give the chunks with the most matches of their
+    words, the vector store the chunks with the most similar embeddings.
+    Both rankings are fused with reciprocal rank fusion, every chunk scores
+    the sum of 1 / (RRF_K + rank) of its ranks.
+    """
+
+    K = 10
+    MAX_K = 50
+    # the number of pages and chunks taken from each ranking
+    CANDIDATES = 50
+    RRF_K = 60
+    # the vector search runs in a thread while the pages are ranked, the
+    # pool is started when it is needed first and never shared with forked
+    # children
+    _pool = None
+    _pid = None
+    _lock = threading.Lock()
+
+    def __init__(self, query, k=K):
+        self.query = query
+        self.k = min(max(k, 1), self.MAX_K)
+
+    @classmethod
+    def _executor(cls):
+        with cls._lock:
+            if cls._pool is None or cls._pid != os.getpid():
+                cls._pool = ThreadPoolExecutor(max_workers=2)
+                cls._pid = os.getpid()
+            return cls._pool
+
+    def _lexical(self):
+        """
+        Returns the chunks of the pages ranked by the Search with the search
+        index, the pages by their score and the chunks of a page by the
+        number of matches.
+        """
+        search = Search(self.query)
+        search.compile()
+        ranked = search.ranked()
+        if ranked is None:
+            return []
+        pagepaths = [fn[:-3] for fn in ranked[: self.CANDIDATES]]
+        chunks = vector_store.page_chunks(pagepaths)
+        result = []
+        for pagepath in pagepaths:
+            found = [
+                (n, chunk)
+                for n, chunk in (
+                    (len(search.re.findall(vector_store.text(c))), c)
+                    for c in chunks.get(pagepath, [])
+                )
+                if n > 0
+            ]
+            found.sort(key=lambda x: -x[0])
+            result += [chunk for _, chunk in found]
+        return result[: self.CANDIDATES]
+
+    def _vector(self):
+        return [
+            chunk
+            for _, chunk in vector_store.search(
+                [self.query], k=self.CANDIDATES
+            )[0]
+        ]
+
+    def results(self):
+        """
+        Returns the list of the k best chunks, with their score and the
+        revision of their page.
+        """
+        if empty(self.query):
+            return []
+        # the chunks are served as they are, the ChangeFeed catches up with
+        # the commits in its thread, e.g. after a restart
+        head = storage.stamp()[0]
+        if head is not None and head != vector_store.head():
+            change_feed.notify(head)
+        vector = self._executor().submit(self._vector)
+        lexical = self._lexical()
+        try:
+            rankings = [lexical, vector.result()]
+        except Exception as e:
+            # e.g. a broken vector store or embedder plugin, the pages
+            # ranked by the search are still an answer
+            app.logger.error(f"Retrieval vector search failed: {e}")
+            rankings = [lexical]
+        fused = {}
+        for ranking in rankings:
+            for rank, chunk in enumerate(ranking, start=1):
+                score, _ = fused.get(chunk["id"], (0.0, chunk))
+                fused[chunk["id"]] = (score + 1 / (self.RRF_K + rank), chunk)
+        best = sorted(fused.values(), key=lambda x: -x[0])[: self.k]
+        revisions = {}
+        result = []
+        for score, chunk in best:
+            pagepath = chunk["pagepath"]
+            if pagepath not in revisions:
+                try:
+                    revisions[pagepath] = storage.metadata(pagepath + ".md")[
+                        "revision"
+                    ]
+                except StorageNotFound:
+                    revisions[pagepath] = None
+            result.append(
+                dict(
+                    chunk,
+                    pagename=get_pagename(pagepath, full=True),
+                    revision=revisions[pagepath],
+                    score=score,
+                )
+            )
+        return result
+
+    def render(self):
+        if not has_permission("READ"):
+            abort(403)
+        return jsonify(query=self.query, results=self.results())
 
 
 class AutoRoute:
@@ -357,6 +357,24 @@ def test_page_save_permissions(app_with_permissions, test_client):
     assert rv.status_code == 403
 
 
+def test_api_retrieve_permissions(app_with_permissions, test_client):
+    from otterwiki.vectorstore import change_feed
+
+    change_feed.update()
+    fun = "api_retrieve"
+    app_with_permissions.config["READ_ACCESS"] = "ANONYMOUS"
+    rv = test_client.get(url_for(fun, query="place like home"))
+    assert rv.status_code == 200
+    app_with_permissions.config["READ_ACCESS"] = "REGISTERED"
+    rv = test_client.get(url_for(fun, query="place like home"))
+    assert rv.status_code == 403
+    login(test_client)
+    rv = test_client.get(url_for(fun, query="place like home"))
+    assert rv.status_code == 200
+    texts = [r["text"] for r in rv.json["results"]]
+    assert "There is no place like Home." in texts
+
+
 def test_page_revert_permissions(app_with_permissions, test_client):
     # update permissions
     app_with_permissions.config["READ_ACCESS"] = "ANONYMOUS"
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+
+from otterwiki.chunker import chunk, count
+from otterwiki.renderer import render
+
+PAGE = """# Title
+
+intro
+
+## Section
+
+text of the section
+
+### Sub
+
+text of the sub section
+
+## Section
+
+again
+"""
+
+
+def test_chunk_headings():
+    chunks = chunk("Page", PAGE)
+    assert [c["breadcrumb"] for c in chunks] == [
+        ["Title"],
+        ["Title", "Section"],
+        ["Title", "Section", "Sub"],
+        ["Title", "Section"],
+    ]
+    assert [c["text"] for c in chunks] == [
+        "intro",
+        "text of the section",
+        "text of the sub section",
+        "again",
+    ]
+    # the anchors of the rendered page
+    _, toc = render.markdown(PAGE)
+    assert [c["anchor"] for c in chunks] == [t[4] for t in toc]
+    assert all(c["pagepath"] == "Page" for c in chunks)
+    # text before the first heading
+    chunks = chunk("Page", "before\n\n# Title\n\nafter\n")
+    assert chunks[0]["breadcrumb"] == []
+    assert chunks[0]["anchor"] == ""
+
+
+def test_chunk_budget():
+    md = "# Long\n\n" + "\n\n".join(
+        f"paragraph {i} with some words in it" for i in range(20)
+    )
+    chunks = chunk("Page", md, budget=20)
+    assert len(chunks) > 1
+    assert all(c["tokens"] <= 20 for c in chunks)
+    assert all(c["tokens"] == count(c["text"]) for c in chunks)
+    text = "\n\n".join(c["text"] for c in chunks)
+    assert text == md[len("# Long\n\n") :]
+    # CJK paragraphs are split after the sentences
+    chunks = chunk("Page", "知识助手的页面。" * 10, budget=20)
+    assert len(chunks) > 1
+    assert all(c["text"].endswith("。") for c in chunks)
+    # lines without the end of a sentence are split between the tokens
+    for md in [
+        "word " * 300,
+        "知识助手" * 100,
+        "otter知识" * 60,
+        f"```\n{'x, ' * 200}\n```\n",
+    ]:
+        chunks = chunk("Page", md, budget=64)
+        assert len(chunks) > 1
+        assert all(count(c["text"]) <= 64 for c in chunks)
+        assert count(chunks[0]["text"]) == 64
+    assert chunk("Page", "word " * 300, budget=64)[-1]["text"] == " ".join(
+        ["word"] * (300 - 4 * 64)
+    )
+
+
+def test_chunk_code_and_tables():
+    code = "\n".join(f"line_{i} = {i}" for i in range(30))
+    chunks = chunk("Page", f"```python\n{code}\n```\n", budget=30)
+    assert len(chunks) > 1
+    for c in chunks:
+        assert c["text"].startswith("```python\n")
+        assert c["text"].endswith("\n```")
+    rows = "\n".join(f"| row {i} | value {i} |" for i in range(30))
+    chunks = chunk("Page", f"| a | b |\n|---|---|\n{rows}\n", budget=30)
+    assert len(chunks) > 1
+    for c in chunks:
+        assert c["text"].startswith("| a | b |\n|---|---|\n| row")
+
+
+def test_chunk_blocks():
+    md = """
+- [ ] task
+- [x] done
+
+> quoted
+
+> [!NOTE]
+> an alert
+
+<div>some <b>html</b></div>
+
+a footnote[^1]
+
+[^1]: the note
+"""
+    c, footnotes = chunk("Page", md)
+    assert c["text"] == (
+        "- [ ] task\n- [x] done\n\n> quoted\n\nan alert\n\n"
+        "some html\n\na footnote[^1]"
+    )
+    assert footnotes["text"] == "[^1]: the note"
+    assert footnotes["anchor"] == "fn-1"
+
+
+def test_chunk_ids():
+    ids = [c["id"] for c in chunk("Page", PAGE)]
+    assert len(set(ids)) == len(ids)
+    assert ids == [c["id"] for c in chunk("Page", PAGE)]
+    # editing a section keeps the ids of the other chunks
+    edited = [c["id"] for c in chunk("Page", PAGE.replace("again", "edit"))]
+    assert edited[:3] == ids[:3]
+    assert edited[3] != ids[3]
+    # a chunk moved within its section keeps its id
+    edited = chunk(
+        "Page", PAGE.replace("intro", "new intro\n\n# Title\n\nintro")
+    )
+    assert ids[0] in [c["id"] for c in edited]
+    # the page is part of the id
+    assert chunk("Other", PAGE)[0]["id"] != ids[0]
+    # identical chunks get distinct ids
+    ids = [c["id"] for c in chunk("Page", "# A\n\nsame\n\n# A\n\nsame\n")]
+    assert len(set(ids)) == 2
@@ -449,3 +449,221 @@ def test_get_parent_revision(storage):
         filename=filename1, revision=revision3
     )
     assert parent_revision == revision1
+
+
+def test_list_index_incremental(storage):
+    author = ("Example Author", "mail@example.com")
+    for f in ["a.md", "b/c.md", "b/d/e.md", "f/g.png"]:
+        assert True == storage.store(
+            f, content="content", author=author, message="add " + f
+        )
+    assert storage.list() == storage._list_walk()
+    storage.rename("b", "h", author=author)
+    assert storage.list() == storage._list_walk()
+    assert storage.list("h", depth=0) == (["c.md"], ["d"])
+    storage.delete("h/d/e.md", author=author)
+    assert storage.list() == storage._list_walk()
+    storage.delete(["f"], author=author)
+    assert storage.list() == storage._list_walk()
+    assert storage.list(exclude=["h"]) == storage._list_walk(exclude=["h"])
+
+
+def test_list_index_external_change(storage):
+    author = ("Example Author", "mail@example.com")
+    assert True == storage.store(
+        "a.md", content="content", author=author, message="add a"
+    )
+    assert storage.list()[0] == ["a.md"]
+    # a file added behind the storage's back
+    with open(os.path.join(storage.path, "b.md"), "w") as f:
+        f.write("content")
+    assert storage.list()[0] == ["a.md", "b.md"]
+    # a commit made with git directly
+    os.makedirs(os.path.join(storage.path, "c"))
+    with open(os.path.join(storage.path, "c", "d.md"), "w") as f:
+        f.write("content")
+    storage.repo.index.add(["c/d.md"])
+    storage.repo.index.commit("add c/d.md")
+    assert storage.list() == (["a.md", "b.md", "c/d.md"], ["c"])
+
+
+def test_metadata_cache(storage):
+    author = ("Example Author", "mail@example.com")
+    filename = "test_metadata_cache.md"
+    assert True == storage.store(
+        filename, content="aaa\n", author=author, message="cached"
+    )
+    metadata = storage.metadata(filename)
+    stats = storage.metadata_cache.stats()
+    assert storage.metadata(filename) == metadata
+    assert storage.metadata_cache.stats()["hits"] == stats["hits"] + 1
+    # a second storage shares the cache via the database
+    other = gitstorage.GitStorage(path=storage.path)
+    other_metadata = other.metadata(filename)
+    assert other.metadata_cache.stats()["hits"] == 1
+    assert other.metadata_cache.stats()["misses"] == 0
+    assert other_metadata == metadata
+    assert other_metadata["datetime"] == metadata["datetime"]
+    assert other_metadata["files"] == metadata["files"]
+
+
+def test_revision_index(storage):
+    author = ("Example Author", "mail@example.com")
+    filename = "test_revision_index.md"
+    for content in ["aaa\n", "bbb\n"]:
+        assert True == storage.store(
+            filename, content=content, author=author, message=content
+        )
+    rev_b, rev_a = [x["revision-full"] for x in storage.log(filename)]
+    index = storage._get_revision_index(filename)
+    assert index.hexshas == [rev_b, rev_a]
+    assert index.get(rev_a[:6]) == rev_a
+    assert index.parent(rev_b[:6]) == rev_a
+    assert index.child(rev_a) == rev_b
+    assert index.parent(rev_a) is None
+    # the index is extended when HEAD moves
+    assert True == storage.store(
+        filename, content="ccc\n", author=author, message="ccc"
+    )
+    rev_c = storage.log(filename)[0]["revision-full"]
+    assert storage._get_revision_index(filename).hexshas == [
+        rev_c,
+        rev_b,
+        rev_a,
+    ]
+    assert storage.metadata(filename, revision=rev_b[:8])["message"] == (
+        "bbb\n"
+    )
+    assert storage.load(filename, revision=rev_a[:6]) == "aaa\n"
+    assert storage.get_parent_revision(filename, rev_c[:6]) == rev_b[:6]
+
+
+def test_load_revision_cat_file(storage):
+    content = b"binary\x00\xff\xfe content with a trailing newline\n"
+    filename = "test_cat_file.bin"
+    author = ("Example Author", "mail@example.com")
+    assert True == storage.store(
+        filename, content=content, author=author, message="bin", mode="wb"
+    )
+    revision = storage.log()[0]["revision"]
+    assert storage.load(filename, mode="rb", revision=revision) == content
+    hexsha, size = storage.blob_info(f"{revision}:{filename}")
+    assert size == len(content)
+    assert hexsha == storage.repo.git.hash_object(filename)
+    assert storage.blob_info(f"{revision}:nonexistent") is None
+    # kill the cat-file processes, they are restarted on the next request
+    for pool in [storage._cat_file, storage._cat_file_check]:
+        for proc in pool._get_pool().queue:
+            proc.close()
+            proc._start()
+            proc.proc.kill()
+            proc.proc.wait()
+    assert storage.load(filename, mode="rb", revision=revision) == content
+    assert storage.blob_info(f"{revision}:{filename}")[1] == len(content)
+    # concurrent requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda _: storage.load(filename, mode="rb", revision=revision),
+                range(64),
+            )
+        )
+    assert all(r == content for r in results)
+
+
+def test_last_commit_index(storage):
+    author = ("Example Author", "mail@example.com")
+    for f in ["a.md", "b.md", "a.md", "c/d.png"]:
+        assert True == storage.store(
+            f, content="content " + str(len(storage.log())), author=author
+        )
+    storage.rename("b.md", "e.md", author=author)
+
+    def last_commit(filename):
+        return next(storage.repo.iter_commits(paths=filename)).hexsha
+
+    for f in ["a.md", "b.md", "c/d.png", "e.md", "c"]:
+        assert storage.metadata(f)["revision-full"] == last_commit(f)
+    # a commit made with git directly extends the index
+    with open(os.path.join(storage.path, "a.md"), "w") as f:
+        f.write("changed")
+    storage.repo.index.add(["a.md"])
+    storage.repo.index.commit("changed a.md")
+    assert storage.metadata("a.md")["revision-full"] == last_commit("a.md")
+    assert storage.metadata("a.md")["message"] == "changed a.md"
+    with pytest.raises(gitstorage.StorageNotFound):
+        storage.metadata("f.md")
+
+
+def test_last_commit_index_merge(storage):
+    author = ("Example Author", "mail@example.com")
+    git = storage.repo.git
+    storage.store("a.md", "a\n", author=author, message="m1")
+    main = storage.repo.active_branch.name
+    git.checkout("-q", "-b", "other")
+    storage.store("a.md", "b\n", author=author, message="m2")
+    git.checkout("-q", main)
+    storage.store("a.md", "c\n", author=author, message="m3")
+    storage.store("x.md", "x\n", author=author, message="m4")
+    # a merge with a conflict in a.md, resolved by hand
+    with pytest.raises(Exception):
+        git.merge("other")
+    with open(os.path.join(storage.path, "a.md"), "w") as f:
+        f.write("resolved\n")
+    storage.repo.index.add(["a.md"])
+    actor = gitstorage.git.Actor(*author)
+    storage.repo.index.commit(
+        "resolve merge",
+        parent_commits=(
+            storage.repo.head.commit,
+            storage.repo.commit("other"),
+        ),
+        author=actor,
+        committer=actor,
+    )
+    assert storage.metadata("a.md")["message"] == "resolve merge"
+    # the merge took x.md unchanged from the one parent
+    assert storage.metadata("x.md")["message"] == "m4"
+
+
+def test_pickaxe(storage):
+    author = ("Example Author", "mail@example.com")
+    storage.store("a.md", "hello Needle\n", author=author, message="add")
+    first = storage.repo.head.commit.hexsha
+    storage.store("b.md", "nothing\n", author=author, message="other")
+    storage.store("a.md", "hello\n", author=author, message="remove")
+    storage.store("c.txt", "needle\n", author=author, message="no page")
+
+    def messages(*args, **kwargs):
+        return [e["message"] for e in storage.pickaxe(*args, **kwargs)]
+
+    assert messages("needle") == ["remove", "add"]
+    assert [e["files"] for e in storage.pickaxe("needle")] == [
+        ["a.md"],
+        ["a.md"],
+    ]
+    assert messages("needle", is_casesensitive=True) == []
+    assert messages("N[e]+dle", is_regexp=True) == ["remove", "add"]
+    # only the commits after since
+    assert messages("needle", since=first) == ["remove"]
+    assert storage.is_ancestor(first, storage.repo.head.commit.hexsha)
+    assert not storage.is_ancestor(storage.repo.head.commit.hexsha, first)
+    with pytest.raises(gitstorage.StorageNotFound):
+        messages("needle", since="--all")
+
+
+def test_subscribe(storage):
+    author = ("Example Author", "mail@example.com")
+    heads = []
+    storage.subscribe(heads.append)
+    storage.store("a.md", "a\n", author=author, message="add")
+    assert heads == [storage.repo.head.commit.hexsha]
+    # nothing committed, nothing notified
+    storage.store("a.md", "a\n", author=author, message="same")
+    assert len(heads) == 1
+    storage.rename("a.md", "b.md", author=author)
+    storage.delete("b.md", author=author)
+    assert len(heads) == 3
+    assert heads[-1] == storage.repo.head.commit.hexsha
@@ -171,6 +171,63 @@ def test_pageindex(test_client):
     assert 'href="/Sub%20Directory/Nested%20page#nested-header"' in html
 
 
+def test_pageindex_tree(test_client, req_ctx):
+    from otterwiki.wiki import PageIndex
+
+    for pagename in [
+        "Index Parent",
+        "Index Parent/Index Child",
+        "Index Folder/Index Leaf",
+    ]:
+        save_shortcut(
+            test_client, pagename, f"# {pagename}\n", f"added {pagename}"
+        )
+    entries = {
+        entry[1]: entry
+        for entries in PageIndex().toc.values()
+        for entry in entries
+    }
+    # (depth, title, url, pagetoc, has_children)
+    assert entries["Index Parent"][4] is True
+    assert entries["Index Child"][4] is False
+    assert entries["Index Child"][0] == 1
+    # directories without a page are listed as such
+    assert entries["Index Folder/"][0] == 0
+    assert "Index Parent/" not in entries
+    assert entries["Index Leaf"][4] is False
+
+
+def test_api_pages(test_client):
+    for pagename in [
+        "Autocomplete Alpha",
+        "Autocomplete/Nestedbeta",
+        "Autocomplete Gamma",
+    ]:
+        save_shortcut(
+            test_client, pagename, f"# {pagename}\n", f"added {pagename}"
+        )
+    pages = test_client.get("/-/api/pages?prefix=autocomplete").json["pages"]
+    assert pages == [
+        "Autocomplete Alpha",
+        "Autocomplete Gamma",
+        "Autocomplete/Nestedbeta",
+    ]
+    # the name of the page itself is matched, too
+    pages = test_client.get("/-/api/pages?prefix=NESTEDB").json["pages"]
+    assert pages == ["Autocomplete/Nestedbeta"]
+    pages = test_client.get("/-/api/pages?prefix=autocomplete&limit=1").json[
+        "pages"
+    ]
+    assert len(pages) == 1
+    # new pages show up
+    save_shortcut(test_client, "Autocomplete Delta", "# x\n", "added")
+    pages = test_client.get("/-/api/pages?prefix=autocomplete d").json["pages"]
+    assert pages == ["Autocomplete Delta"]
+    assert test_client.get("/-/api/pages?prefix=nonexistent").json == {
+        "pages": []
+    }
+
+
 def test_page_save(test_client):
     from otterwiki.server import storage
 
@@ -379,6 +436,294 @@ def test_search(test_client):
     assert rv.status_code == 200
 
 
+def test_search_parallel(test_client, req_ctx, monkeypatch):
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+
+    import otterwiki.wiki
+    from otterwiki.searchindex import ScanPool
+    from otterwiki.wiki import Search
+
+    for i in range(6):
+        save_shortcut(
+            test_client,
+            f"Parallel {i}",
+            "Parallel\n" * i + "other\nParallel scan",
+            "initial commit",
+        )
+
+    def search(**kwargs):
+        s = Search(query="Parallel", is_casesensitive=True, **kwargs)
+        s.compile()
+        result = s.search()
+        return sorted(
+            result.items(), key=lambda x: (-x[0][0], -x[0][1], x[0][2])
+        )
+
+    sequential = search()
+    pool = ScanPool(2)
+    monkeypatch.setattr(otterwiki.wiki, "scan_pool", pool)
+    monkeypatch.setattr(Search, "SCAN_PARALLEL", 1)
+    monkeypatch.setattr(Search, "SCAN_BATCH", 2)
+    try:
+        assert search() == sequential
+        # stop early
+        s = Search(query="Parallel scan", is_casesensitive=True, limit=2)
+        s.compile()
+        assert len(s.search()) == 2
+        assert not s.complete
+    finally:
+        pool.reset()
+
+    class BrokenPool:
+        submitted = 0
+
+        def submit(self, *args):
+            self.submitted += 1
+            future = Future()
+            future.set_exception(BrokenProcessPool())
+            return future
+
+        def shutdown(self, **kwargs):
+            pass
+
+    # a pool that can not be spawned, e.g. under uWSGI, is not tried again
+    broken = BrokenPool()
+    pool._pool, pool._pid = broken, os.getpid()
+    assert search() == sequential
+    assert broken.submitted > 0
+    submitted = broken.submitted
+    assert pool.get() is None
+    assert search() == sequential
+    assert broken.submitted == submitted
+
+
+def test_search_substring(test_client, req_ctx):
+    from otterwiki.wiki import Search
+
+    save_shortcut(
+        test_client, "Substring One", "The quick brown fox\n", "initial commit"
+    )
+    save_shortcut(
+        test_client,
+        "Substring Two",
+        "A quick fox, a brown dog\n",
+        "initial commit",
+    )
+    save_shortcut(
+        test_client,
+        "Substring Three",
+        "foo-bar and foo(bar) in the otterwiki\n",
+        "initial commit",
+    )
+    save_shortcut(
+        test_client, "Substring Four", "foo bar in a wiki\n", "initial commit"
+    )
+
+    def search(query):
+        s = Search(query=query)
+        s.compile()
+        return {
+            key[2]: (key[1], summary)
+            for key, summary in s.search().items()
+            if key[2].startswith("substring ")
+        }
+
+    # the query is found as a whole, anywhere in the text
+    result = search("quick brown")
+    assert set(result) == {"substring one.md"}
+    assert result["substring one.md"] == (
+        1,
+        ['The <span class="text-match">quick brown</span> fox'],
+    )
+    assert set(search("uick")) == {"substring one.md", "substring two.md"}
+    assert set(search("k b")) == {"substring one.md"}
+    assert set(search("own do")) == {"substring two.md"}
+    # a page with the word does not hide a page with a part of a word
+    assert set(search("wiki")) == {"substring three.md", "substring four.md"}
+    # every match is counted, not only the words
+    assert search("o")["substring three.md"][0] == 5
+    # punctuation is matched as it is
+    assert set(search("foo bar")) == {"substring four.md"}
+    assert set(search("foo-bar")) == {"substring three.md"}
+    assert set(search("foo(bar)")) == {"substring three.md"}
+    assert search("Quick, bro") == {}
+
+
+def test_search_pagination(test_client, req_ctx):
+    from otterwiki.wiki import Search
+
+    for i in range(25):
+        save_shortcut(
+            test_client,
+            f"Paginated {i}",
+            "paginated search\n" * (i % 3 + 1),
+            "initial commit",
+        )
+    rv = test_client.get("/-/search/paginated")
+    assert rv.status_code == 200
+    html = rv.data.decode()
+    assert html.count('<h2 class="content-title mt-20">') == 20
+    assert "1 / 2" in html
+    assert "page=2" in html
+    rv = test_client.get("/-/search?query=paginated&page=2")
+    html = rv.data.decode()
+    assert html.count('<h2 class="content-title mt-20">') == 5
+    assert "2 / 2" in html
+    # the page is clamped
+    rv = test_client.get("/-/search?query=paginated&page=9")
+    assert "2 / 2" in rv.data.decode()
+    # the options are kept in the links to the other pages
+    rv = test_client.get("/-/search?query=paginated&is_regexp=y")
+    html = rv.data.decode()
+    assert "is_regexp=y" in html
+    assert html.count('<h2 class="content-title mt-20">') == 20
+    # streamed, all results on one page
+    rv = test_client.get("/-/search?query=paginated&stream=1")
+    assert rv.is_streamed
+    html = rv.data.decode()
+    assert html.count('<h2 class="content-title mt-20">') == 25
+    # the total is estimated when the scan stopped early
+    s = Search(query="paginated search", is_regexp=True, limit=5)
+    s.compile()
+    assert len(s.search()) == 5
+    assert not s.complete
+    assert s.total >= 5
+    # the pages ranked best by the index are scanned first
+    s = Search(query="paginated search", limit=5)
+    s.compile()
+    keys = list(s.search())
+    assert len(keys) == 5
+    assert not s.complete
+    assert s.total == 25
+    assert {key[5] for key in keys} == {max(s._index().values())}
+
+
+def test_search_pagination_index(test_client, req_ctx, monkeypatch):
+    from otterwiki.wiki import Search
+
+    for i in range(25):
+        save_shortcut(
+            test_client,
+            f"Indexpaged {i}",
+            "indexpaged words\n" * (i % 3 + 1),
+            "initial commit",
+        )
+    # the pages after the scan limit can be paged to
+    monkeypatch.setattr(Search, "SCAN_LIMIT", 10)
+    rv = test_client.get("/-/search?query=indexpaged words&page=2")
+    html = rv.data.decode()
+    assert html.count('<h2 class="content-title mt-20">') == 5
+    assert "2 / 2" in html
+    # the best pages first
+    s = Search(query="indexpaged words", page=1)
+    s.compile()
+    result = s._paginate()
+    assert result["total"] == 25
+    assert result["is_estimate"]
+    scores = [key[5] for key in result["keys"]]
+    assert scores == sorted(scores, reverse=True)
+    assert len(scores) == 20
+
+
+def test_api_retrieve(test_client, monkeypatch):
+    from otterwiki.server import storage
+    from otterwiki.vectorstore import change_feed, vector_store
+
+    save_shortcut(
+        test_client,
+        "Retrieve Otters",
+        "# Otters\n\nOtters are mammals.\n\n"
+        "## Rivers\n\nRetrievable otters swim in rivers.\n",
+        "initial commit",
+    )
+    save_shortcut(
+        test_client,
+        "Retrieve Beavers",
+        "# Beavers\n\nRetrievable beavers build dams.\n",
+        "initial commit",
+    )
+    change_feed.update()
+    rv = test_client.get("/-/api/retrieve?query=retrievable otters&k=2")
+    assert rv.status_code == 200
+    results = rv.json["results"]
+    assert len(results) == 2
+    best = results[0]
+    assert best["pagepath"] == "retrieve otters"
+    assert best["pagename"] == "Retrieve Otters"
+    assert best["anchor"] == "rivers"
+    assert best["breadcrumb"] == ["Otters", "Rivers"]
+    assert best["text"] == "Retrievable otters swim in rivers."
+    assert (
+        best["revision"] == storage.metadata("retrieve otters.md")["revision"]
+    )
+    assert best["score"] > results[1]["score"]
+    # the chunks follow the commits
+    save_shortcut(
+        test_client,
+        "Retrieve Otters",
+        "# Otters\n\nOtters are mammals.\n",
+        "edit",
+    )
+    change_feed.update()
+    texts = [
+        r["text"]
+        for r in test_client.post(
+            "/-/api/retrieve", data={"query": "retrievable otters"}
+        ).json["results"]
+    ]
+    assert "Retrievable otters swim in rivers." not in texts
+    assert "Retrievable beavers build dams." in texts
+    assert test_client.get("/-/api/retrieve").json["results"] == []
+
+    # without the vector search the pages ranked by the search answer
+    def broken(*args, **kwargs):
+        raise RuntimeError("broken embedder")
+
+    monkeypatch.setattr(vector_store, "search", broken)
+    rv = test_client.get("/-/api/retrieve?query=retrievable beavers")
+    assert rv.status_code == 200
+    assert rv.json["results"][0]["text"] == "Retrievable beavers build dams."
+
+
+def test_search_history(test_client, monkeypatch):
+    from otterwiki.server import storage
+
+    calls = []
+    pickaxe = storage.pickaxe
+
+    def recording_pickaxe(*args, **kwargs):
+        calls.append(kwargs.get("since"))
+        return pickaxe(*args, **kwargs)
+
+    monkeypatch.setattr(storage, "pickaxe", recording_pickaxe)
+
+    def search():
+        rv = test_client.post(
+            "/-/search", data={"query": "Pickaxe", "in_history": "y"}
+        )
+        assert rv.status_code == 200
+        assert rv.is_streamed
+        return rv.data.decode()
+
+    save_shortcut(test_client, "History Search", "a Pickaxe", "add pickaxe")
+    save_shortcut(test_client, "History Search", "removed", "remove pickaxe")
+    html = search()
+    assert "add pickaxe" in html
+    assert "remove pickaxe" in html
+    assert calls == [None]
+    # the result is cached
+    search()
+    assert calls == [None]
+    # after a new commit only the new commits are searched
+    head = storage.repo.head.commit.hexsha
+    save_shortcut(test_client, "History Other", "Pickaxe again", "again")
+    html = search()
+    assert "again" in html
+    assert "add pickaxe" in html
+    assert calls == [None, head]
+
+
 def test_rename(test_client):
     old_pagename = "RenameTest"
     new_pagename = "RenameTestNew"
@@ -598,3 +943,44 @@ def test_blame_issue200_empty_trailing_lines(test_client, create_app):
     # check blame
     rv = test_client.get("/{}/blame".format(pagename))
     assert rv.status_code == 200
+
+
+def test_changelog_pagination(test_client, req_ctx):
+    from otterwiki.wiki import Changelog
+
+    storage = test_client.application.storage
+    author = ("Example Author", "mail@example.com")
+    for i in range(5):
+        storage.store(
+            "changelog_pagination.md",
+            content=f"content {i}\n",
+            author=author,
+            message=f"changelog pagination {i}",
+        )
+    log = storage.log(max_count=5)
+    chlg = Changelog()
+    chlg.commit_count = 2
+    html = chlg.render()
+    assert "changelog pagination 4" in html
+    assert "changelog pagination 3" in html
+    assert "changelog pagination 2" not in html
+    assert f"after={log[1]['revision-full']}" in html
+    # the next page
+    chlg = Changelog(after=log[1]["revision-full"])
+    chlg.commit_count = 2
+    html = chlg.render()
+    assert "changelog pagination 3" not in html
+    assert "changelog pagination 2" in html
+    assert "changelog pagination 1" in html
+    assert f"before={log[2]['revision-full']}" in html
+    # and back
+    chlg = Changelog(before=log[2]["revision-full"])
+    chlg.commit_count = 2
+    html = chlg.render()
+    assert "changelog pagination 4" in html
+    assert "changelog pagination 3" in html
+    # invalid cursors
+    rv = test_client.get("/-/changelog?after=xxx")
+    assert rv.status_code == 404
+    rv = test_client.get("/-/changelog")
+    assert rv.status_code == 200
@@ -5,6 +5,7 @@ import pytest
 from bs4 import BeautifulSoup
 from otterwiki.renderer import (
     render,
+    balance_html,
     clean_html,
     OtterwikiRenderer,
     pygments_render,
@@ -251,6 +252,64 @@ def test_clean_html_script():
     )
 
 
+def test_toc_only():
+    md = """---
+title: "# not a heading"
+---
+# head 1
+text
+```
+# not a heading either
+```
+
+head **2**
+----------
+
+> ## quoted [[Wiki Link]]
+
+- list
+  ### in a list
+
+# head 1
+"""
+    toc = render.toc(md)
+    assert toc == render.markdown(md)[1]
+    assert [t[4] for t in toc] == [
+        "head-1",
+        "head-2",
+        "quoted-wiki-link",
+        "in-a-list",
+        "head-1-1",
+    ]
+    assert render.toc("no headings\n") == []
+
+
+def test_balance_html():
+    assert balance_html("<p>text") == "<p>text</p>"
+    assert balance_html("<p>text</p></div>") == "<p>text</p>"
+    assert balance_html("<div><p>a</div>b") == "<div><p>a</p></div>b"
+    assert balance_html("a<br>b<img src=x></img>") == 'a<br/>b<img src="x"/>'
+    assert (
+        balance_html("<p class=' b  a ' id=x>")
+        == '<p class="b a" id="x"></p>'
+    )
+    assert balance_html("<pre>\n\n</pre>\n\n") == "<pre>\n\n</pre>\n"
+    assert balance_html("&lt;&amp;&#150;") == "&lt;&amp;\u2013"
+    assert balance_html("<script>a<b</script>") == "<script>a<b</script>"
+    # the same output BeautifulSoup produces
+    with render.parser() as parser:
+        rendered = parser(
+            "# head\n\n| a | b |\n|---|---|\n| 1 | *2* |\n\n    code\n"
+        )
+    for html in [
+        "<table><tr><td>1<td>2</tr></table></td>",
+        "<em><strong>x</em></strong><!-- c --><a title='\"q\"'>",
+        "<ul><li>a<li>b</ul><br/></br><input disabled>&nbsp&unknown;",
+        rendered,
+    ]:
+        assert balance_html(html) == str(BeautifulSoup(html, "html.parser"))
+
+
 def test_clean_html_render():
     text = """Preformatted script:
 
@@ -703,3 +762,78 @@ date: 2025-04-06 11:05:01
     assert pre is not None
     assert hasattr(pre, "text")
     assert "tag: test" in pre.text  # pyright:ignore
+
+
+def test_render_cache(tmpdir):
+    from otterwiki.renderer import RenderCache
+
+    renderer = OtterwikiRenderer(config={"WIKILINK_STYLE": ""})
+    cache = RenderCache(renderer, path=str(tmpdir), memsize=1)
+    md = "# Header\n\n[[Title|Link]]\n"
+    html, toc = cache.markdown(md, page_url="/Page")
+    assert (html, toc) == renderer.markdown(md, page_url="/Page")
+    assert cache.misses == 1
+    # from memory
+    assert cache.markdown(md, page_url="/Page") == (html, toc)
+    assert cache.hits == 1
+    # push the entry out of memory, it is loaded from disk
+    cache.markdown("other\n")
+    assert cache.markdown(md, page_url="/Page") == (html, toc)
+    assert cache.hits == 2
+    # a second cache shares the disk tier
+    other = RenderCache(renderer, path=str(tmpdir))
+    assert other.markdown(md, page_url="/Page") == (html, toc)
+    assert other.hits == 1
+    # different arguments and config are different keys
+    assert cache.key(md, page_url="/Page") != cache.key(md, page_url="/Other")
+    key = cache.key(md)
+    renderer.config["WIKILINK_STYLE"] = "LINK_TITLE"
+    assert cache.key(md) != key
+    assert cache.markdown(md)[0] != html
+    # eviction
+    cache.disksize = 1
+    cache.evict()
+    assert len(tmpdir.listdir()) == 1
+    assert sum(len(d.listdir()) for d in tmpdir.listdir()) == 1
+
+
+def test_renderer_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    renderer = OtterwikiRenderer()
+    pages = [
+        f"# Page {i}\n\n## Section {i}\n\n![](./img.png)\n" for i in range(50)
+    ]
+
+    def render_page(i):
+        return renderer.markdown(pages[i], page_url=f"/Page{i}")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(render_page, range(len(pages))))
+    for i, (html, toc) in enumerate(results):
+        assert [t[3] for t in toc] == [f"Page {i}", f"Section {i}"]
+        assert f'src="/Page{i}/a/img.png"' in html
+
+
+def test_renderer_reentrant():
+    from otterwiki.plugins import hookimpl, plugin_manager
+
+    renderer = OtterwikiRenderer()
+    inner = []
+
+    class RenderInside:
+        @hookimpl
+        def renderer_markdown_preprocess(self, md):
+            # render another page while the outer page is being rendered
+            if md == "# Outer\n":
+                inner.append(renderer.markdown("# Inner\n"))
+            return md
+
+    plugin = RenderInside()
+    plugin_manager.register(plugin)
+    try:
+        html, toc = renderer.markdown("# Outer\n")
+    finally:
+        plugin_manager.unregister(plugin)
+    assert [t[3] for t in toc] == ["Outer"]
+    assert [t[3] for t in inner[0][1]] == ["Inner"]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+
+
+def test_search_index(create_app, req_ctx, tmpdir):
+    from otterwiki.searchindex import SearchIndex
+
+    storage = create_app.storage
+    author = ("Search Test", "search@example.org")
+    storage.store(
+        "searchindex/one.md",
+        "# One\n\nzebrafish and more zebrafish\n\nzebrafish\n",
+        author=author,
+    )
+    storage.store(
+        "searchindex/two.md",
+        "# Two\n\nA zebrafish among many other words in a longer text.\n",
+        author=author,
+    )
+
+    index = SearchIndex(storage, filename=str(tmpdir.join("s.sqlite")))
+    result = index.search(["zebrafish"])
+    assert set(result) == {"searchindex/one.md", "searchindex/two.md"}
+    assert index.reads > 2
+    # the page with more matches ranks higher
+    assert result["searchindex/one.md"][0] > result["searchindex/two.md"][0]
+    # the lines with the matches
+    assert result["searchindex/one.md"][1] == [
+        (2, "zebrafish and more zebrafish"),
+        (4, "zebrafish"),
+    ]
+    # with limit only the best pages come with their lines
+    limited = index.search(["zebrafish"], limit=1)
+    assert limited["searchindex/one.md"] == result["searchindex/one.md"]
+    assert limited["searchindex/two.md"] == (
+        result["searchindex/two.md"][0],
+        [],
+    )
+    # words are matched by their beginning
+    assert set(index.search(["zebra"])) == set(result)
+    assert index.search(["zebrafishes"]) == {}
+    # several words are matched as a phrase, the last by its beginning
+    assert set(index.search(["zebrafish", "am"])) == {"searchindex/two.md"}
+    assert index.search(["zebra", "among"]) == {}
+    assert index.search(["zebrafish", "words"]) == {}
+    assert index.search(["and", "more"])["searchindex/one.md"][1] == [
+        (2, "zebrafish and more zebrafish")
+    ]
+
+    # only the changed files are indexed again
+    reads = index.reads
+    storage.store(
+        "searchindex/two.md", "# Two\n\nno fish anymore\n", author=author
+    )
+    assert set(index.search(["zebrafish"])) == {"searchindex/one.md"}
+    assert index.reads == reads + 1
+    storage.delete("searchindex/one.md", author=author)
+    assert index.search(["zebrafish"]) == {}
+    assert index.reads == reads + 1
+
+    # a new index, e.g. after a restart, uses the stored index
+    other = SearchIndex(storage, filename=str(tmpdir.join("s.sqlite")))
+    assert other.search(["fish"]) == index.search(["fish"])
+    assert other.reads == 0
+
+
+def test_search_index_cjk(create_app, req_ctx, tmpdir):
+    from otterwiki.searchindex import SearchIndex
+
+    storage = create_app.storage
+    author = ("Search Test", "search@example.org")
+    storage.store(
+        "cjkindex/one.md",
+        "# 知识助手\n\n知识助手是一个基于Git的Wiki系统。\n",
+        author=author,
+    )
+    storage.store(
+        "cjkindex/two.md", "# 助手\n\n另一个页面，没有知识。\n", author=author
+    )
+    index = SearchIndex(storage, filename=str(tmpdir.join("s.sqlite")))
+
+    def search(query):
+        result = index.search(index.words(query))
+        return {fn for fn in result if fn.startswith("cjkindex/")}
+
+    assert search("知识助手") == {"cjkindex/one.md"}
+    assert search("助手") == {"cjkindex/one.md", "cjkindex/two.md"}
+    assert search("知") == {"cjkindex/one.md", "cjkindex/two.md"}
+    assert search("Wiki系统") == {"cjkindex/one.md"}
+    # the words of the query are not next to each other
+    assert search("Git 系统") == set()
+    assert search("页面") == {"cjkindex/two.md"}
+    result = index.search(index.words("知识"))
+    # the page with the query in the header and the text ranks higher
+    assert result["cjkindex/one.md"][0] > result["cjkindex/two.md"][0]
+
+
+def test_regex_trigrams(create_app):
+    from otterwiki.searchindex import regex_trigrams
+
+    assert regex_trigrams("(Needle)") == ("and", ["dle", "edl", "eed", "nee"])
+    # anchors and word boundaries do not break a literal
+    assert regex_trigrams(r"^\bWord\b") == ("and", ["ord", "wor"])
+    # small character classes and alternatives
+    assert regex_trigrams("gr[ae]y") == (
+        "or",
+        [("and", ["gra", "ray"]), ("and", ["gre", "rey"])],
+    )
+    assert regex_trigrams("foo|barbaz") == (
+        "or",
+        ["foo", ("and", ["arb", "bar", "baz", "rba"])],
+    )
+    # repeated items are required when repeated at least once
+    assert regex_trigrams("N[eE]+dle") == "dle"
+    assert regex_trigrams("(abc)?def") == "def"
+    # nothing to extract
+    assert regex_trigrams("fo|barbaz") is None
+    assert regex_trigrams("a.*b") is None
+    assert regex_trigrams("(") is None
+
+
+def test_search_index_candidates(create_app, req_ctx, tmpdir):
+    from otterwiki.searchindex import SearchIndex, regex_trigrams
+
+    storage = create_app.storage
+    author = ("Search Test", "search@example.org")
+    storage.store("trigrams/grey.md", "The sky is Grey.\n", author=author)
+    storage.store("trigrams/gray.md", "A gray cat\n", author=author)
+    storage.store("trigrams/green.md", "Grass is green\n", author=author)
+
+    index = SearchIndex(storage, filename=str(tmpdir.join("s.sqlite")))
+
+    def candidates(pattern):
+        return {
+            fn
+            for fn in index.candidates(regex_trigrams(pattern))
+            if fn.startswith("trigrams/")
+        }
+
+    assert candidates("gr[ae]y") == {"trigrams/grey.md", "trigrams/gray.md"}
+    assert candidates("Green+|grass") == {"trigrams/green.md"}
+    assert candidates("sky.*grey") == {"trigrams/grey.md"}
+    assert index.candidates(regex_trigrams("g.*y")) is None
+    # trigrams are not matched across lines
+    storage.store("trigrams/gray.md", "A gr\nay cat\n", author=author)
+    assert candidates("gray") == set()
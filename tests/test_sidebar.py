@@ -130,3 +130,82 @@ def test_sidebar_custom_menu_error(create_app, test_client, req_ctx):
     assert SidebarMenu().config == []
     links = get_sidebar_menu(test_client)
     assert links is None
+
+
+def test_page_header_index(create_app, req_ctx, tmpdir):
+    from otterwiki.sidebar import PageHeaderIndex, SidebarPageIndex
+
+    storage = create_app.storage
+    author = ("Sidebar Test", "sidebar@example.org")
+    storage.store("headerindex/one.md", "# ONE\n\ntext\n", author=author)
+    storage.store(
+        "headerindex/two.md", "Two Header\n===\n\ntext\n", author=author
+    )
+    filenames = ["headerindex/one.md", "headerindex/two.md"]
+
+    index = PageHeaderIndex(storage, filename=str(tmpdir.join("h.sqlite")))
+    assert index.get(filenames) == {
+        "headerindex/one.md": "ONE",
+        "headerindex/two.md": "Two Header",
+    }
+    assert index.reads == 2
+    # nothing changed, nothing is read
+    index.get(filenames)
+    assert index.reads == 2
+    # only the changed file is read again
+    storage.store(
+        "headerindex/two.md", "# Changed Two\n\ntext\n", author=author
+    )
+    assert index.get(filenames)["headerindex/two.md"] == "Changed Two"
+    assert index.reads == 3
+    # a new index, e.g. after a restart, uses the stored headers
+    other = PageHeaderIndex(storage, filename=str(tmpdir.join("h.sqlite")))
+    other.warm()
+    assert other.get(filenames) == index.get(filenames)
+    assert other.reads == 0
+
+    create_app.config["SIDEBAR_MENUTREE_MODE"] = "SORTED"
+    tree = SidebarPageIndex("headerindex").query()
+    assert tree["headerindex"]["children"]["one"]["header"] == "ONE"
+    create_app.config["SIDEBAR_MENUTREE_MODE"] = ""
+
+
+def test_menutree_cache(create_app, req_ctx, tmpdir):
+    import otterwiki.sidebar
+    from otterwiki.sidebar import MenuTreeCache, SidebarPageIndex
+
+    storage = create_app.storage
+    author = ("Sidebar Test", "sidebar@example.org")
+    storage.store("treecache/a/one.md", "# one\n", author=author)
+    storage.store("treecache/b/two.md", "# two\n", author=author)
+    cache = MenuTreeCache(storage, filename=str(tmpdir.join("t.sqlite")))
+    otterwiki.sidebar.menutree_cache = cache
+    create_app.config["SIDEBAR_MENUTREE_MODE"] = "SORTED"
+    try:
+        tree = SidebarPageIndex("treecache/a").query()
+        assert list(tree["treecache"]["children"]["a"]["children"]) == ["one"]
+        assert SidebarPageIndex("treecache/a").query() == tree
+        assert (cache.hits, cache.misses) == (1, 1)
+        # a commit outside of the directory keeps the cached tree
+        storage.store("treecache/b/three.md", "# three\n", author=author)
+        assert SidebarPageIndex("treecache/a").query() == tree
+        assert (cache.hits, cache.misses) == (2, 1)
+        # a commit below the directory rebuilds the tree
+        storage.store("treecache/a/four.md", "# four\n", author=author)
+        tree = SidebarPageIndex("treecache/a").query()
+        assert list(tree["treecache"]["children"]["a"]["children"]) == [
+            "four",
+            "one",
+        ]
+        assert (cache.hits, cache.misses) == (2, 2)
+        # another process shares the stored trees
+        other = MenuTreeCache(storage, filename=str(tmpdir.join("t.sqlite")))
+        otterwiki.sidebar.menutree_cache = other
+        assert SidebarPageIndex("treecache/a").query() == tree
+        assert other.hits == 1
+        # different settings are different entries
+        SidebarPageIndex("treecache/a", mode="*")
+        assert (other.hits, other.misses) == (1, 1)
+    finally:
+        create_app.config["SIDEBAR_MENUTREE_MODE"] = ""
+        otterwiki.sidebar.menutree_cache = MenuTreeCache(storage)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+
+from otterwiki.tokenizer import bigrams, is_cjk, tokenize
+
+
+def test_tokenize_words():
+    assert tokenize("Hello, World! snake_case Über 42") == [
+        "hello",
+        "world",
+        "snake_case",
+        "über",
+        "42",
+    ]
+    assert tokenize("") == []
+
+
+def test_tokenize_cjk():
+    assert bigrams("知") == ["知"]
+    assert bigrams("知识助手") == ["知识", "识助", "助手", "手"]
+    assert bigrams("知识助手", query=True) == ["知识", "识助", "助手"]
+    # mixed text, runs of CJK characters end at any other character
+    assert tokenize("Otter知识助手是Wiki。日本語のテキスト") == [
+        "otter",
+        "知识",
+        "识助",
+        "助手",
+        "手是",
+        "是",
+        "wiki",
+        "日本",
+        "本語",
+        "語の",
+        "のテ",
+        "テキ",
+        "キス",
+        "スト",
+        "ト",
+    ]
+    assert tokenize("助手 wiki", query=True) == ["助手", "wiki"]
+    assert is_cjk("助手")
+    assert not is_cjk("wiki")
+
+
+def test_tokenize_query_in_document():
+    # every token of a query is the prefix of a token of a document
+    # containing the query
+    document = tokenize("在知识助手中搜索")
+    for query in ["知识", "识助手", "索", "搜", "手中"]:
+        for token in tokenize(query, query=True):
+            assert any(t.startswith(token) for t in document)
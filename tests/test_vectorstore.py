@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# vim: set et ts=8 sts=4 sw=4 ai:
+
+import numpy as np
+import pytest
+
+
+def make_chunk(pagepath, text, breadcrumb=None):
+    from otterwiki.chunker import chunk_id
+
+    breadcrumb = breadcrumb or []
+    return {
+        "id": chunk_id(pagepath, breadcrumb, text),
+        "pagepath": pagepath,
+        "breadcrumb": breadcrumb,
+        "anchor": "",
+        "text": text,
+    }
+
+
+def test_hashing_embedder(create_app):
+    from otterwiki.vectorstore import HashingEmbedder
+
+    embedder = HashingEmbedder(dim=64)
+    a, b, c = embedder.embed(
+        ["otters swim in rivers", "Otters swim in rivers!", "知识助手"]
+    )
+    assert a.dtype == np.float32
+    assert a.shape == (64,)
+    assert np.allclose(a, b)
+    assert np.isclose(np.linalg.norm(c), 1)
+    assert np.allclose(embedder.embed([""]), 0)
+
+
+def test_vector_store(create_app, tmpdir):
+    from otterwiki.vectorstore import HashingEmbedder, VectorStore
+
+    class CountingEmbedder(HashingEmbedder):
+        embedded = 0
+
+        def embed(self, texts):
+            self.embedded += len(texts)
+            return super().embed(texts)
+
+    store = VectorStore(str(tmpdir), embedder=CountingEmbedder())
+    assert store.search(["otters"]) == [[]]
+    store.embedder.embedded = 0
+    chunks = [
+        make_chunk("Otters", "otters swim in rivers", ["Otters"]),
+        make_chunk("Otters", "otters eat fish", ["Otters", "Food"]),
+        make_chunk("Git", "git stores commits"),
+    ]
+    assert store.add(chunks) == 3
+    # chunks known by their id are not embedded again
+    assert store.add(chunks) == 0
+    assert store.embedder.embedded == 3
+    rivers, commits = store.search(["rivers", "commits"], k=2)
+    assert rivers[0][1]["text"] == "otters swim in rivers"
+    assert rivers[0][1]["breadcrumb"] == ["Otters"]
+    assert commits[0][1]["pagepath"] == "Git"
+    assert rivers[0][0] > rivers[1][0]
+    assert len(store.search(["rivers"], k=10)[0]) == 3
+
+    # another process maps the matrix of its own
+    other = VectorStore(str(tmpdir))
+    assert other.search(["rivers"], k=1)[0][0][1]["id"] == chunks[0]["id"]
+
+    # only the new chunks of a page are embedded
+    embedded = store.embedder.embedded
+    store.replace_page(
+        "Otters",
+        [chunks[0], make_chunk("Otters", "otters sleep", ["Otters"])],
+    )
+    assert store.embedder.embedded == embedded + 1
+    texts = [c["text"] for _, c in other.search(["otters"], k=10)[0]]
+    assert sorted(texts) == [
+        "git stores commits",
+        "otters sleep",
+        "otters swim in rivers",
+    ]
+
+    # compacting removes the deleted rows
+    store.delete([chunks[2]["id"]])
+    assert store.compact(force=True)
+    assert not tmpdir.listdir(lambda p: p.basename.startswith("vectors-1."))
+    texts = [c["text"] for _, c in other.search(["otters"], k=10)[0]]
+    assert sorted(texts) == ["otters sleep", "otters swim in rivers"]
+    store.add([chunks[2]])
+    assert other.search(["commits"], k=1)[0][0][1]["text"] == (
+        "git stores commits"
+    )
+
+    # a store with another dtype or embedder starts over
+    half = VectorStore(str(tmpdir), dtype="float16")
+    assert half.search(["otters"]) == [[]]
+    assert half.add(chunks) == 3
+    assert half.search(["rivers"], k=1)[0][0][1]["id"] == chunks[0]["id"]
+    with pytest.raises(ValueError):
+        VectorStore(str(tmpdir), dtype="int8")
+
+
+def test_vector_store_top(create_app, tmpdir):
+    from otterwiki.vectorstore import VectorStore, normalize
+
+    store = VectorStore(str(tmpdir))
+    store.BLOCK = 7
+    rng = np.random.default_rng(42)
+    matrix = normalize(rng.normal(size=(100, 16)).astype(np.float32))
+    queries = normalize(rng.normal(size=(5, 16)).astype(np.float32))
+    alive = np.ones(100, dtype=bool)
+    alive[::3] = False
+    scores, rows = store.top(matrix, alive, queries, 4)
+    expected = queries @ matrix.T
+    expected[:, ~alive] = -np.inf
+    assert (rows == np.argsort(-expected, axis=1)[:, :4]).all()
+    assert np.allclose(scores, np.sort(expected, axis=1)[:, ::-1][:, :4])
+
+
+def test_vector_store_ivf(create_app, tmpdir):
+    from otterwiki.vectorstore import VectorStore, normalize
+
+    # clustered vectors, as the embeddings of similar texts are
+    rng = np.random.default_rng(42)
+    centers = normalize(rng.normal(size=(20, 32)))
+    data = normalize(
+        centers[rng.integers(0, 20, size=1000)]
+        + rng.normal(scale=0.2, size=(1000, 32))
+    ).astype(np.float32)
+
+    class DataEmbedder:
+        name, dim = "data", 32
+
+        def embed(self, texts):
+            return data[[int(text) for text in texts]]
+
+    store = VectorStore(str(tmpdir), embedder=DataEmbedder())
+    store.IVF_ROWS = 800
+    chunks = [make_chunk("Data", str(i)) for i in range(1000)]
+    store.add(chunks[:900])
+    # the store has been clustered into sqrt(900) lists
+    assert store._load()["centroids"].shape == (30, 32)
+    # appended rows are assigned to their list
+    store.add(chunks[900:])
+    store.delete([chunks[0]["id"], chunks[950]["id"]])
+
+    def ids(result):
+        return [[c["id"] for _, c in r] for r in result]
+
+    queries = data[:50]
+    exact = ids(store.search_vectors(queries, k=10, exact=True))
+    assert chunks[0]["id"] not in sum(exact, [])
+    # all lists probed is exact
+    assert ids(store.search_vectors(queries, k=10, nprobe=30)) == exact
+    approximate = ids(store.search_vectors(queries, k=10, nprobe=3))
+    recall = np.mean(
+        [len(set(a) & set(e)) / 10 for a, e in zip(approximate, exact)]
+    )
+    assert recall > 0.8
+    # appended rows are found
+    assert ids(store.search_vectors(data[[951]], k=1)) == [[chunks[951]["id"]]]
+
+    # the lists are kept by the compaction
+    store.compact(force=True)
+    assert store._load()["sorted"] == 998
+    assert ids(store.search_vectors(queries, k=10, nprobe=30)) == exact
+
+
+def test_change_feed(create_app, tmpdir):
+    from otterwiki.server import storage
+    from otterwiki.vectorstore import ChangeFeed, HashingEmbedder, VectorStore
+
+    class CountingEmbedder(HashingEmbedder):
+        embedded = 0
+
+        def embed(self, texts):
+            self.embedded += len(texts)
+            return super().embed(texts)
+
+    author = ("Example Author", "mail@example.com")
+    store = VectorStore(
+        str(tmpdir.mkdir("vectors")), embedder=CountingEmbedder()
+    )
+    feed = ChangeFeed(storage, store)
+    storage.store(
+        "feedotters.md",
+        "# Otters\n\notters swim in rivers\n\n## Food\n\notters eat fish\n",
+        author=author,
+    )
+    storage.store("feedgit.md", "# Git\n\ngit stores commits\n", author=author)
+    # the first update chunks all pages
+    assert feed.update() > 0
+    assert store.head() == storage.repo.head.commit.hexsha
+    assert {"feedotters", "feedgit"} <= store.pages()
+    assert feed.update() == 0
+
+    # only the changed page is chunked again and only its new chunk embedded
+    embedded = store.embedder.embedded
+    rows = len(store._execute("SELECT id FROM chunk"))
+    storage.store(
+        "feedotters.md",
+        "# Otters\n\notters swim in rivers\n\n## Food\n\notters eat crabs\n",
+        author=author,
+    )
+    reads = feed.reads
+    assert feed.update() == 1
+    assert feed.reads == reads + 1
+    assert store.embedder.embedded == embedded + 1
+    assert len(store._execute("SELECT id FROM chunk")) == rows
+    texts = [c["text"] for _, c in store.search(["crabs"], k=1)[0]]
+    assert texts == ["otters eat crabs"]
+
+    # removed pages are removed from the store
+    storage.delete("feedgit.md", author=author)
+    assert feed.update() == 1
+    assert "feedgit" not in store.pages()
+    assert "feedotters" in store.pages()
+
+
+def test_vector_store_threads(create_app, tmpdir):
+    import threading
+    import time
+
+    from otterwiki.vectorstore import HashingEmbedder, VectorStore
+
+    class SlowEmbedder(HashingEmbedder):
+        def embed(self, texts):
+            # within the transaction of replace_page
+            time.sleep(0.01)
+            return super().embed(texts)
+
+    store = VectorStore(str(tmpdir), embedder=SlowEmbedder())
+    versions = [
+        [make_chunk("Page", f"version {v} part {i}") for i in range(3)]
+        for v in range(2)
+    ]
+    store.replace_page("Page", versions[0])
+    done = threading.Event()
+
+    def write():
+        for i in range(20):
+            store.replace_page("Page", versions[i % 2])
+        done.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    seen = set()
+    # the readers never see a replace_page half applied
+    while not done.is_set():
+        chunks = store.page_chunks(["Page"])["Page"]
+        seen.add(len(chunks))
+    writer.join()
+    assert seen <= {3}